@@ -1,14 +1,22 @@
+import io
 import logging
 
 import itertools
+from collections import deque
+from hashlib import blake2b
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple, Union
 from zipfile import ZipFile
-from tempfile import TemporaryDirectory
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 import lief.DEX
 
 from .heckel_diff import diff as heckel_diff
 from .encoder import Encoder, DefaultEncoder
 from .classes_differ import ClassesDiffer
+from .features import ClassFeatures, extract_features
+from .artifacts import Artifact, DIGEST_CHUNK_SIZE
+from .diff_cache import DiffCache, cache_configuration
+from . import artifacts, profiling
 
 import faulthandler
 faulthandler.enable()
@@ -16,6 +24,9 @@ faulthandler.enable()
 
 logger = logging.getLogger(__name__)
 
+# rough peak memory of parsing a dex with lief and extracting its features, relative to its size
+DEX_MEMORY_FACTOR = 12
+
 
 class APKDiffer:
 
@@ -23,37 +34,200 @@ class APKDiffer:
     def filter_class(cls: lief.DEX.Class) -> bool:
         return True
 
-    def __init__(self, class_filtering_function=None, encoder=DefaultEncoder):
+    def __init__(self, class_filtering_function=None, encoder=DefaultEncoder, fuzzy_matcher=None, encoding_workers=1, workers=None, memory_budget=None, cache: Optional[DiffCache] = None):
         self._classes_differ = ClassesDiffer(
-            class_filtering_function, encoder)
-
-        # parsed dexs are stored while diffing is ongoing, in order to prevent GC which segfaults
-        self._dexs = []
-
-    def diff(self, old_apk_path: str, new_apk_path: str):
-        old_classes = self._extract_apk_classes(old_apk_path)
-        new_classes = self._extract_apk_classes(new_apk_path)
-
-        logger.info(f'total classes: {len(old_classes)} -> {len(new_classes)}')
-
-        result = self._classes_differ.diff(old_classes, new_classes)
-        self._dexs = []
-        return result
-
-    def _extract_apk_classes(self, apk_path: str):
-        classes = []
-        tmp_dir = TemporaryDirectory()
-
-        with ZipFile(apk_path) as z:
-            namelist = z.namelist()
-            for i in itertools.count(start=1):
-                dex_filename = 'classes' + ('' if i == 1 else str(i)) + '.dex'
-                if (dex_filename not in namelist):
-                    logger.info(f'APK {apk_path} has {i-1} dex files')
-                    break
-                dex = lief.DEX.parse(z.extract(dex_filename, tmp_dir.name))
-                self._dexs.append(dex)
-                
-                classes.extend(sorted(dex.classes, key=lambda c: c.index))
-
-        return classes
+            class_filtering_function, encoder, fuzzy_matcher, encoding_workers)
+
+        # number of processes parsing dex files, None means one per core and 1 parses in-process
+        self._workers = workers
+
+        # bytes the dex files parsed at once may take, estimated from their sizes, None for no bound
+        self._memory_budget = memory_budget
+
+        # optional on-disk cache of the mappings of past diffs
+        self._cache = cache
+
+    def diff(self, old_apk: Artifact, new_apk: Artifact):
+        """Diff two apks, each given by path, as bytes or as a binary file object. 
+        """
+        old_apk, new_apk = artifacts.load(old_apk), artifacts.load(new_apk)
+
+        configuration = cache_configuration(self._cache, self._classes_differ)
+        if configuration is not None:
+            key = self._cache.key(artifacts.digest(old_apk), artifacts.digest(new_apk), configuration)
+            result = self._cache.get(key)
+            if result is None:
+                result = self._diff(old_apk, new_apk)
+                self._cache.put(key, result)
+            return result
+
+        return self._diff(old_apk, new_apk)
+
+    def _diff(self, old_apk, new_apk):
+        return self.diff_dexs(*self._extract_apks_dexs([old_apk, new_apk]))
+
+    def diff_dexs(self, old_dexs: List[Tuple[bytes, List[ClassFeatures]]], new_dexs: List[Tuple[bytes, List[ClassFeatures]]]):
+        """Diff two apks given as the content digest and class features of their dex files, 
+        as returned by `extract_dexs`, the classes of identical dex files mapping to themselves. 
+        """
+        return self._classes_differ.diff(*_classes_pair(old_dexs, new_dexs))
+
+    def diff_many(self, pairs: Iterable[Tuple[Artifact, Artifact]], workers=None):
+        """Diff (old apk, new apk) pairs, returning their mappings in order. 
+
+        Every dex file is parsed once across all the pairs, however many apks contain it, 
+        and pairs are diffed concurrently as by `ClassesDiffer.diff_many`. 
+        """
+        pairs = list(pairs)
+        loaded = artifacts.load_all(apk for pair in pairs for apk in pair)
+
+        def diff_pairs(indices):
+            needed = list(dict.fromkeys(id(apk) for i in indices for apk in pairs[i]))
+            dexs = dict(zip(needed, self._extract_apks_dexs([loaded[key] for key in needed])))
+
+            return self._classes_differ.diff_many(
+                [_classes_pair(dexs[id(pairs[i][0])], dexs[id(pairs[i][1])]) for i in indices], workers)
+
+        configuration = cache_configuration(self._cache, self._classes_differ)
+        if configuration is None:
+            return diff_pairs(range(len(pairs)))
+
+        digests = {key: artifacts.digest(source) for key, source in loaded.items()}
+        return self._cache.diff_many(
+            [self._cache.key(digests[id(old_apk)], digests[id(new_apk)], configuration) for old_apk, new_apk in pairs], diff_pairs)
+
+    def extract_features(self, apk: Artifact) -> List[ClassFeatures]:
+        return [cls for _, classes in self.extract_dexs(apk) for cls in classes]
+
+    def extract_dexs(self, apk: Artifact) -> List[Tuple[bytes, List[ClassFeatures]]]:
+        """Return the content digest and class features of every dex file of `apk`. 
+        """
+        dexs, = self._extract_apks_dexs([artifacts.load(apk)])
+        return dexs
+
+    def _extract_apks_dexs(self, apks: List[Union[str, bytes]]) -> List[List[Tuple[bytes, List[ClassFeatures]]]]:
+        """Return the content digest and class features of every dex file of every loaded apk. 
+        """
+        with profiling.section('dex extraction'):
+            dex_files = [_list_dex_files(apk) for apk in apks]
+
+        # identical dex files, typically across two builds, are parsed once
+        unique_dex_files = {}
+        for apk, apk_dex_files in zip(apks, dex_files):
+            for name, size, digest in apk_dex_files:
+                unique_dex_files.setdefault(digest, (apk, name, size))
+
+        with profiling.section('parsing'):
+            parsed = self._parse_dex_files(unique_dex_files)
+
+        return [[(digest, parsed[digest]) for _, _, digest in apk_dex_files] for apk_dex_files in dex_files]
+
+    def _parse_dex_files(self, dex_files) -> Dict[bytes, List[ClassFeatures]]:
+        """Return the class features of `dex_files`, given as (apk, name, size) by digest. 
+
+        Dex files are read and parsed one at a time per process, and only their features are kept. 
+        In worker processes, parsing only starts when the estimated memory of the dex files already 
+        being parsed leaves room for it in the memory budget. 
+        """
+        if self._workers == 1 or len(dex_files) <= 1:
+            return {digest: _parse_dex_features(apk, name) for digest, (apk, name, _) in dex_files.items()}
+
+        def submit(digest):
+            apk, name, _ = dex_files[digest]
+            if isinstance(apk, str):
+                return executor.submit(_parse_dex_features, apk, name)
+            # workers can't reopen an apk held in memory, so they get the dex alone
+            return executor.submit(_parse_dex, _read_dex(apk, name))
+
+        with ProcessPoolExecutor(self._workers) as executor:
+            return run_within_memory_budget(
+                submit, [(digest, _dex_memory(size)) for digest, (_, _, size) in dex_files.items()], self._memory_budget)
+
+
+def run_within_memory_budget(submit, tasks: List[Tuple[Hashable, int]], memory_budget: Optional[int]) -> Dict:
+    """Run `tasks`, given as (key, estimated memory), by `submit`, which starts the task of a key 
+    and returns its future, and return their results by key. 
+
+    A task only starts when the estimated memory of those already running leaves room for it in 
+    `memory_budget`, None meaning no bound. 
+    """
+    results = {}
+    pending = deque(tasks)
+    running = {}
+    in_flight = 0
+
+    while pending or running:
+        # a single task is always let through, even when it alone exceeds the budget
+        while pending and (not running or memory_budget is None or in_flight + pending[0][1] <= memory_budget):
+            key, memory = pending.popleft()
+            running[submit(key)] = (key, memory)
+            in_flight += memory
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            key, memory = running.pop(future)
+            in_flight -= memory
+            results[key] = future.result()
+
+    return results
+
+
+def _classes_pair(old_dexs, new_dexs):
+    """Return the classes of two extracted apks, and the initial mapping of their identical dex files. 
+    """
+    old_classes = [cls for _, classes in old_dexs for cls in classes]
+    new_classes = [cls for _, classes in new_dexs for cls in classes]
+
+    logger.info(f'total classes: {len(old_classes)} -> {len(new_classes)}')
+
+    # the classes of dex files found unchanged in both apks map to themselves
+    identical_digests = set(digest for digest, _ in old_dexs) & set(digest for digest, _ in new_dexs)
+    initial_mapping = {cls.fullname: cls.fullname for digest, classes in new_dexs if digest in identical_digests for cls in classes}
+    logger.info(f'{len(identical_digests)} identical dex files')
+
+    return old_classes, new_classes, initial_mapping
+
+def _open_apk(apk: Union[str, bytes]) -> ZipFile:
+    return ZipFile(apk if isinstance(apk, str) else io.BytesIO(apk))
+
+def _list_dex_files(apk: Union[str, bytes]) -> List[Tuple[str, int, bytes]]:
+    """Return the name, uncompressed size and content digest of the dex files of an apk, 
+    hashing their content in chunks rather than reading it whole. 
+    """
+    dex_files = []
+
+    with _open_apk(apk) as z:
+        namelist = set(z.namelist())
+        for i in itertools.count(start=1):
+            dex_filename = 'classes' + ('' if i == 1 else str(i)) + '.dex'
+            if (dex_filename not in namelist):
+                logger.info(f'APK has {i-1} dex files')
+                break
+
+            digest = blake2b(digest_size=16)
+            with z.open(dex_filename) as f:
+                for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            dex_files.append((dex_filename, z.getinfo(dex_filename).file_size, digest.digest()))
+
+    return dex_files
+
+def _read_dex(apk: Union[str, bytes], name: str) -> bytes:
+    with _open_apk(apk) as z:
+        return z.read(name)
+
+def _dex_memory(size: int) -> int:
+    return DEX_MEMORY_FACTOR * size
+
+def _parse_dex_features(apk: Union[str, bytes], name: str) -> List[ClassFeatures]:
+    return _parse_dex(_read_dex(apk, name))
+
+def _parse_dex(data: bytes) -> List[ClassFeatures]:
+    # only plain features are returned, so the dex and its lief objects are freed right after; 
+    # lief takes bytes for a file name, so the data is handed over as a buffer
+    dex = lief.DEX.parse(memoryview(data))
+    del data
+    classes = sorted(dex.classes, key=lambda c: c.index)
+    features = extract_features(classes)
+    del classes, dex
+    return features
@@ -0,0 +1,45 @@
+import os
+from hashlib import blake2b
+from typing import BinaryIO, Union
+
+
+# a dex or apk file, given by path, by content, or as a binary file object
+Artifact = Union[str, os.PathLike, bytes, bytearray, memoryview, BinaryIO]
+
+DIGEST_CHUNK_SIZE = 1 << 20
+
+
+def load(artifact: Artifact) -> Union[str, bytes]:
+    """Return `artifact` as a path, or as bytes when it was given in memory.
+
+    File objects are read from their current position, so each must be loaded once.
+    """
+    if isinstance(artifact, (str, os.PathLike)):
+        return os.fspath(artifact)
+    if isinstance(artifact, (bytes, bytearray, memoryview)):
+        return bytes(artifact)
+    return artifact.read()
+
+
+def digest(source: Union[str, bytes]) -> bytes:
+    """Return the content digest of a loaded artifact, reading files in chunks.
+    """
+    if isinstance(source, bytes):
+        return blake2b(source, digest_size=16).digest()
+
+    digest = blake2b(digest_size=16)
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def load_all(artifacts) -> dict:
+    """Load every distinct artifact object once, keyed by identity, as the same file object
+    can't be read twice.
+    """
+    loaded = {}
+    for artifact in artifacts:
+        if id(artifact) not in loaded:
+            loaded[id(artifact)] = load(artifact)
+    return loaded
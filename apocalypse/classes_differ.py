@@ -1,9 +1,21 @@
+import functools
+import heapq
 import logging
+import multiprocessing
+import time
+import types
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
+from typing import TYPE_CHECKING, Optional
 
-import lief.DEX
+from .heckel_diff import default_diff as heckel_diff
+from .encoder import DefaultEncoder
+from .features import extract_features
+from . import profiling
 
-from .heckel_diff import diff as heckel_diff
-from .encoder import Encoder, DefaultEncoder
+if TYPE_CHECKING:
+    import lief.DEX
 
 
 logger = logging.getLogger(__name__)
@@ -12,46 +24,434 @@ logger = logging.getLogger(__name__)
 class ClassesDiffer:
 
     @staticmethod
-    def filter_class(cls: lief.DEX.Class) -> bool:
+    def filter_class(cls: 'lief.DEX.Class') -> bool:
         return cls.index != 4294967295  # filter out external classes
 
-    def __init__(self, class_filtering_function=None, encoder=DefaultEncoder):
+    def __init__(self, class_filtering_function=None, encoder=DefaultEncoder, fuzzy_matcher=None, encoding_workers=1):
         if class_filtering_function is None:
             class_filtering_function = self.filter_class
         self._class_filtering_function = class_filtering_function
+        self._encoder_class = encoder
         self._encoder = encoder()
 
-    def diff(self, old_classes, new_classes):
-        old_classes = [cls for cls in old_classes if self._class_filtering_function(cls)]
-        new_classes = [cls for cls in new_classes if self._class_filtering_function(cls)]
+        # optional final stage matching the residual by similarity, see FuzzyMatcher
+        self._fuzzy_matcher = fuzzy_matcher
+
+        # number of processes encoding shards of the classes, 1 encodes in-process
+        self._encoding_workers = encoding_workers
+
+    def configuration(self) -> Optional[str]:
+        """Describe the settings that decide the mappings, to key cached diffs with, 
+        or return None when they can't be described reliably and diffs must not be cached. 
+
+        Functions are told apart by name, bytecode, defaults and captured values, and partials 
+        by their function and arguments, so a changed filter doesn't hit stale entries. 
+        """
+        parts = [_describe(self._class_filtering_function), _describe(self._encoder_class), repr(self._fuzzy_matcher)]
+        if None in parts:
+            return None
+        return '|'.join(parts)
+
+    def diff(self, old_classes, new_classes, initial_mapping=None):
+        """Diff two class lists, given either as `lief.DEX.Class` objects or as `ClassFeatures` snapshots. 
+
+        Pairs of `initial_mapping` (e.g. the classes of identical dex files) are taken as matched 
+        before any stage, and so are classes of the same name whose whole definition is identical 
+        and unique on both sides. Matched classes still anchor their neighbours in every stage. 
+        """
+        with profiling.section('filtering'):
+            old_classes = extract_features(cls for cls in old_classes if self._class_filtering_function(cls))
+            new_classes = extract_features(cls for cls in new_classes if self._class_filtering_function(cls))
 
         logger.info(
             f'filtered classes: {len(old_classes)} -> {len(new_classes)}')
 
-        successful_mappings = 0
-        self._encoder.set_mapping({}, {})
+        with profiling.section('content hashing'):
+            old_lines, new_lines = _pin_identical(old_classes, new_classes, initial_mapping or {})
+
+        mapping = {old_classes[old_line].fullname: new_classes[new_line].fullname for old_line, new_line in zip(old_lines, new_lines)}
+        reverse_mapping = {new: old for old, new in mapping.items()}
+        self._encoder.set_mapping(mapping, reverse_mapping)
+
+        logger.info(f'pinned {len(mapping)} identical classes')
+        profiling.record_diff(old_classes=len(old_classes), new_classes=len(new_classes), pinned=len(mapping))
+
+        if self._encoding_workers > 1:
+            residuals = _ShardedResiduals(old_classes, new_classes, self._encoder_class, mapping, old_lines, new_lines, self._encoding_workers)
+        else:
+            residuals = _Residuals(old_classes, new_classes, self._encoder, old_lines, new_lines)
+        try:
+            self._diff_residuals(old_classes, new_classes, mapping, reverse_mapping, residuals)
+        finally:
+            residuals.close()
+
+        return mapping, reverse_mapping
+
+    def diff_many(self, pairs, workers=None):
+        """Diff several (old classes, new classes, initial mapping) triples, returning their mappings in order. 
+
+        Pairs are diffed concurrently by `workers` processes, one per core when None, 
+        so the filtering function and encoder must be picklable unless `workers` is 1. 
+        """
+        pairs = list(pairs)
+        if workers == 1 or len(pairs) <= 1:
+            return [self.diff(old_classes, new_classes, initial_mapping) for old_classes, new_classes, initial_mapping in pairs]
+
+        with ProcessPoolExecutor(workers) as executor:
+            return list(executor.map(_diff_pair, [self] * len(pairs), *zip(*pairs)))
+
+    def _diff_residuals(self, old_classes, new_classes, mapping, reverse_mapping, residuals):
+        previous_precision = None
+        mapping_delta = {}
+        reverse_mapping_delta = {}
 
         for i, precision in enumerate(self._encoder.get_stages()):
-            old_encoding = [self._encoder.encode_old_class(
-                cls, precision) for cls in old_classes]
-            new_encoding = [self._encoder.encode_new_class(
-                cls, precision) for cls in new_classes]
-            
-            mapping, reverse_mapping = heckel_diff(old_encoding, new_encoding)
+            residuals.invalidate(precision != previous_precision, mapping_delta, reverse_mapping_delta)
+            previous_precision = precision
+
+            start = time.perf_counter()
+            old_lines, old_encoding, new_lines, new_encoding = residuals.encode(precision)
+            encoding_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            stage_mapping, _ = heckel_diff(old_encoding, new_encoding)
+            heckel_time = time.perf_counter() - start
+
+            # matched classes are in the sequences as anchors only, their pairs are already known
+            stage_pairs = [(old_lines[i], new_lines[j]) for i, j in stage_mapping.items()
+                           if old_classes[old_lines[i]].fullname not in mapping and new_classes[new_lines[j]].fullname not in reverse_mapping]
 
-            mapping = {
-                old_classes[i].fullname: new_classes[mapping[i]].fullname for i in mapping}
-            reverse_mapping = {
-                new_classes[i].fullname: old_classes[reverse_mapping[i]].fullname for i in reverse_mapping}
+            mapping_delta = {
+                old_classes[old_line].fullname: new_classes[new_line].fullname for old_line, new_line in stage_pairs}
+            reverse_mapping_delta = {
+                new: old for old, new in mapping_delta.items()}
 
-            self._encoder.set_mapping(mapping, reverse_mapping)
+            mapping.update(mapping_delta)
+            reverse_mapping.update(reverse_mapping_delta)
+
+            residuals.remove([old_line for old_line, _ in stage_pairs], [new_line for _, new_line in stage_pairs])
 
             logger.info(f'pass #{i + 1} resulted in {len(mapping)} mappings')
 
-            if len(mapping) == successful_mappings:
+            if profiling.active():
+                profiling.record_stage(
+                    precision=precision.name,
+                    encoding=encoding_time,
+                    heckel=heckel_time,
+                    **_cardinalities(old_encoding, new_encoding),
+                    mappings=len(mapping_delta))
+
+            if not mapping_delta:
                 logger.info('breaking early since no progress is being made')
                 break
 
-            successful_mappings = len(mapping)
+        if self._fuzzy_matcher is not None:
+            old_lines, new_lines = residuals.lines()
 
-        return mapping, reverse_mapping
+            start = time.perf_counter()
+            stage_mapping = self._fuzzy_matcher.match(
+                [old_classes[line] for line in old_lines], [new_classes[line] for line in new_lines], mapping)
+            fuzzy_time = time.perf_counter() - start
+
+            for i, j in stage_mapping.items():
+                mapping[old_classes[old_lines[i]].fullname] = new_classes[new_lines[j]].fullname
+                reverse_mapping[new_classes[new_lines[j]].fullname] = old_classes[old_lines[i]].fullname
+
+            logger.info(f'fuzzy pass resulted in {len(mapping)} mappings')
+
+            profiling.record_stage(
+                precision='FUZZY',
+                matching=fuzzy_time,
+                old_classes=len(old_lines),
+                new_classes=len(new_lines),
+                mappings=len(stage_mapping))
+
+
+def _describe(value) -> Optional[str]:
+    """Return a description of `value` that is stable across processes, or None when there is none. 
+
+    Module globals a function reads aren't part of its description. 
+    """
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return repr(value)
+
+    if isinstance(value, (tuple, list, set, frozenset)):
+        items = [_describe(item) for item in value]
+        if None in items:
+            return None
+        if isinstance(value, (set, frozenset)):
+            items.sort()
+        return f"{type(value).__name__}({','.join(items)})"
+
+    if isinstance(value, dict):
+        items = [(_describe(key), _describe(item)) for key, item in value.items()]
+        if any(None in pair for pair in items):
+            return None
+        return f"dict({','.join(sorted(f'{key}:{item}' for key, item in items))})"
+
+    if isinstance(value, functools.partial):
+        parts = [_describe(value.func), _describe(value.args), _describe(value.keywords)]
+        if None in parts:
+            return None
+        return f"partial({','.join(parts)})"
+
+    if isinstance(value, type):
+        return f'{value.__module__}.{value.__qualname__}'
+
+    if isinstance(value, types.FunctionType):
+        try:
+            captured = [cell.cell_contents for cell in value.__closure__ or ()]
+        except ValueError:
+            return None  # a captured variable isn't assigned yet
+        parts = [_describe_code(value.__code__), _describe(value.__defaults__), _describe(value.__kwdefaults__), _describe(captured)]
+        if None in parts:
+            return None
+        return f"{value.__module__}.{value.__qualname__}:{blake2b(','.join(parts).encode(), digest_size=8).hexdigest()}"
+
+    return None
+
+
+def _describe_code(code) -> str:
+    # nested code objects, e.g. of lambdas, are described by content as their repr holds an address,
+    # and frozensets in sorted order as theirs depends on string hashing. 
+    # The bytecode refers to attributes, globals and variables by index, so their names are part of it
+    consts = [_describe_code(const) if isinstance(const, types.CodeType) else _describe(const) or repr(const) for const in code.co_consts]
+    names = [' '.join(code.co_names), ' '.join(code.co_varnames), ' '.join(code.co_freevars)]
+    return blake2b(code.co_code + '\n'.join(consts + names).encode(), digest_size=8).hexdigest()
+
+
+def _diff_pair(differ, old_classes, new_classes, initial_mapping):
+    # runs in a worker process, on its own copy of the differ
+    return differ.diff(old_classes, new_classes, initial_mapping)
+
+
+def _pin_identical(old_classes, new_classes, initial_mapping):
+    """Return the old and new lines of the classes matched before any stage. 
+    """
+    old_lines_by_name = {cls.fullname: line for line, cls in enumerate(old_classes)}
+    new_lines_by_name = {cls.fullname: line for line, cls in enumerate(new_classes)}
+
+    pinned = {old_lines_by_name[old]: new_lines_by_name[new] for old, new in initial_mapping.items()
+              if old in old_lines_by_name and new in new_lines_by_name}
+    pinned_new = set(pinned.values())
+
+    old_digests = defaultdict(list)
+    for line, cls in enumerate(old_classes):
+        if line not in pinned:
+            old_digests[cls.content_digest()].append(line)
+    new_digests = defaultdict(list)
+    for line, cls in enumerate(new_classes):
+        if line not in pinned_new:
+            new_digests[cls.content_digest()].append(line)
+
+    for digest, old_lines in old_digests.items():
+        new_lines = new_digests.get(digest)
+        if len(old_lines) != 1 or new_lines is None or len(new_lines) != 1:
+            continue
+        # renamed classes are left to the stages, which only match them by structure where the encoder does
+        if old_classes[old_lines[0]].fullname == new_classes[new_lines[0]].fullname:
+            pinned[old_lines[0]] = new_lines[0]
+
+    return list(pinned), list(pinned.values())
+
+def _cardinalities(old_encoding, new_encoding):
+    # colliding symbols are shared by several classes of one side, which heckel can't match
+    old_counts = Counter(old_encoding)
+    new_counts = Counter(new_encoding)
+    return {
+        'old_classes': len(old_encoding),
+        'new_classes': len(new_encoding),
+        'unique_symbols': len(old_counts.keys() | new_counts.keys()),
+        'colliding_symbols': len({symbol for counts in (old_counts, new_counts) for symbol, count in counts.items() if count > 1}),
+    }
+
+
+class _Residuals:
+    """The classes of both sides of a diff, encoded in-process. 
+
+    Every class is diffed at every stage, matched ones standing as anchors for their neighbours, 
+    but a matched class is encoded once, as the name it maps to, and an unmatched one is only 
+    re-encoded when the precision changes or a type it mentions got mapped. 
+    """
+
+    def __init__(self, old_classes, new_classes, encoder, old_matched_lines, new_matched_lines):
+        self._old = _Residual(old_classes, encoder.encode_old_class, encoder.get_dependencies, old_matched_lines)
+        self._new = _Residual(new_classes, encoder.encode_new_class, encoder.get_dependencies, new_matched_lines)
+
+    def invalidate(self, everything, mapping_delta, reverse_mapping_delta):
+        if everything:
+            self._old.invalidate_all()
+            self._new.invalidate_all()
+        else:
+            self._old.invalidate(mapping_delta)
+            self._new.invalidate(reverse_mapping_delta)
+
+    def encode(self, precision):
+        return (*self._old.encode(precision), *self._new.encode(precision))
+
+    def remove(self, old_lines, new_lines):
+        self._old.remove(old_lines)
+        self._new.remove(new_lines)
+
+    def lines(self):
+        return self._old.lines(), self._new.lines()
+
+    def close(self):
+        pass
+
+
+class _ShardedResiduals:
+    """The classes of both sides of a diff, encoded by worker processes. 
+
+    Each worker keeps a fixed shard of both sides as `_Residuals` of its own, and is only sent 
+    the mapping delta and matched lines of every stage, so classes are shipped to it once. 
+    """
+
+    def __init__(self, old_classes, new_classes, encoder_class, mapping, old_matched_lines, new_matched_lines, workers):
+        self._old_lines = set(range(len(old_classes))).difference(old_matched_lines)
+        self._new_lines = set(range(len(new_classes))).difference(new_matched_lines)
+
+        # the first stage gets the whole mapping found before it as delta
+        self._everything = True
+        self._mapping_delta = dict(mapping)
+        self._removed_old_lines = list(old_matched_lines)
+        self._removed_new_lines = list(new_matched_lines)
+
+        self._connections = []
+        self._processes = []
+        for shard in range(workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_encode_shards, 
+                args=(worker_connection, encoder_class, 
+                      [(line, old_classes[line]) for line in range(shard, len(old_classes), workers)], 
+                      [(line, new_classes[line]) for line in range(shard, len(new_classes), workers)]), 
+                daemon=True)
+            process.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+    def invalidate(self, everything, mapping_delta, reverse_mapping_delta):
+        self._everything = self._everything or everything
+        self._mapping_delta.update(mapping_delta)
+
+    def encode(self, precision):
+        message = (precision, self._everything, self._mapping_delta, self._removed_old_lines, self._removed_new_lines)
+        for connection in self._connections:
+            connection.send(message)
+
+        self._everything = False
+        self._mapping_delta = {}
+        self._removed_old_lines = []
+        self._removed_new_lines = []
+
+        # shards come back sorted by line, and are merged as such
+        results = [connection.recv() for connection in self._connections]
+        old = list(heapq.merge(*(zip(old_lines, old_encoding) for old_lines, old_encoding, _, _ in results), key=lambda entry: entry[0]))
+        new = list(heapq.merge(*(zip(new_lines, new_encoding) for _, _, new_lines, new_encoding in results), key=lambda entry: entry[0]))
+        return [line for line, _ in old], [encoding for _, encoding in old], [line for line, _ in new], [encoding for _, encoding in new]
+
+    def remove(self, old_lines, new_lines):
+        self._old_lines.difference_update(old_lines)
+        self._new_lines.difference_update(new_lines)
+        self._removed_old_lines.extend(old_lines)
+        self._removed_new_lines.extend(new_lines)
+
+    def lines(self):
+        return sorted(self._old_lines), sorted(self._new_lines)
+
+    def close(self):
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass  # the worker already exited, e.g. after a failure
+            connection.close()
+        for process in self._processes:
+            process.join()
+
+
+def _encode_shards(connection, encoder_class, old_shard, new_shard):
+    # runs in a worker process, with lines of the shards local to it and translated at the boundary
+    encoder = encoder_class()
+    mapping = {}
+    reverse_mapping = {}
+    encoder.set_mapping(mapping, reverse_mapping)
+
+    old_lines = [line for line, _ in old_shard]
+    new_lines = [line for line, _ in new_shard]
+    old_local_lines = {line: i for i, line in enumerate(old_lines)}
+    new_local_lines = {line: i for i, line in enumerate(new_lines)}
+    residuals = _Residuals([cls for _, cls in old_shard], [cls for _, cls in new_shard], encoder, (), ())
+
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        precision, everything, mapping_delta, removed_old_lines, removed_new_lines = message
+
+        residuals.remove([old_local_lines[line] for line in removed_old_lines if line in old_local_lines], 
+                         [new_local_lines[line] for line in removed_new_lines if line in new_local_lines])
+
+        reverse_mapping_delta = {new: old for old, new in mapping_delta.items()}
+        mapping.update(mapping_delta)
+        reverse_mapping.update(reverse_mapping_delta)
+        residuals.invalidate(everything, mapping_delta, reverse_mapping_delta)
+
+        old_shard_lines, old_encoding, new_shard_lines, new_encoding = residuals.encode(precision)
+        connection.send(([old_lines[line] for line in old_shard_lines], old_encoding, 
+                         [new_lines[line] for line in new_shard_lines], new_encoding))
+
+    connection.close()
+
+
+class _Residual:
+    """The classes of one side of a diff, with their cached encodings. 
+
+    Matched classes keep the encoding they got once matched, which no longer changes. 
+    """
+
+    def __init__(self, classes, encode, get_dependencies, matched_lines=()):
+        self._classes = classes
+        self._encode = encode
+
+        # the still unmatched lines
+        self._lines = set(range(len(classes))).difference(matched_lines)
+        self._encodings = {}
+        self._dirty = set(range(len(classes)))
+
+        # reverse dependency index, from a class name to the lines whose encoding mentions it
+        self._dependents = defaultdict(list)
+        self._always_dirty = set()
+        for line in self._lines:
+            dependencies = get_dependencies(classes[line])
+            if dependencies is None:
+                self._always_dirty.add(line)
+                continue
+            for dependency in dependencies:
+                self._dependents[dependency].append(line)
+
+    def invalidate_all(self):
+        self._dirty.update(self._lines)
+
+    def invalidate(self, mapped_names):
+        self._dirty.update(self._always_dirty & self._lines)
+        for name in mapped_names:
+            self._dirty.update(line for line in self._dependents.get(name, ()) if line in self._lines)
+
+    def lines(self):
+        return sorted(self._lines)
+
+    def encode(self, precision):
+        for line in self._dirty:
+            self._encodings[line] = self._encode(self._classes[line], precision)
+        self._dirty = set()
+
+        lines = list(range(len(self._classes)))
+        return lines, [self._encodings[line] for line in lines]
+
+    def remove(self, lines):
+        # matched lines are encoded once more, as the name they map to
+        self._lines.difference_update(lines)
+        self._dirty.update(lines)
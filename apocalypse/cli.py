@@ -1,41 +1,123 @@
 import click
+import csv
 import logging
 import json
+from contextlib import contextmanager
 from pathlib import Path
-from apocalypse.dex_differ import DexDiffer
-from apocalypse.apk_differ import APKDiffer
 import apocalypse.timeline as timeline
+from apocalypse.server import Server, Client, DEFAULT_ADDRESS
+from apocalypse.profiling import Profile
 
 
+@contextmanager
+def _profiled(report_path):
+    if report_path is None:
+        yield
+        return
+
+    with Profile() as profile:
+        yield
+    with open(report_path, 'w') as f:
+        json.dump(profile.report(), f, indent=2)
+
+def _megabytes(value):
+    return value * 2**20 if value is not None else None
+
 @click.group()
 @click.option('-v', '--verbose', is_flag=True)
-def main(verbose):
+@click.option('--server', envvar='APOCALYPSE_SERVER', metavar='ADDRESS', 
+              help='Forward queries to a running `apocalypse serve` (http://host:port or unix:PATH). ')
+@click.pass_context
+def main(ctx, verbose, server):
     if verbose:
         logging.basicConfig(level=logging.INFO)
+    ctx.obj = Client(server) if server else None
 
 @main.command()
 @click.argument('name')
 @click.option('--format', type=click.Choice(['APK', 'DEX']), default='APK')
-def init(name: str, format: str):
+@click.option('--storage', type=click.Choice(timeline.STORAGE_FORMATS), default='json', help='On-disk format of the maps. ')
+@click.option('--range-cache-size', type=int, default=timeline.RANGE_CACHE_SIZE // 2**20, show_default=True, 
+              help='Bound of the cached map query results, in MB, 0 disables the cache. ')
+@click.option('--sources', type=click.Choice(timeline.SOURCE_LAYOUTS), default='files', show_default=True,
+              help='Keep a copy of every source file, or store their entries once by content. ')
+@click.option('--memory-budget', type=int, default=None, 
+              help='MB the dex files parsed at once may take when inserting versions, unbounded by default. ')
+def init(name: str, format: str, storage: str, range_cache_size: int, sources: str, memory_budget: int):
     """Initialize a new timeline. 
     """
-    timeline.init(name, format)
+    timeline.init(name, format, storage, range_cache_size * 2**20, sources, _megabytes(memory_budget))
 
 @main.command()
 @click.argument('version')
 @click.argument('file', type=click.Path(exists=True))
 @click.option('-f', '--force', is_flag=True)
 @click.option('--compute/--no-compute', default=True)
-def insert(version: str, file: str, force: bool, compute: bool):
+@click.option('--profile', type=click.Path(), help='Write a JSON report of the time and memory spent per diff stage. ')
+@click.option('-J', '--encoding-workers', type=int, default=1, help='Number of processes encoding classes in every diff stage. ')
+@click.option('--memory-budget', type=int, default=None, 
+              help='MB the dex files parsed at once may take, the timeline\'s by default. ')
+def insert(version: str, file: str, force: bool, compute: bool, profile: str, encoding_workers: int, memory_budget: int):
     """Insert a version into the timeline. 
     """
-    timeline.insert_version(version, file, force, compute)
+    with _profiled(profile):
+        timeline.insert_version(version, file, force, compute, encoding_workers, _megabytes(memory_budget))
 
 @main.command()
-def versions():
+@click.argument('storage', type=click.Choice(timeline.STORAGE_FORMATS))
+def migrate(storage: str):
+    """Convert the maps of the timeline to another storage format. 
+    """
+    timeline.migrate_storage(storage)
+
+@main.command('insert-many')
+@click.argument('source', type=click.Path(exists=True))
+@click.option('-f', '--force', is_flag=True)
+@click.option('-j', '--workers', type=int, default=None, help='Number of diffing processes, one per core by default. ')
+@click.option('--memory-budget', type=int, default=None, 
+              help='MB the dex files parsed at once may take, the timeline\'s by default. ')
+def insert_many(source: str, force: bool, workers: int, memory_budget: int):
+    """Insert many versions from a directory or manifest file. 
+
+    SOURCE is either a directory of files named after their versions, or a manifest 
+    with a 'VERSION PATH' pair per line (or a JSON object of version to path). 
+    An interrupted insertion resumes when the same command is run again. 
+    """
+    def progress(done, total):
+        click.echo(f'diffed {done}/{total} version pairs', err=True)
+
+    timeline.insert_versions(timeline.read_manifest(source), force, workers, progress, _megabytes(memory_budget))
+
+@main.command()
+@click.option('--from', 'from_', metavar='VERSION', help='First version of the range to rebuild. ')
+@click.option('--to', metavar='VERSION', help='Last version of the range to rebuild. ')
+@click.option('-j', '--workers', type=int, default=None, help='Number of diffing processes, one per core by default. ')
+@click.option('--memory-budget', type=int, default=None, 
+              help='MB the dex files parsed at once may take, the timeline\'s by default. ')
+def rebuild(from_: str, to: str, workers: int, memory_budget: int):
+    """Recompute the maps between adjacent versions, e.g. after changing the encoder or filter. 
+
+    An interrupted rebuild resumes when the same command is run again. 
+    """
+    def progress(done, total):
+        click.echo(f'diffed {done}/{total} version pairs', err=True)
+
+    timeline.rebuild(from_, to, workers, progress, _megabytes(memory_budget))
+
+@main.command()
+@click.option('--address', default=DEFAULT_ADDRESS, show_default=True, help='http://host:port or unix:PATH')
+@click.option('--cache-size', type=int, default=512, show_default=True, help='Memory bound of the cache, in MB. ')
+def serve(address: str, cache_size: int):
+    """Serve queries on the timeline, keeping loaded maps and features cached. 
+    """
+    Server(cache_size * 1024 * 1024).serve_forever(address)
+
+@main.command()
+@click.pass_obj
+def versions(client):
     """Show versions in timeline. 
     """
-    result = timeline.versions()
+    result = client.request('versions') if client else timeline.versions()
     if result:
         click.echo('\n'.join(result))
 
@@ -43,12 +125,39 @@ def versions():
 @click.option('--version/--file', default=True, help='Chose whether to compare versions or files. ')
 @click.argument('from_', metavar='FROM')
 @click.argument('to')
-def map(from_: str, to: str, version: bool):
+@click.option('--profile', type=click.Path(), help='Write a JSON report of the time and memory spent per diff stage. ')
+@click.option('--jsonl', is_flag=True, help='Stream one {"from", "to"} JSON object per line instead of a single map. ')
+@click.option('--package', help='Only map the classes of this package (e.g. com.example) and its subpackages. ')
+@click.option('-J', '--encoding-workers', type=int, default=1, help='Number of processes encoding classes when diffing files. ')
+@click.option('--cache', is_flag=True, help='Reuse the mappings of files diffed before, kept under $XDG_CACHE_HOME/apocalypse. ')
+@click.option('--cache-size', type=int, default=1024, show_default=True, help='Bound of the diff cache, in MB. ')
+@click.option('--fuzzy', is_flag=True, help='Match the classes left over by the exact stages by similarity when diffing files. ')
+@click.pass_obj
+def map(client, from_: str, to: str, version: bool, profile: str, jsonl: bool, package: str, encoding_workers: int, cache: bool, cache_size: int, fuzzy: bool):
     """Map classes from one version to another. 
     """
-    if version:
-        click.echo(timeline.map(from_, to))
+    with _profiled(profile):
+        _map(client, from_, to, version, jsonl, package, encoding_workers, cache, cache_size, fuzzy)
+
+def _map(client, from_, to, version, jsonl, package, encoding_workers, cache, cache_size, fuzzy):
+    params = {} if package is None else {'package': package}
+
+    if version and client:
+        pairs = (client.request('map', from_=from_, to=to, **params) or {}).items()
+    elif version and jsonl:
+        pairs = timeline.iter_map(from_, to, package)
+    elif version:
+        click.echo(timeline.map(from_, to, package))
+        return
     else:
+        from apocalypse.dex_differ import DexDiffer
+        from apocalypse.apk_differ import APKDiffer
+        from apocalypse.diff_cache import DiffCache
+        from apocalypse.fuzzy import FuzzyMatcher
+
+        diff_cache = DiffCache(max_size=cache_size * 2**20) if cache else None
+        fuzzy_matcher = FuzzyMatcher() if fuzzy else None
+
         from_ = Path(from_)
         if not from_.is_file():
             click.echo(f"Error: Invalid value for 'FROM': Path '{from_}' does not exist. \n")
@@ -62,30 +171,64 @@ def map(from_: str, to: str, version: bool):
             click.echo(f"Error: Different file extensions for '{from_.as_posix()}' and '{to.as_posix()}'")
             return
         elif from_.suffix == '.dex':
-            differ = DexDiffer()
+            differ = DexDiffer(fuzzy_matcher=fuzzy_matcher, encoding_workers=encoding_workers, cache=diff_cache)
         elif from_.suffix == '.apk':
-            differ = APKDiffer()
+            differ = APKDiffer(fuzzy_matcher=fuzzy_matcher, encoding_workers=encoding_workers, cache=diff_cache)
         else:
             click.echo(f"Error: Invalid file extension '{from_.suffix}'")
             return
-        mapping, _ = differ.diff(from_.as_posix(), to.as_posix())
-        click.echo(json.dumps(mapping))
+
+        if client:
+            if fuzzy:
+                params['fuzzy'] = 1
+            pairs = client.request('diff', from_=from_.resolve().as_posix(), to=to.resolve().as_posix(), **params).items()
+        else:
+            mapping, _ = differ.diff(from_.as_posix(), to.as_posix())
+            pairs = timeline.filter_package(mapping.items(), package)
+
+    if jsonl:
+        for class_name, mapped_name in pairs:
+            click.echo(json.dumps({'from': class_name, 'to': mapped_name}))
+    else:
+        click.echo(json.dumps(dict(pairs)))
 
 @main.command()
 @click.argument('version')
 @click.argument('class_', metavar='CLASS')
-def until(version, class_):
+@click.pass_obj
+def until(client, version, class_):
     """Print the last version where CLASS from VERSION existed. 
     """
-    click.echo(f"Class '{class_}' existed until version {timeline.until(version, class_)}")
+    click.echo(f"Class '{class_}' existed until version {client.request('until', version=version, class_=class_) if client else timeline.until(version, class_)}")
 
 @main.command()
 @click.argument('version')
 @click.argument('class_', metavar='CLASS')
-def since(version, class_):
+@click.pass_obj
+def since(client, version, class_):
     """Print the first version where CLASS from VERSION appeared. 
     """
-    click.echo(f"Class '{class_}' existed since version {timeline.since(version, class_)}")
+    click.echo(f"Class '{class_}' existed since version {client.request('since', version=version, class_=class_) if client else timeline.since(version, class_)}")
+
+@main.command()
+@click.option('--format', 'format_', type=click.Choice(['jsonl', 'csv']), default='jsonl', show_default=True)
+@click.option('-o', '--output', type=click.File('w'), default='-', help='File to write to, stdout by default. ')
+def lifetimes(format_: str, output):
+    """Print the first version, last version and names of every class, as JSON lines or CSV. 
+
+    CSV rows have a column per version, empty where the class doesn't exist. 
+    """
+    if format_ == 'csv':
+        versions = timeline.versions()
+        if versions is None:
+            return
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow(['first', 'last'] + versions)
+        for first, last, names in timeline.lifetimes():
+            writer.writerow([first, last] + [names.get(version, '') for version in versions])
+    else:
+        for first, last, names in timeline.lifetimes():
+            output.write(json.dumps({'first': first, 'last': last, 'names': names}) + '\n')
 
 
 if __name__ == '__main__':
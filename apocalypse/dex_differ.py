@@ -1,10 +1,15 @@
 import logging
+from typing import Iterable, List, Optional, Tuple
 
 import lief.DEX
 
 from .heckel_diff import diff as heckel_diff
 from .encoder import Encoder, DefaultEncoder
 from .classes_differ import ClassesDiffer
+from .features import ClassFeatures, extract_features
+from .artifacts import Artifact
+from .diff_cache import DiffCache, cache_configuration
+from . import artifacts, profiling
 
 
 logger = logging.getLogger(__name__)
@@ -16,18 +21,87 @@ class DexDiffer:
     def filter_class(cls: lief.DEX.Class) -> bool:
         return True
 
-    def __init__(self, class_filtering_function=None, encoder=DefaultEncoder):
+    def __init__(self, class_filtering_function=None, encoder=DefaultEncoder, fuzzy_matcher=None, encoding_workers=1, cache: Optional[DiffCache] = None):
         self._classes_differ = ClassesDiffer(
-            class_filtering_function, encoder)
+            class_filtering_function, encoder, fuzzy_matcher, encoding_workers)
 
-    def diff(self, old_dex_path: str, new_dex_path: str):
-        old_dex = lief.DEX.parse(old_dex_path)
-        new_dex = lief.DEX.parse(new_dex_path)
+        # optional on-disk cache of the mappings of past diffs
+        self._cache = cache
+
+    def diff(self, old_dex: Artifact, new_dex: Artifact):
+        """Diff two dex files, each given by path, as bytes or as a binary file object. 
+        """
+        old_dex, new_dex = artifacts.load(old_dex), artifacts.load(new_dex)
+        old_digest, new_digest = artifacts.digest(old_dex), artifacts.digest(new_dex)
+
+        configuration = cache_configuration(self._cache, self._classes_differ)
+        if configuration is not None:
+            key = self._cache.key(old_digest, new_digest, configuration)
+            result = self._cache.get(key)
+            if result is None:
+                result = self._diff(old_dex, new_dex, old_digest == new_digest)
+                self._cache.put(key, result)
+            return result
+
+        return self._diff(old_dex, new_dex, old_digest == new_digest)
+
+    def _diff(self, old_dex, new_dex, identical):
+        if identical:
+            # identical files: every class maps to itself, and one parse is enough
+            old_classes = new_classes = self.extract_features(old_dex)
+            initial_mapping = {cls.fullname: cls.fullname for cls in old_classes}
+        else:
+            old_classes = self.extract_features(old_dex)
+            new_classes = self.extract_features(new_dex)
+            initial_mapping = None
 
         logger.info(
-            f'total classes: {len(old_dex.classes)} -> {len(new_dex.classes)}')
+            f'total classes: {len(old_classes)} -> {len(new_classes)}')
+
+        return self._classes_differ.diff(old_classes, new_classes, initial_mapping)
+
+    def diff_many(self, pairs: Iterable[Tuple[Artifact, Artifact]], workers=None):
+        """Diff (old dex, new dex) pairs, returning their mappings in order. 
+
+        A dex file appearing in several pairs, by content, is parsed once, 
+        and pairs are diffed concurrently as by `ClassesDiffer.diff_many`. 
+        """
+        pairs = list(pairs)
+        loaded = artifacts.load_all(dex for pair in pairs for dex in pair)
+        digests = {key: artifacts.digest(source) for key, source in loaded.items()}
+        pair_digests = [(digests[id(old_dex)], digests[id(new_dex)]) for old_dex, new_dex in pairs]
+
+        def diff_pairs(indices):
+            features = {}
+            classes_pairs = []
+            for i in indices:
+                (old_dex, new_dex), (old_digest, new_digest) = pairs[i], pair_digests[i]
+                for dex, digest in ((old_dex, old_digest), (new_dex, new_digest)):
+                    if digest not in features:
+                        features[digest] = self.extract_features(loaded[id(dex)])
+
+                old_classes, new_classes = features[old_digest], features[new_digest]
+                initial_mapping = {cls.fullname: cls.fullname for cls in old_classes} if old_digest == new_digest else None
+                classes_pairs.append((old_classes, new_classes, initial_mapping))
+
+            return self._classes_differ.diff_many(classes_pairs, workers)
+
+        configuration = cache_configuration(self._cache, self._classes_differ)
+        if configuration is None:
+            return diff_pairs(range(len(pairs)))
+
+        return self._cache.diff_many(
+            [self._cache.key(old_digest, new_digest, configuration) for old_digest, new_digest in pair_digests], diff_pairs)
 
-        old_dex_classes = sorted(old_dex.classes, key=lambda c: c.index)
-        new_dex_classes = sorted(new_dex.classes, key=lambda c: c.index)
+    def extract_dexs(self, dex: Artifact) -> List[Tuple[bytes, List[ClassFeatures]]]:
+        """Return the content digest and class features of `dex`, as `APKDiffer.extract_dexs` does for apks. 
+        """
+        dex = artifacts.load(dex)
+        return [(artifacts.digest(dex), self.extract_features(dex))]
 
-        return self._classes_differ.diff(old_dex_classes, new_dex_classes)
+    def extract_features(self, dex: Artifact) -> List[ClassFeatures]:
+        with profiling.section('parsing'):
+            source = artifacts.load(dex)
+            # lief takes bytes for a file name, so in-memory data is handed over as a buffer
+            dex = lief.DEX.parse(memoryview(source) if isinstance(source, bytes) else source)
+            return extract_features(sorted(dex.classes, key=lambda c: c.index))
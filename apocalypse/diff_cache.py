@@ -0,0 +1,110 @@
+import gzip
+import json
+import logging
+import os
+from hashlib import blake2b
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from .storage import TMP_SUFFIX, atomic_write
+
+
+logger = logging.getLogger(__name__)
+
+
+# bumped whenever the differ changes its mappings, so entries of older releases are never served
+CACHE_VERSION = 1
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+
+def default_folder() -> Path:
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'apocalypse'
+
+
+def cache_configuration(cache: Optional['DiffCache'], classes_differ) -> Optional[str]:
+    """Return the configuration to key the diffs of `classes_differ` with in `cache`, 
+    or None when diffs aren't cached. 
+    """
+    if cache is None:
+        return None
+    configuration = classes_differ.configuration()
+    if configuration is None:
+        logger.warning('not caching diffs, as the filtering function or encoder can\'t be described')
+    return configuration
+
+
+class DiffCache:
+    """Mappings of past diffs on disk, shared by every process of a user, keyed by the content
+    of both inputs and the configuration of the differ.
+
+    Entries beyond `max_size` bytes are evicted least recently used first, recency being
+    tracked by the modification time of entries, which a hit refreshes.
+    """
+
+    def __init__(self, folder=None, max_size: int = DEFAULT_MAX_SIZE):
+        self._folder = Path(folder) if folder is not None else default_folder()
+        self._max_size = max_size
+
+    def key(self, old_digest: bytes, new_digest: bytes, configuration: str) -> str:
+        key = blake2b(digest_size=16)
+        for part in (str(CACHE_VERSION).encode(), old_digest, new_digest, configuration.encode()):
+            key.update(len(part).to_bytes(4, 'little') + part)
+        return key.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, str], Dict[str, str]]]:
+        path = self._folder / key
+        try:
+            with gzip.open(path, 'rb') as f:
+                mapping = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process since it was read
+            pass
+        return mapping, {new: old for old, new in mapping.items()}
+
+    def put(self, key: str, result: Tuple[Dict[str, str], Dict[str, str]]):
+        # the reverse mapping is the inverse of the mapping, so only the latter is stored
+        mapping, _ = result
+
+        self._folder.mkdir(parents=True, exist_ok=True)
+        with atomic_write(self._folder / key, 'wb') as raw, gzip.open(raw, 'wt') as f:
+            json.dump(mapping, f, separators=(',', ':'))
+
+        self._evict()
+
+    def diff_many(self, keys, diff_missing):
+        """Return the results of `keys`, those not cached being computed at once by `diff_missing`, 
+        given their indices, and stored. 
+        """
+        results = [self.get(key) for key in keys]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            for i, result in zip(missing, diff_missing(missing)):
+                self.put(keys[i], result)
+                results[i] = result
+
+        return results
+
+    def _evict(self):
+        entries = []
+        for path in self._folder.iterdir():
+            if path.name.endswith(TMP_SUFFIX):
+                continue
+            try:
+                entries.append((path.stat(), path))
+            except FileNotFoundError:
+                # evicted by another process meanwhile
+                continue
+
+        size = sum(stat.st_size for stat, _ in entries)
+        for stat, path in sorted(entries, key=lambda entry: entry[0].st_mtime):
+            if size <= self._max_size:
+                break
+            path.unlink(missing_ok=True)
+            size -= stat.st_size
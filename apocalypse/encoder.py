@@ -1,8 +1,9 @@
 from abc import ABC, abstractmethod
 from enum import IntEnum
 from collections import defaultdict
+from hashlib import blake2b
 
-import lief.DEX
+from .features import ClassFeatures, PRIMITIVES
 
 
 class Precision(IntEnum):
@@ -23,109 +24,160 @@ class Encoder(ABC):
         self._reverse_mapping = reverse_mapping
 
     @abstractmethod
-    def encode_old_class(self, cls: lief.DEX.Class):
+    def encode_old_class(self, cls: ClassFeatures):
         pass
     
     @abstractmethod
-    def encode_new_class(self, cls: lief.DEX.Class):
+    def encode_new_class(self, cls: ClassFeatures):
         pass
 
     @abstractmethod
     def get_stages(self):
         pass
 
+    def get_dependencies(self, cls: ClassFeatures):
+        """Return the class names whose mapping can change the encoding of `cls`, 
+        or None if the encoding may depend on any mapping. 
+        """
+        return None
+
 
 class DefaultEncoder(Encoder):
+    """Encodes classes into 128-bit blake2b digests of their features. 
 
-    def __init__(self):
+    With `debug` set, the readable encoding string is returned instead of its digest. 
+    Both modes produce the same matches, as the digest is computed over that exact string. 
+    """
+
+    DIGEST_SIZE = 16
+
+    def __init__(self, debug=False):
         super().__init__()
+        self._debug = debug
+
+        # encoding templates of the classes of the ongoing diff, by class identity and precision
+        self._templates = {}
+
+    def set_mapping(self, mapping, reverse_mapping):
+        super().set_mapping(mapping, reverse_mapping)
+        self._templates = {}
 
-    def encode_old_class(self, cls: lief.DEX.Class, precision: Precision = Precision.PERFECT):
+    def encode_old_class(self, cls: ClassFeatures, precision: Precision = Precision.PERFECT):
         if cls.fullname in self._mapping:
-            return self._mapping[cls.fullname]
+            return self._finalize(self._mapping[cls.fullname])
 
         return self._encode_class(cls, True, precision)
     
-    def encode_new_class(self, cls: lief.DEX.Class, precision: Precision = Precision.PERFECT):
+    def encode_new_class(self, cls: ClassFeatures, precision: Precision = Precision.PERFECT):
         if cls.fullname in self._reverse_mapping:
-            return cls.fullname
+            return self._finalize(cls.fullname)
 
         return self._encode_class(cls, False, precision)
 
-    def _encode_class(self, cls: lief.DEX.Class, old: bool, precision: Precision):
+    def _finalize(self, encoding: str):
+        if self._debug:
+            return encoding
+        return blake2b(encoding.encode(), digest_size=self.DIGEST_SIZE).digest()
+
+    def _encode_class(self, cls: ClassFeatures, old: bool, precision: Precision):
         if len(cls.package_name) > 3 or len(cls.fullname) == 1:
-            return cls.fullname
-        
-        types = [cls.fullname]
+            return self._finalize(cls.fullname)
 
         mapping = self._mapping if old else self._reverse_mapping
 
-        def encode_type(type_: lief.DEX.Type):
-            representation = ''
+        parts = []
+        if cls.has_parent:
+            if cls.parent in mapping:
+                if old:
+                    parts.append(mapping[cls.parent])
+                else:
+                    parts.append(cls.parent)
+            elif len(cls.parent_package_name) > 3:
+                parts.append(cls.parent)
+            else:
+                parts.append('_')
+
+        # types are numbered in order of first appearance, the class itself being 0
+        type_ids = {cls.fullname: 0}
+
+        chunks, types = self._template(cls, precision)
+        parts.append(chunks[0])
+        for type_, chunk in zip(types, chunks[1:]):
+            array = type_.startswith('[')
+            base_type = type_[1:] if array else type_
 
-            if type(type_.value) is list:
-                representation += '['
-                type_ = type_.underlying_array_type
-            
-            if type_.type == lief.DEX.Type.TYPES.PRIMITIVE:
-                representation += type_.value.name
+            if base_type in PRIMITIVES:
+                parts.append(type_)
+            elif base_type in mapping:
+                parts.append(mapping[base_type] if old else base_type)
             else:
-                if old and type_.value.fullname in mapping:
-                    return mapping[type_.value.fullname]
-                elif not old and type_.value.fullname in mapping:
-                    return type_.value.fullname
+                type_id = type_ids.get(base_type)
+                if type_id is None:
+                    type_id = type_ids[base_type] = len(type_ids)
+                parts.append('[' + str(type_id) if array else str(type_id))
+
+            parts.append(chunk)
+
+        # the parts are joined and hashed at once: feeding them to the digest one by one gives 
+        # the same digest, but the many small updates made encoding about a third slower
+        return self._finalize(''.join(parts))
+
+    def _template(self, cls: ClassFeatures, precision: Precision):
+        """Return the mapping independent parts of the encoding of `cls`, as the literal chunks
+        around its type references and those types, computed once per class and precision.
+        """
+        key = (id(cls), precision)
+        entry = self._templates.get(key)
+        if entry is not None:
+            return entry[1]
+
+        chunks = []
+        types = []
+        chunk = '$' + str(cls.access_flags) + ',' + cls.package_name
+
+        for method in cls.methods:
+            chunk += '|'
 
-                if type_.value.fullname in types:
-                    representation += str(types.index(type_.value.fullname))
-                else:
-                    types.append(type_.value.fullname)
-                    representation += str(len(types) - 1)
-            
-            return representation
-        
-        def encode_method_signature(method: lief.DEX.Method):
-            result = ''
-            
             if len(method.name) > 4:
-                result += '.'.join(method.name.split('$')[:2]) + '!'
+                chunk += '.'.join(method.name.split('$')[:2]) + '!'
 
             if precision < Precision.API_CHANGE:
-                prototype = [encode_type(t) for t in method.prototype.parameters_type]
-                prototype.append(encode_type(method.prototype.return_type))
+                for i, type_ in enumerate(method.parameters_type + [method.return_type]):
+                    if i:
+                        chunk += ','
+                    chunks.append(chunk)
+                    types.append(type_)
+                    chunk = ''
 
-            return result + ','.join(prototype)
+            chunk += ',' + str(method.access_flags) + ','
 
-        encoding = ''
-        
-        if cls.has_parent:
-            if cls.parent.fullname in mapping:
-                if old:
-                    encoding += mapping[cls.parent.fullname]
-                else:
-                    encoding += cls.parent.fullname
-            elif len(cls.parent.package_name) > 3:
-                encoding += cls.parent.fullname
-            else:
-                encoding += '_'
-        
-        encoding += '$'
+            if precision < Precision.IMPLEMENTATION_CHANGE:
+                chunk += str(method.bytecode_length)
+                if method.bytecode_length:
+                    chunk += ':' + str(method.bytecode_first)
 
-        encoding += str(sum(int(flag) for flag in cls.access_flags)) + ','
-        encoding += cls.package_name
+        chunks.append(chunk)
 
-        for method in cls.methods:
-            encoding += '|'
+        # the class is kept alongside, so that its id can't be reused by another class
+        self._templates[key] = (cls, (chunks, types))
+        return chunks, types
 
-            encoding += encode_method_signature(method) + ','
+    def get_dependencies(self, cls: ClassFeatures):
+        if len(cls.package_name) > 3 or len(cls.fullname) == 1:
+            return set()
 
-            encoding += str(sum(int(flag) for flag in method.access_flags)) + ','
+        dependencies = set()
 
-            if precision < Precision.IMPLEMENTATION_CHANGE:
-                encoding += str(len(method.bytecode))
-                if method.bytecode:
-                    encoding += ':' + str(method.bytecode[0])
+        if cls.has_parent:
+            dependencies.add(cls.parent)
+
+        for method in cls.methods:
+            for type_ in method.parameters_type + [method.return_type]:
+                type_ = type_.lstrip('[')
+                if type_ not in PRIMITIVES:
+                    dependencies.add(type_)
 
-        return encoding
+        return dependencies
 
     def get_stages(self):
         return [
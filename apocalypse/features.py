@@ -0,0 +1,153 @@
+import gc
+import gzip
+import json
+from hashlib import blake2b
+from typing import TYPE_CHECKING, List, Optional
+
+from .storage import atomic_write
+
+if TYPE_CHECKING:
+    import lief.DEX
+
+
+# names of lief.DEX.Type.PRIMITIVES, spelled out so that reading snapshots doesn't load lief
+PRIMITIVES = frozenset(['VOID_T', 'BOOLEAN', 'BYTE', 'SHORT', 'CHAR', 'INT', 'LONG', 'FLOAT', 'DOUBLE'])
+
+
+class MethodFeatures:
+
+    __slots__ = ('name', 'parameters_type', 'return_type', 'access_flags', 'bytecode_length', 'bytecode_first')
+
+    def __init__(self, name: str, parameters_type: List[str], return_type: str,
+                 access_flags: int, bytecode_length: int, bytecode_first: Optional[int]):
+        self.name = name
+        self.parameters_type = parameters_type
+        self.return_type = return_type
+        self.access_flags = access_flags
+        self.bytecode_length = bytecode_length
+        self.bytecode_first = bytecode_first
+
+    @classmethod
+    def from_lief(cls, method: 'lief.DEX.Method'):
+        bytecode = method.bytecode
+        return cls(
+            method.name,
+            [_type_name(t) for t in method.prototype.parameters_type],
+            _type_name(method.prototype.return_type),
+            _flags_value(method.access_flags),
+            len(bytecode),
+            bytecode[0] if bytecode else None)
+
+    def to_json(self):
+        return [self.name, self.parameters_type, self.return_type,
+                self.access_flags, self.bytecode_length, self.bytecode_first]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(*data)
+
+
+class ClassFeatures:
+    """Plain snapshot of the parts of a `lief.DEX.Class` that encoders read.
+
+    Types are stored by name: class types by fullname, primitives by their
+    `lief.DEX.Type.PRIMITIVES` name, and arrays with a leading '['.
+    """
+
+    __slots__ = ('fullname', 'package_name', 'index', 'access_flags', 'parent', 'parent_package_name', 'methods')
+
+    def __init__(self, fullname: str, package_name: str, index: int, access_flags: int,
+                 parent: Optional[str], parent_package_name: Optional[str], methods: List[MethodFeatures]):
+        self.fullname = fullname
+        self.package_name = package_name
+        self.index = index
+        self.access_flags = access_flags
+        self.parent = parent
+        self.parent_package_name = parent_package_name
+        self.methods = methods
+
+    @property
+    def has_parent(self):
+        return self.parent is not None
+
+    @classmethod
+    def from_lief(cls, lief_class: 'lief.DEX.Class'):
+        if lief_class.has_parent:
+            parent = lief_class.parent.fullname
+            parent_package_name = lief_class.parent.package_name
+        else:
+            parent = None
+            parent_package_name = None
+
+        return cls(
+            lief_class.fullname,
+            lief_class.package_name,
+            lief_class.index,
+            _flags_value(lief_class.access_flags),
+            parent,
+            parent_package_name,
+            [MethodFeatures.from_lief(method) for method in lief_class.methods])
+
+    def content_digest(self) -> bytes:
+        """Digest of the whole class definition except its name and position,
+        which identical classes share even when renamed.
+        """
+        name = self.fullname
+
+        # names and types can't contain newlines or commas, so joining them is unambiguous
+        parts = [self.package_name, str(self.access_flags), str(self.parent), str(self.parent_package_name)]
+        for method in self.methods:
+            types = method.parameters_type + [method.return_type]
+            signature = ','.join(types)
+            if name in signature:
+                signature = ','.join(['' if t.lstrip('[') == name else t for t in types])
+            parts.append(f'{method.name}\n{signature}\n{method.access_flags},{method.bytecode_length},{method.bytecode_first}')
+        return blake2b('\n'.join(parts).encode(), digest_size=16).digest()
+
+    def to_json(self):
+        return [self.fullname, self.package_name, self.index, self.access_flags,
+                self.parent, self.parent_package_name, [method.to_json() for method in self.methods]]
+
+    @classmethod
+    def from_json(cls, data):
+        *fields, methods = data
+        return cls(*fields, [MethodFeatures.from_json(method) for method in methods])
+
+
+def extract_features(classes) -> List[ClassFeatures]:
+    return [cls if isinstance(cls, ClassFeatures) else ClassFeatures.from_lief(cls) for cls in classes]
+
+def save_features(classes: List[ClassFeatures], path):
+    with atomic_write(path, 'wb') as raw, gzip.open(raw, 'wt') as f:
+        json.dump([cls.to_json() for cls in classes], f, separators=(',', ':'))
+
+def load_features(path) -> List[ClassFeatures]:
+    # the cyclic GC would otherwise rescan the growing heap many times while the records
+    # get built, and records are built inline since from_json calls add up at this scale
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with gzip.open(path, 'rb') as f:
+            data = json.loads(f.read())
+        return [ClassFeatures(*fields, [MethodFeatures(*method) for method in methods]) for *fields, methods in data]
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def _type_name(type_: 'lief.DEX.Type') -> str:
+    import lief.DEX
+
+    prefix = ''
+
+    # arrays are told by their kind, as newer lief releases fail to give their value
+    if type_.type == lief.DEX.Type.TYPES.ARRAY:
+        prefix = '['
+        type_ = type_.underlying_array_type
+
+    if type_.type == lief.DEX.Type.TYPES.PRIMITIVE:
+        return prefix + type_.value.name
+    return prefix + type_.value.fullname
+
+def _flags_value(flags) -> int:
+    # flags are int enums in older lief releases, and plain enums with a value in newer ones
+    return sum(int(getattr(flag, 'value', flag)) for flag in flags)
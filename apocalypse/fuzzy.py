@@ -0,0 +1,140 @@
+import random
+from collections import Counter, defaultdict
+from hashlib import blake2b
+from typing import Dict, List
+
+from .features import ClassFeatures
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# MinHash signatures are computed with universal hashes (a * x + b) mod P over 32-bit shingle hashes,
+# with a and b below 2 ** 31 so that they can't overflow 64-bit integers
+_PRIME = 4294967311
+_UNKNOWN_TYPE = '?'
+
+
+class FuzzyMatcher:
+    """Matches classes left over by the exact stages by the similarity of their method shingles.
+
+    Each class becomes a set of shingles from its method signatures and bytecode features,
+    summarized by a MinHash signature. Signatures are cut in bands and classes sharing a band
+    within the same package become candidate pairs (locality-sensitive hashing), so only
+    similar classes are ever compared. A pair is matched when each class is the other's most
+    similar candidate, unambiguously, with a Jaccard similarity of at least `threshold`.
+    """
+
+    def __init__(self, threshold: float = 0.7, bands: int = 16, rows: int = 4, max_bucket_size: int = 64, seed: int = 0):
+        self._threshold = threshold
+        self._bands = bands
+        self._rows = rows
+        # huge buckets come from trivial classes (e.g. empty ones) that can't be told apart anyway
+        self._max_bucket_size = max_bucket_size
+        self._seed = seed
+
+        rng = random.Random(seed)
+        self._a = [rng.randrange(1, 2 ** 31) for _ in range(bands * rows)]
+        self._b = [rng.randrange(2 ** 31) for _ in range(bands * rows)]
+
+    def __repr__(self):
+        return (f'FuzzyMatcher(threshold={self._threshold}, bands={self._bands}, rows={self._rows}, '
+                f'max_bucket_size={self._max_bucket_size}, seed={self._seed})')
+
+    def match(self, old_classes: List[ClassFeatures], new_classes: List[ClassFeatures], mapping: Dict[str, str]) -> Dict[int, int]:
+        """Return matches from indices of `old_classes` to indices of `new_classes`, the unmatched classes of a diff.
+
+        Types are compared through the `mapping` found so far, and the unmatched classes are all alike.
+        """
+        old_unknown = set(cls.fullname for cls in old_classes)
+        new_unknown = set(cls.fullname for cls in new_classes)
+        old_shingles = [_shingles(cls, mapping, old_unknown) for cls in old_classes]
+        new_shingles = [_shingles(cls, {}, new_unknown) for cls in new_classes]
+
+        old_signatures = self._signatures(old_shingles)
+        new_signatures = self._signatures(new_shingles)
+
+        buckets = defaultdict(lambda: ([], []))
+        for side, classes, signatures in ((0, old_classes, old_signatures), (1, new_classes, new_signatures)):
+            for i, (cls, signature) in enumerate(zip(classes, signatures)):
+                for band in range(self._bands):
+                    key = (cls.package_name, band, tuple(signature[band * self._rows:(band + 1) * self._rows]))
+                    buckets[key][side].append(i)
+
+        candidates = set()
+        for old_lines, new_lines in buckets.values():
+            if old_lines and new_lines and len(old_lines) + len(new_lines) <= self._max_bucket_size:
+                candidates.update((old_line, new_line) for old_line in old_lines for new_line in new_lines)
+
+        old_best = {}
+        new_best = {}
+        for old_line, new_line in candidates:
+            similarity = _jaccard(old_shingles[old_line], new_shingles[new_line])
+            if similarity < self._threshold:
+                continue
+            _offer(old_best, old_line, new_line, similarity)
+            _offer(new_best, new_line, old_line, similarity)
+
+        return {old_line: new_line for old_line, (new_line, _) in old_best.items()
+                if new_line is not None and new_best.get(new_line, (None,))[0] == old_line}
+
+    def _signatures(self, shingles):
+        hashes = [[int.from_bytes(blake2b(shingle.encode(), digest_size=4).digest(), 'little') for shingle in class_shingles]
+                  for class_shingles in shingles]
+
+        if np is not None:
+            signatures = np.full((len(hashes), len(self._a)), _PRIME, dtype=np.uint64)
+            non_empty = [i for i, class_hashes in enumerate(hashes) if class_hashes]
+            if non_empty:
+                # all shingles are hashed at once, then reduced per class
+                flat = np.array([h for i in non_empty for h in hashes[i]], dtype=np.uint64)
+                starts = np.cumsum([0] + [len(hashes[i]) for i in non_empty[:-1]])
+                values = (flat[:, None] * np.array(self._a, dtype=np.uint64) + np.array(self._b, dtype=np.uint64)) % np.uint64(_PRIME)
+                signatures[non_empty] = np.minimum.reduceat(values, starts, axis=0)
+            return signatures.tolist()
+
+        return [[min(((a * h + b) % _PRIME for h in class_hashes), default=_PRIME) for a, b in zip(self._a, self._b)]
+                for class_hashes in hashes]
+
+
+def _shingles(cls: ClassFeatures, mapping: Dict[str, str], unknown_types) -> frozenset:
+    def encode_type(type_):
+        array = '[' if type_.startswith('[') else ''
+        type_ = type_.lstrip('[')
+        if type_ in unknown_types:
+            return array + _UNKNOWN_TYPE
+        return array + mapping.get(type_, type_)
+
+    shingles = ['class:' + str(cls.access_flags)]
+    if cls.has_parent:
+        shingles.append('parent:' + encode_type(cls.parent))
+
+    for method in cls.methods:
+        signature = '(' + ','.join(encode_type(t) for t in method.parameters_type) + ')' + encode_type(method.return_type)
+        name = method.name if len(method.name) > 4 else ''
+        shingles.append(f'method:{name}{signature}/{method.access_flags}/{method.bytecode_length}:{method.bytecode_first}')
+        shingles.append(f'signature:{name}{signature}/{method.access_flags}')
+        shingles.append(f'code:{method.bytecode_length}:{method.bytecode_first}')
+
+    # repeated shingles are numbered, so the sets behave as multisets
+    counts = Counter()
+    numbered = []
+    for shingle in shingles:
+        counts[shingle] += 1
+        numbered.append(f'{shingle}#{counts[shingle]}')
+    return frozenset(numbered)
+
+def _jaccard(a: frozenset, b: frozenset) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+def _offer(best, line, other_line, similarity):
+    # ties make the match ambiguous, which is recorded as a None best
+    current = best.get(line)
+    if current is None or similarity > current[1]:
+        best[line] = (other_line, similarity)
+    elif similarity == current[1] and current[0] != other_line:
+        best[line] = (None, similarity)
@@ -1,7 +1,13 @@
+import bisect
 from typing import List, Any
 
 from dataclasses import dataclass
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 @dataclass
 class Symbol:
@@ -55,8 +61,8 @@ def diff(old : List[Any], new : List[Any]):
             reverse_mapping[line] = entry.olno
 
     # Pass 4
-    for line, symbol in list(enumerate(new))[1:]:
-        if line - 1 not in reverse_mapping:
+    for line in range(1, len(new)):
+        if line - 1 not in reverse_mapping or line in reverse_mapping:
             continue
 
         maybe_old_line = reverse_mapping[line - 1] + 1
@@ -64,22 +70,120 @@ def diff(old : List[Any], new : List[Any]):
         if maybe_old_line >= len(old) or maybe_old_line in mapping:
             continue
 
-        if old[maybe_old_line] == symbol:
+        if old[maybe_old_line] == new[line]:
             mapping[maybe_old_line] = line
             reverse_mapping[line] = maybe_old_line
 
     # Pass 5
-    for line, symbol in list(reversed(list(enumerate(new))))[:1]:
-        if line + 1 not in reverse_mapping:
+    for line in reversed(range(len(new) - 1)):
+        if line + 1 not in reverse_mapping or line in reverse_mapping:
             continue
 
         maybe_old_line = reverse_mapping[line + 1] - 1
 
-        if maybe_old_line in mapping:
+        if maybe_old_line < 0 or maybe_old_line in mapping:
             continue
 
-        if old[maybe_old_line] == symbol:
+        if old[maybe_old_line] == new[line]:
             mapping[maybe_old_line] = line
             reverse_mapping[line] = maybe_old_line
 
-    return mapping, reverse_mapping
\ No newline at end of file
+    return mapping, reverse_mapping
+
+
+def vectorized_diff(old : List[Any], new : List[Any]):
+    """Same result as `diff`, computed over NumPy arrays of interned symbol ids. 
+    """
+
+    symbols = {}
+    old_ids = np.fromiter((symbols.setdefault(symbol, len(symbols)) for symbol in old), dtype=np.int64, count=len(old))
+    new_ids = np.fromiter((symbols.setdefault(symbol, len(symbols)) for symbol in new), dtype=np.int64, count=len(new))
+
+    # Passes 1 and 2
+    old_count = np.bincount(old_ids, minlength=len(symbols))
+    new_count = np.bincount(new_ids, minlength=len(symbols))
+    olno = np.zeros(len(symbols), dtype=np.int64)
+    olno[old_ids] = np.arange(len(old))
+
+    new_to_old = np.full(len(new), -1, dtype=np.int64)
+    old_to_new = np.full(len(old), -1, dtype=np.int64)
+
+    # Pass 3
+    lines = np.flatnonzero((old_count[new_ids] == 1) & (new_count[new_ids] == 1))
+    new_to_old[lines] = olno[new_ids[lines]]
+    old_to_new[new_to_old[lines]] = lines
+
+    # Passes 4 and 5
+    _extend_matches(old_ids, new_ids, old_to_new, new_to_old, 1)
+    _extend_matches(old_ids, new_ids, old_to_new, new_to_old, -1)
+
+    lines = np.flatnonzero(new_to_old >= 0)
+    old_lines = new_to_old[lines].tolist()
+    lines = lines.tolist()
+
+    return dict(zip(old_lines, lines)), dict(zip(lines, old_lines))
+
+
+def _extend_matches(old_ids, new_ids, old_to_new, new_to_old, step):
+    # every matched line followed (in `step` direction) by an unmatched one starts a chain
+    # that extends along its diagonal while the symbols of both sides are equal
+    anchors = np.flatnonzero(new_to_old >= 0)
+    anchors = anchors[(anchors + step >= 0) & (anchors + step < len(new_ids))]
+    anchors = anchors[new_to_old[anchors + step] < 0]
+
+    lengths = np.zeros(len(anchors), dtype=np.int64)
+    active = np.arange(len(anchors))
+    distance = 1
+    while len(active):
+        new_lines = anchors[active] + step * distance
+        old_lines = new_to_old[anchors[active]] + step * distance
+
+        valid = (new_lines >= 0) & (new_lines < len(new_ids)) & (old_lines >= 0) & (old_lines < len(old_ids))
+        valid[valid] = ((new_to_old[new_lines[valid]] < 0)
+                        & (old_to_new[old_lines[valid]] < 0)
+                        & (old_ids[old_lines[valid]] == new_ids[new_lines[valid]]))
+
+        lengths[active[~valid]] = distance - 1
+        active = active[valid]
+        distance += 1
+
+    # chains never share new lines, but may compete for old lines: the chain the sequential
+    # pass would reach first wins, and later chains stop right before a taken old line
+    candidates = np.flatnonzero(lengths)
+    if step < 0:
+        candidates = candidates[::-1]
+
+    taken_starts = []
+    taken_ends = []
+    for chain in candidates.tolist():
+        anchor = int(anchors[chain])
+        origin = int(new_to_old[anchor])
+        length = int(lengths[chain])
+
+        if step > 0:
+            first, last = origin + 1, origin + length
+            i = bisect.bisect_right(taken_starts, first)
+            if i and taken_ends[i - 1] >= first:
+                continue
+            if i < len(taken_starts) and taken_starts[i] <= last:
+                last = taken_starts[i] - 1
+            length = last - first + 1
+        else:
+            first, last = origin - length, origin - 1
+            i = bisect.bisect_right(taken_starts, last)
+            if i and taken_ends[i - 1] >= last:
+                continue
+            if i and taken_ends[i - 1] >= first:
+                first = taken_ends[i - 1] + 1
+            length = last - first + 1
+
+        taken_starts.insert(i, first)
+        taken_ends.insert(i, last)
+
+        new_lines = anchor + step * np.arange(1, length + 1)
+        old_lines = origin + step * np.arange(1, length + 1)
+        new_to_old[new_lines] = old_lines
+        old_to_new[old_lines] = new_lines
+
+
+default_diff = vectorized_diff if np is not None else diff
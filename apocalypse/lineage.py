@@ -0,0 +1,151 @@
+import sqlite3
+from itertools import groupby
+from .version import StrictVersion
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+
+# Every chain of mapped classes across consecutive versions is a lineage with a stable id, 
+# a class mapped to no neighbor being a lineage of its own version alone.
+# Rows are keyed by a sortable version key, so the versions of a lineage can be range-updated
+# when a version gets inserted between two others.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS versions (version TEXT PRIMARY KEY, key TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS lineages (id INTEGER PRIMARY KEY, first TEXT, last TEXT);
+CREATE TABLE IF NOT EXISTS names (
+    lineage INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    version TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (version, name)
+);
+CREATE INDEX IF NOT EXISTS names_by_lineage ON names (lineage, key);
+'''
+
+
+def version_key(version: str) -> str:
+    parsed = StrictVersion(version)
+    major, minor, patch = parsed.version
+    if parsed.prerelease:
+        letter, number = parsed.prerelease
+        return f'{major:010}{minor:010}{patch:010}0{letter}{number:010}'
+    return f'{major:010}{minor:010}{patch:010}1'
+
+
+class LineageIndex:
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def versions(self):
+        return [row[0] for row in self._connection.execute('SELECT version FROM versions ORDER BY key')]
+
+    def until(self, version: str, name: str) -> str:
+        return self._bound(version, name, 'last')
+
+    def since(self, version: str, name: str) -> str:
+        return self._bound(version, name, 'first')
+
+    def _bound(self, version, name, column):
+        row = self._connection.execute(
+            f'SELECT lineages.{column} FROM names JOIN lineages ON names.lineage = lineages.id '
+            'WHERE names.version = ? AND names.name = ?', (version, name)).fetchone()
+        # classes without any mapping to a neighbor only exist in their own version
+        return row[0] if row else version
+
+    def lifetimes(self) -> Iterator[Tuple[str, str, Dict[str, str]]]:
+        """Yield the first version, last version and names per version of every lineage.
+        """
+        rows = self._connection.execute(
+            'SELECT lineages.id, lineages.first, lineages.last, names.version, names.name '
+            'FROM names JOIN lineages ON names.lineage = lineages.id ORDER BY names.lineage, names.key')
+        for (_, first, last), lineage_rows in groupby(rows, key=lambda row: row[:3]):
+            yield first, last, {version: name for *_, version, name in lineage_rows}
+
+    def insert_version(self, version: str, previous_version: Optional[str], next_version: Optional[str],
+                       map_from_previous: Optional[Dict[str, str]], map_to_next: Optional[Dict[str, str]],
+                       names: Iterable[str] = ()):
+        """Insert `version` between its neighbors, given the forward maps that link it to them, 
+        and the `names` of its classes, which all get a lineage, mapped to a neighbor or not.
+        """
+        with self._connection:
+            affected = set()
+            key = version_key(version)
+
+            # a replaced version first unlinks its lineages
+            for lineage, in self._connection.execute(
+                    'SELECT lineage FROM names WHERE version = ?', (version,)).fetchall():
+                self._connection.execute('DELETE FROM names WHERE lineage = ? AND version = ?', (lineage, version))
+                affected.add(lineage)
+                affected.add(self._split(lineage, key))
+
+            # lineages going straight from the previous to the next version are cut in two
+            if previous_version and next_version:
+                for lineage, in self._connection.execute(
+                        'SELECT a.lineage FROM names a JOIN names b ON a.lineage = b.lineage '
+                        'WHERE a.version = ? AND b.version = ?', (previous_version, next_version)).fetchall():
+                    affected.add(lineage)
+                    affected.add(self._split(lineage, version_key(next_version)))
+
+            self._connection.execute('INSERT OR REPLACE INTO versions VALUES (?, ?)', (version, key))
+
+            lineages = {}
+            for previous_name, name in (map_from_previous or {}).items():
+                lineage = self._lineage_of(previous_version, previous_name)
+                self._add(lineage, version, name)
+                lineages[name] = lineage
+                affected.add(lineage)
+
+            for name, next_name in (map_to_next or {}).items():
+                lineage = lineages.get(name)
+                if lineage is None:
+                    lineage = self._lineage_of(version, name)
+                    affected.add(lineage)
+
+                next_lineage = self._find(next_version, next_name)
+                if next_lineage is None:
+                    self._add(lineage, next_version, next_name)
+                else:
+                    self._connection.execute('UPDATE names SET lineage = ? WHERE lineage = ?', (lineage, next_lineage))
+                    self._connection.execute('DELETE FROM lineages WHERE id = ?', (next_lineage,))
+                    affected.discard(next_lineage)
+
+            for name in names:
+                self._lineage_of(version, name)
+
+            self._update_bounds(affected)
+
+    def _find(self, version, name) -> Optional[int]:
+        row = self._connection.execute(
+            'SELECT lineage FROM names WHERE version = ? AND name = ?', (version, name)).fetchone()
+        return row[0] if row else None
+
+    def _lineage_of(self, version, name) -> int:
+        lineage = self._find(version, name)
+        if lineage is None:
+            lineage = self._connection.execute('INSERT INTO lineages (first, last) VALUES (?, ?)', (version, version)).lastrowid
+            self._add(lineage, version, name)
+        return lineage
+
+    def _add(self, lineage, version, name):
+        self._connection.execute('INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?)', (lineage, version_key(version), version, name))
+
+    def _split(self, lineage, key) -> int:
+        new_lineage = self._connection.execute('INSERT INTO lineages (first, last) VALUES (NULL, NULL)').lastrowid
+        self._connection.execute('UPDATE names SET lineage = ? WHERE lineage = ? AND key >= ?', (new_lineage, lineage, key))
+        return new_lineage
+
+    def _update_bounds(self, lineages):
+        for lineage in lineages:
+            first = self._connection.execute(
+                'SELECT version FROM names WHERE lineage = ? ORDER BY key LIMIT 1', (lineage,)).fetchone()
+            last = self._connection.execute(
+                'SELECT version FROM names WHERE lineage = ? ORDER BY key DESC LIMIT 1', (lineage,)).fetchone()
+            if first is None:
+                self._connection.execute('DELETE FROM lineages WHERE id = ?', (lineage,))
+            else:
+                self._connection.execute('UPDATE lineages SET first = ?, last = ? WHERE id = ?', (first[0], last[0], lineage))
@@ -0,0 +1,87 @@
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+_active_profile = ContextVar('profile', default=None)
+
+
+class Profile:
+    """Collects timings and per-stage statistics of the diffs run while it is active.
+
+        with Profile() as profile:
+            APKDiffer().diff(old_apk_path, new_apk_path)
+        report = profile.report()
+    """
+
+    def __init__(self):
+        self.sections = defaultdict(float)
+        self.diffs = []
+        self.total = None
+        self._start = None
+        self._token = None
+
+    def __enter__(self):
+        self._token = _active_profile.set(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.total = time.perf_counter() - self._start
+        _active_profile.reset(self._token)
+
+    def report(self):
+        return {
+            'total': self.total,
+            'sections': dict(self.sections),
+            'diffs': self.diffs,
+            'peak_rss': peak_rss(),
+        }
+
+
+def active():
+    return _active_profile.get()
+
+@contextmanager
+def section(name):
+    """Add the time spent in the block to the `name` section of the active profile, if any.
+    """
+    profile = _active_profile.get()
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.sections[name] += time.perf_counter() - start
+
+def record_diff(**diff):
+    """Start the record of a classes diff, which the following stages get added to.
+    """
+    profile = _active_profile.get()
+    if profile is not None:
+        profile.diffs.append(dict(diff, stages=[]))
+
+def record_stage(**stage):
+    profile = _active_profile.get()
+    if profile is not None and profile.diffs:
+        profile.diffs[-1]['stages'].append(stage)
+
+def peak_rss():
+    """Peak resident set size in bytes of this process and of its waited-for children.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
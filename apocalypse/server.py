@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import socket
+import threading
+from collections import OrderedDict
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import apocalypse.timeline as timeline
+from apocalypse.features import ClassFeatures
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_ADDRESS = 'http://127.0.0.1:8765'
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by the estimated memory size of its values.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        self._max_size = max_size
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        if size > self._max_size:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._size += size
+
+            while self._size > self._max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+
+def estimate_size(value) -> int:
+    # rough per-entry costs of the Python objects behind maps and feature lists, by dex file
+    if isinstance(value, dict):
+        return 64 + 200 * len(value)
+    if isinstance(value, list):
+        return 64 + sum(300 + 250 * len(item.methods) if isinstance(item, ClassFeatures) else estimate_size(item) for item in value)
+    if isinstance(value, tuple):
+        return 64 + sum(estimate_size(item) for item in value)
+    return 100
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        try:
+            endpoint = self.server.endpoints[url.path.strip('/')]
+        except KeyError:
+            self._reply(404, {'error': f'Unknown endpoint {url.path}'})
+            return
+
+        try:
+            result = endpoint(**params)
+        except TypeError as e:
+            self._reply(400, {'error': str(e)})
+        except Exception as e:
+            logger.exception(f'{url.path} failed')
+            self._reply(500, {'error': str(e)})
+        else:
+            self._reply(200, {'result': result})
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+    def address_string(self):
+        # unix socket peers have no (host, port) pair
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+
+class _UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        self.socket.bind(self.server_address)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class Server:
+    """Answers timeline queries while keeping loaded maps and parsed features in an LRU cache.
+    """
+
+    def __init__(self, cache_size: int = DEFAULT_CACHE_SIZE):
+        self._cache = LRUCache(cache_size)
+        timeline.set_cache(self._cache)
+
+    def endpoints(self):
+        return {
+            'versions': self.versions,
+            'map': self.map,
+            'until': self.until,
+            'since': self.since,
+            'diff': self.diff,
+        }
+
+    def versions(self):
+        return timeline.versions()
+
+    def map(self, from_, to, package=None):
+        result = timeline.map(from_, to, package)
+        return json.loads(result) if result is not None else None
+
+    def until(self, version, class_):
+        return timeline.until(version, class_)
+
+    def since(self, version, class_):
+        return timeline.since(version, class_)
+
+    def diff(self, from_, to, package=None, fuzzy=None):
+        from apocalypse.apk_differ import APKDiffer
+        from apocalypse.fuzzy import FuzzyMatcher
+
+        # as in a local diff, the classes of identical dex files map to themselves
+        differ = APKDiffer(fuzzy_matcher=FuzzyMatcher() if fuzzy else None)
+        mapping, _ = differ.diff_dexs(self._file_dexs(from_), self._file_dexs(to))
+        return dict(timeline.filter_package(mapping.items(), package))
+
+    def _file_dexs(self, path):
+        path = Path(path)
+        stat = path.stat()
+        key = ('file', str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+
+        dexs = self._cache.get(key)
+        if dexs is None:
+            from apocalypse.dex_differ import DexDiffer
+            from apocalypse.apk_differ import APKDiffer
+
+            if path.suffix == '.dex':
+                dexs = DexDiffer().extract_dexs(str(path))
+            elif path.suffix == '.apk':
+                dexs = APKDiffer().extract_dexs(str(path))
+            else:
+                raise ValueError(f"Invalid file extension '{path.suffix}'")
+            self._cache.put(key, dexs)
+        return dexs
+
+    def serve_forever(self, address: str = DEFAULT_ADDRESS):
+        if address.startswith('unix:'):
+            socket_path = address[len('unix:'):]
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            http_server = _UnixHTTPServer(socket_path, _Handler)
+        else:
+            url = urlparse(address)
+            http_server = ThreadingHTTPServer((url.hostname, url.port), _Handler)
+
+        http_server.endpoints = self.endpoints()
+        logger.info(f'serving timeline on {address}')
+        try:
+            http_server.serve_forever()
+        finally:
+            http_server.server_close()
+            if address.startswith('unix:'):
+                os.unlink(address[len('unix:'):])
+
+
+class _UnixHTTPConnection(HTTPConnection):
+
+    def __init__(self, socket_path):
+        super().__init__('localhost')
+        self._socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._socket_path)
+
+
+class Client:
+    """Thin client forwarding queries to a running `Server`.
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS):
+        self._address = address
+
+    def _connection(self):
+        if self._address.startswith('unix:'):
+            return _UnixHTTPConnection(self._address[len('unix:'):])
+        url = urlparse(self._address)
+        return HTTPConnection(url.hostname, url.port)
+
+    def request(self, endpoint, **params):
+        connection = self._connection()
+        try:
+            connection.request('GET', f'/{endpoint}?{urlencode(params)}')
+            response = connection.getresponse()
+            body = json.loads(response.read())
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            raise RuntimeError(body.get('error', f'Server replied with status {response.status}'))
+        return body['result']
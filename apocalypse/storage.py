@@ -0,0 +1,353 @@
+import json
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from hashlib import blake2b
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # without flock, locks only exclude the threads of the process
+    fcntl = None
+
+
+# Binary map files share one table of interned class names per timeline.
+#
+# names:        b'APNT' | count: u32 | offsets: u64[count + 1] | sorted ids: u32[count] | utf-8 blob
+# {a}-{b}.bin:  b'APDM' | changed: u32 | bitmap size: u32 | keys: u32[changed] | values: u32[changed] | bitmap
+#
+# Keys are sorted so lookups binary search the memory-mapped arrays. Classes that keep their
+# name are not stored as pairs but as a set bit in the identity bitmap, indexed by name id.
+
+NAMES_MAGIC = b'APNT'
+MAP_MAGIC = b'APDM'
+BINARY_SUFFIX = '.bin'
+TMP_SUFFIX = '.tmp'
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Open a temporary file next to `path`, which replaces it once the block completes without error.
+
+    Readers see either the previous or the new content, and concurrent writers each get their own temporary file.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}{TMP_SUFFIX}')
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
+
+
+
+class FileLock:
+    """Exclusive lock on a file, held across processes through flock and reentrant within a process.
+    """
+
+    def __init__(self, path):
+        self._path = Path(path)
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self, blocking=True) -> bool:
+        """Take the lock, or with `blocking` unset return False right away when someone else holds it. 
+        """
+        if not self._lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            try:
+                self._file = open(self._path, 'a')
+                if fcntl is not None:
+                    fcntl.flock(self._file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BaseException as e:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._lock.release()
+                if isinstance(e, BlockingIOError):
+                    return False
+                raise
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            # closing the file releases the flock
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+
+class NameTable:
+
+    def __init__(self, path):
+        self._path = Path(path)
+        self._mmap = None
+        self._ids = None
+        self._open()
+
+    def _open(self):
+        # a previous mapping is left to the GC, as views into it may still be alive
+        self._ids = None
+
+        if not self._path.is_file():
+            self._mmap = None
+            self._count = 0
+            return
+
+        with open(self._path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._count = struct.unpack_from('<4sI', self._mmap)
+        if magic != NAMES_MAGIC:
+            raise ValueError(f'{self._path} is not a name table')
+
+        view = memoryview(self._mmap)
+        offsets_end = 8 + 8 * (self._count + 1)
+        self._offsets = view[8:offsets_end].cast('Q')
+        self._sorted_ids = view[offsets_end:offsets_end + 4 * self._count].cast('I')
+        self._blob_start = offsets_end + 4 * self._count
+
+    def __len__(self):
+        return self._count
+
+    def name(self, id_: int) -> str:
+        start = self._blob_start + self._offsets[id_]
+        end = self._blob_start + self._offsets[id_ + 1]
+        return self._mmap[start:end].decode()
+
+    def _name_bytes(self, id_: int) -> bytes:
+        return self._mmap[self._blob_start + self._offsets[id_]:self._blob_start + self._offsets[id_ + 1]]
+
+    def id(self, name: str) -> Optional[int]:
+        if self._ids is not None:
+            return self._ids.get(name)
+
+        target = name.encode()
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            candidate = self._name_bytes(self._sorted_ids[middle])
+            if candidate < target:
+                low = middle + 1
+            elif candidate > target:
+                high = middle
+            else:
+                return self._sorted_ids[middle]
+        return None
+
+    def names(self):
+        return [self.name(id_) for id_ in range(self._count)]
+
+    def intern(self, names) -> Dict[str, int]:
+        """Return the ids of `names`, appending the ones not yet in the table.
+        """
+        if self._ids is None:
+            self._ids = {name: id_ for id_, name in enumerate(self.names())}
+
+        missing = sorted(set(name for name in names if name not in self._ids))
+        if missing:
+            all_names = self.names() + missing
+            self._write(all_names)
+            self._open()
+            self._ids = {name: id_ for id_, name in enumerate(all_names)}
+
+        return self._ids
+
+    def _write(self, names):
+        encoded = [name.encode() for name in names]
+
+        offsets = [0]
+        for name in encoded:
+            offsets.append(offsets[-1] + len(name))
+        sorted_ids = sorted(range(len(encoded)), key=encoded.__getitem__)
+
+        with atomic_write(self._path, 'wb') as f:
+            f.write(struct.pack('<4sI', NAMES_MAGIC, len(encoded)))
+            f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+            f.write(struct.pack(f'<{len(sorted_ids)}I', *sorted_ids))
+            f.write(b''.join(encoded))
+
+
+class BinaryMap:
+
+    def __init__(self, path, names: NameTable):
+        self._names = names
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, bitmap_size = struct.unpack_from('<4sII', self._mmap)
+        if magic != MAP_MAGIC:
+            raise ValueError(f'{path} is not a binary map')
+
+        view = memoryview(self._mmap)
+        self._keys = view[12:12 + 4 * count].cast('I')
+        self._values = view[12 + 4 * count:12 + 8 * count].cast('I')
+        self._bitmap = view[12 + 8 * count:12 + 8 * count + bitmap_size]
+
+    def _is_identity(self, id_: int) -> bool:
+        return id_ // 8 < len(self._bitmap) and bool(self._bitmap[id_ // 8] & (1 << (id_ % 8)))
+
+    def get(self, name: str) -> Optional[str]:
+        id_ = self._names.id(name)
+        if id_ is None:
+            return None
+        if self._is_identity(id_):
+            return name
+
+        low, high = 0, len(self._keys)
+        while low < high:
+            middle = (low + high) // 2
+            if self._keys[middle] < id_:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self._keys) and self._keys[low] == id_:
+            return self._names.name(self._values[low])
+        return None
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        for i, byte in enumerate(self._bitmap):
+            for bit in range(8):
+                if byte & (1 << bit):
+                    name = self._names.name(8 * i + bit)
+                    yield name, name
+        for key, value in zip(self._keys, self._values):
+            yield self._names.name(key), self._names.name(value)
+
+    @staticmethod
+    def write(path, mapping: Dict[str, str], names: NameTable):
+        ids = names.intern(list(mapping.keys()) + list(mapping.values()))
+
+        changed = sorted((ids[key], ids[value]) for key, value in mapping.items() if key != value)
+        identities = [ids[key] for key, value in mapping.items() if key == value]
+
+        bitmap = bytearray((max(identities) // 8 + 1) if identities else 0)
+        for id_ in identities:
+            bitmap[id_ // 8] |= 1 << (id_ % 8)
+
+        with atomic_write(path, 'wb') as f:
+            f.write(struct.pack('<4sII', MAP_MAGIC, len(changed), len(bitmap)))
+            f.write(struct.pack(f'<{len(changed)}I', *(key for key, _ in changed)))
+            f.write(struct.pack(f'<{len(changed)}I', *(value for _, value in changed)))
+            f.write(bitmap)
+
+
+class JSONMapStore:
+    """Maps stored as one JSON dict per version pair.
+    """
+
+    def __init__(self, folder):
+        self._folder = Path(folder)
+
+    def _path(self, version_a, version_b):
+        return self._folder / f'{version_a}-{version_b}'
+
+    def exists(self, version_a, version_b):
+        return self._path(version_a, version_b).is_file()
+
+    def stamp(self, version_a, version_b):
+        stat = self._path(version_a, version_b).stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self, version_a, version_b) -> Dict[str, str]:
+        with open(self._path(version_a, version_b)) as f:
+            return json.load(f)
+
+    def lookup(self, version_a, version_b, name) -> Optional[str]:
+        return self.read(version_a, version_b).get(name)
+
+    def write(self, version_a, version_b, mapping):
+        self._folder.mkdir(exist_ok=True)
+        with atomic_write(self._path(version_a, version_b)) as f:
+            json.dump(mapping, f)
+
+    def remove(self, version_a, version_b):
+        self._path(version_a, version_b).unlink(missing_ok=True)
+
+    def pairs(self):
+        if not self._folder.is_dir():
+            return []
+        return [tuple(path.name.split('-')) for path in self._folder.iterdir()
+                if '-' in path.name and path.suffix not in (BINARY_SUFFIX, TMP_SUFFIX)]
+
+
+class BinaryMapStore:
+    """Maps stored as memory-mapped sorted id arrays over a shared `NameTable`.
+    """
+
+    def __init__(self, folder, names: NameTable):
+        self._folder = Path(folder)
+        self._names = names
+
+    def _path(self, version_a, version_b):
+        return self._folder / f'{version_a}-{version_b}{BINARY_SUFFIX}'
+
+    def exists(self, version_a, version_b):
+        return self._path(version_a, version_b).is_file()
+
+    def stamp(self, version_a, version_b):
+        stat = self._path(version_a, version_b).stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self, version_a, version_b) -> Dict[str, str]:
+        return dict(BinaryMap(self._path(version_a, version_b), self._names).items())
+
+    def lookup(self, version_a, version_b, name) -> Optional[str]:
+        return BinaryMap(self._path(version_a, version_b), self._names).get(name)
+
+    def write(self, version_a, version_b, mapping):
+        self._folder.mkdir(exist_ok=True)
+        BinaryMap.write(self._path(version_a, version_b), mapping, self._names)
+
+    def remove(self, version_a, version_b):
+        self._path(version_a, version_b).unlink(missing_ok=True)
+
+    def pairs(self):
+        if not self._folder.is_dir():
+            return []
+        return [tuple(path.stem.split('-')) for path in self._folder.iterdir()
+                if path.suffix == BINARY_SUFFIX]
+
+
+class BlobStore:
+    """Files stored once each, under the digest of their content.
+    """
+
+    def __init__(self, folder):
+        self._folder = Path(folder)
+
+    def path(self, digest: str) -> Path:
+        return self._folder / digest[:2] / digest
+
+    def put(self, data: bytes) -> str:
+        digest = blake2b(data, digest_size=16).hexdigest()
+
+        path = self.path(digest)
+        if not path.is_file():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_write(path, 'wb') as f:
+                f.write(data)
+
+        return digest
+
+    def read(self, digest: str) -> bytes:
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
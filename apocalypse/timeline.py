@@ -1,23 +1,76 @@
 from pathlib import Path
 import shutil
-from distutils.version import StrictVersion
+import itertools
+from hashlib import blake2b
+from apocalypse.version import StrictVersion
 
 import logging
 
+import os
 import json
+import functools
+from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 
-from apocalypse.dex_differ import DexDiffer
-from apocalypse.apk_differ import APKDiffer
-
+from apocalypse.features import save_features, load_features
+from apocalypse.storage import NameTable, JSONMapStore, BinaryMapStore, BlobStore, FileLock, atomic_write, TMP_SUFFIX
+from apocalypse.lineage import LineageIndex
+from apocalypse import profiling
 
 
 CONFIG_FILE = 'timeline'
 SOURCES_FOLDER = 'sources'
 DIFF_FOLDER = 'diffs'
+FEATURES_FOLDER = 'features'
+DEXS_FOLDER = 'dexs'
+BLOBS_FOLDER = 'blobs'
+DEX_FEATURES_FOLDER = 'dex-features'
+SKIPS_FOLDER = 'skips'
+RANGE_CACHE_FOLDER = 'cache'
+NAMES_FILE = 'names'
+LINEAGE_FILE = 'lineage.db'
+CHECKPOINT_FILE = 'insert-many.checkpoint'
+LOCK_FILE = 'timeline.lock'
+LOCKS_FOLDER = 'locks'
+GENERATION_FILE = 'generation'
+REBUILD_CHECKPOINT_FILE = 'rebuild.checkpoint'
+
+STORAGE_FORMATS = ('json', 'binary')
+
+# 'files' keeps a copy of every source file, 'blobs' stores the entries of sources once by content,
+# each version being a manifest of (entry name, blob digest)
+SOURCE_LAYOUTS = ('files', 'blobs')
+
+MAX_SKIP_LEVEL = 32
+
+# default bound in bytes of the cached range query results, see the 'range_cache_size' config
+RANGE_CACHE_SIZE = 256 * 1024 * 1024
 
 
 logger = logging.getLogger(__name__)
 
+# optional cache of loaded maps and features, see set_cache
+_cache = None
+
+# locks of this process, by absolute path, so that they are reentrant across calls
+_locks = {}
+
+
+def _locked(function):
+    # runs a whole-timeline operation under the timeline lock, as one change of the timeline
+    @functools.wraps(function)
+    def locked(*args, **kwargs):
+        if not in_timeline():
+            return function(*args, **kwargs)
+
+        with _timeline_lock():
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _bump_generation()
+
+    return locked
 
 def in_timeline():
     return Path(SOURCES_FOLDER).is_dir() and Path(DIFF_FOLDER).is_dir()
@@ -30,22 +83,38 @@ def get_config(key, default=None):
         return default
 
 def put_config(key, value):
-    with open(Path(CONFIG_FILE), 'w') as f:
+    with open(Path(CONFIG_FILE)) as f:
         config = json.load(f)
-        config[key] = value
+    config[key] = value
+    with atomic_write(Path(CONFIG_FILE)) as f:
         json.dump(config, f)
 
-def init(name, format):
+def init(name, format, storage='json', range_cache_size=RANGE_CACHE_SIZE, sources='files', memory_budget=None):
     root = Path(name)
     root.mkdir()
     (root / SOURCES_FOLDER).mkdir()
     (root / DIFF_FOLDER).mkdir()
+    (root / FEATURES_FOLDER).mkdir()
+    (root / SKIPS_FOLDER).mkdir()
     with open(root / CONFIG_FILE, 'w') as f:
         json.dump({
-            'format': format
+            'format': format,
+            'storage': storage,
+            'range_cache_size': range_cache_size,
+            'sources': sources,
+            'memory_budget': memory_budget
         }, f)
 
-def insert_version(version, file_path, force=False, compute_maps=True):
+def insert_version(version, file_path, force=False, compute_maps=True, encoding_workers=1, memory_budget=None):
+    """Insert a version from a file, diffing it against its neighbors. 
+
+    Many processes may insert into the same timeline. The diffs run unlocked against the current 
+    neighbors, and the version is committed under the timeline lock if they are still the neighbors, 
+    otherwise the pairs that changed are diffed again. 
+
+    `memory_budget` bounds the bytes the dex files parsed at once may take, see `APKDiffer`, 
+    and defaults to the one of the timeline config. 
+    """
     if not in_timeline():
         logger.error('Not in a timeline. ')
         return
@@ -54,81 +123,255 @@ def insert_version(version, file_path, force=False, compute_maps=True):
         logger.error(f"'{version}' is not a valid version")
         return
 
-    if (Path(SOURCES_FOLDER) / version).is_file():
-        if not force:
+    with _version_lock(version):
+        if (Path(SOURCES_FOLDER) / version).is_file() and not force:
             logger.error(f'Version {version} already exists. \nUse --force to override. ')
             return
-        else:
-            (Path(SOURCES_FOLDER) / version).unlink()
 
-    shutil.copy(file_path, Path(SOURCES_FOLDER) / version)
+        # blobs are content addressed, so storing them ahead of the commit is harmless
+        manifest = _store_blobs(file_path)
+        dexs = _source_dexs(file_path, manifest, _memory_budget(memory_budget))
 
-    if compute_maps:
-        previous_version = None
-        next_version = None
-        for some_version in versions():
-            if StrictVersion(some_version) > StrictVersion(version):
-                next_version = some_version
-                break
-            elif StrictVersion(version) > StrictVersion(some_version):
-                previous_version = some_version
+        maps = {}
+        while True:
+            pairs = _neighbor_pairs(version) if compute_maps else {}
+            for pair, stamp in pairs.items():
+                if (pair, stamp) not in maps:
+                    old_dexs = dexs if pair[0] == version else _load_dexs(pair[0])
+                    new_dexs = dexs if pair[1] == version else _load_dexs(pair[1])
+                    maps[pair, stamp] = _diff_dexs(old_dexs, new_dexs, encoding_workers)
+
+            with _timeline_lock():
+                # insert-many doesn't take version locks, so the version may have been inserted meanwhile
+                if (Path(SOURCES_FOLDER) / version).is_file() and not force:
+                    logger.error(f'Version {version} already exists. \nUse --force to override. ')
+                    return
 
-        if previous_version:
-            _compute_maps(previous_version, version)
-        if next_version:
-            _compute_maps(version, next_version)
+                if compute_maps and _neighbor_pairs(version) != pairs:
+                    logger.info(f'Neighbors of {version} changed, diffing again')
+                    continue
 
-def map(version_from, version_to):
+                _invalidate_skip_maps(version)
+                _invalidate_range_cache(version)
+
+                store = _map_store()
+                for (version_a, version_b), stamp in pairs.items():
+                    map_from_previous, map_to_previous = maps[(version_a, version_b), stamp]
+                    store.write(version_a, version_b, map_from_previous)
+                    store.write(version_b, version_a, map_to_previous)
+
+                # the source comes last, as it makes the version visible
+                _save_snapshot(version, dexs)
+                _write_source(file_path, version, manifest)
+
+                if compute_maps:
+                    _update_skip_maps(version)
+                    _update_lineage_index(version)
+                _bump_generation()
+                return
+
+@_locked
+def insert_versions(entries, force=False, workers=None, progress=None, memory_budget=None):
+    """Insert many (version, file path) entries at once, diffing the final adjacent pairs in parallel. 
+
+    Progress is kept in a checkpoint file, so an interrupted call resumes when repeated with the same entries. 
+    Versions are only extracted at once while their estimated parsing memory fits in `memory_budget`, 
+    which defaults to the one of the timeline config. 
+    """
     if not in_timeline():
         logger.error('Not in a timeline. ')
         return
 
-    if not _is_version_valid(version_from):
-        logger.error(f"'{version_from}' is not a valid version")
+    entries = sorted(((str(version), str(file_path)) for version, file_path in entries), key=lambda entry: StrictVersion(entry[0]))
+    new_versions = [version for version, _ in entries]
+
+    for version in new_versions:
+        if not _is_version_valid(version):
+            logger.error(f"'{version}' is not a valid version")
+            return
+    if len(set(new_versions)) != len(new_versions):
+        logger.error('Versions must be unique')
         return
-    if not _is_version_valid(version_to):
-        logger.error(f"'{version_to}' is not a valid version")
+
+    checkpoint = _read_checkpoint()
+    if checkpoint is not None and checkpoint['entries'] != [list(entry) for entry in entries]:
+        logger.error(f'Another insertion was interrupted. \nRepeat it or delete {CHECKPOINT_FILE} to discard it. ')
         return
+    # checked under the timeline lock, so that no single insert can commit one of them meanwhile, 
+    # and again on resume, as one may have been inserted while the insertion was interrupted
+    if not force:
+        for version in new_versions:
+            if (Path(SOURCES_FOLDER) / version).is_file() and (checkpoint is None or version not in checkpoint['copied']):
+                logger.error(f'Version {version} already exists. \nUse --force to override. ')
+                return
+    if checkpoint is None:
+        checkpoint = {'entries': [list(entry) for entry in entries], 'copied': [], 'done': []}
+        _write_checkpoint(checkpoint)
 
-    if version_from == version_to:
-        logger.error(f"Can't map version {version_from} to itself")
+    for version, file_path in entries:
+        if version in checkpoint['copied']:
+            continue
+        (Path(FEATURES_FOLDER) / version).unlink(missing_ok=True)
+        (Path(DEXS_FOLDER) / version).unlink(missing_ok=True)
+        _write_source(file_path, version, _store_blobs(file_path))
+        _invalidate_skip_maps(version)
+        _invalidate_range_cache(version)
+        checkpoint['copied'].append(version)
+        _write_checkpoint(checkpoint)
+
+    all_versions = versions()
+    pairs = []
+    for version in new_versions:
+        position = all_versions.index(version)
+        if position > 0:
+            pairs.append((all_versions[position - 1], version))
+        if position + 1 < len(all_versions):
+            pairs.append((version, all_versions[position + 1]))
+    pairs = [pair for pair in dict.fromkeys(pairs) if list(pair) not in checkpoint['done']]
+    total = len(checkpoint['done']) + len(pairs)
+
+    with ProcessPoolExecutor(workers) as executor:
+        # features are extracted once per version before any pair needs them
+        _extract_all_features(executor, new_versions, _memory_budget(memory_budget))
+
+        futures = {executor.submit(_diff_versions, *pair): pair for pair in pairs}
+        store = _map_store()
+        for future in as_completed(futures):
+            version_a, version_b = futures[future]
+            map_from_previous, map_to_previous = future.result()
+            store.write(version_a, version_b, map_from_previous)
+            store.write(version_b, version_a, map_to_previous)
+
+            checkpoint['done'].append([version_a, version_b])
+            _write_checkpoint(checkpoint)
+            if progress:
+                progress(len(checkpoint['done']), total)
+
+    for version in new_versions:
+        _update_skip_maps(version)
+    _rebuild_lineage_index()
+
+    Path(CHECKPOINT_FILE).unlink()
+
+@_locked
+def rebuild(first_version=None, last_version=None, workers=None, progress=None, memory_budget=None):
+    """Recompute the maps between adjacent versions, e.g. after a change of encoder or filter. 
+
+    Only the pairs between `first_version` and `last_version` are, when given. Consecutive pairs are 
+    diffed in chains, so a worker loads the features of a version once for both of its pairs. 
+    An interrupted rebuild resumes when repeated with the same range. Missing features are 
+    extracted within `memory_budget` as by `insert_versions`. 
+    """
+    if not in_timeline():
+        logger.error('Not in a timeline. ')
         return
 
-    if not (Path(SOURCES_FOLDER) / version_from).is_file():
-        logger.error("Version {version_from} doesn't exist. ")
+    for version in (first_version, last_version):
+        if version is not None and not _is_version_valid(version):
+            logger.error(f"'{version}' is not a valid version")
+            return
+
+    range_versions = [version for version in versions()
+                      if (first_version is None or StrictVersion(version) >= StrictVersion(first_version))
+                      and (last_version is None or StrictVersion(version) <= StrictVersion(last_version))]
+    pairs = list(zip(range_versions, range_versions[1:]))
+
+    checkpoint = _read_checkpoint(REBUILD_CHECKPOINT_FILE)
+    if checkpoint is not None and checkpoint['range'] != [first_version, last_version]:
+        logger.error(f'Another rebuild was interrupted. \nRepeat it or delete {REBUILD_CHECKPOINT_FILE} to discard it. ')
         return
-    if not (Path(SOURCES_FOLDER) / version_to).is_file():
-        logger.error(f"Version {version_to} doesn't exist. ")
+    if checkpoint is None:
+        checkpoint = {'range': [first_version, last_version], 'done': []}
+        _write_checkpoint(checkpoint, REBUILD_CHECKPOINT_FILE)
+
+    remaining_pairs = [pair for pair in pairs if list(pair) not in checkpoint['done']]
+    missing_features = [version for version in range_versions if not (Path(FEATURES_FOLDER) / version).is_file()]
+
+    with ProcessPoolExecutor(workers) as executor:
+        # snapshots are written before any chain reads them, as two chains may share a version
+        _extract_all_features(executor, missing_features, _memory_budget(memory_budget))
+
+        futures = [executor.submit(_diff_chain, chain) for chain in _chains(remaining_pairs, workers or os.cpu_count())]
+        store = _map_store()
+        for future in as_completed(futures):
+            for version_a, version_b, map_from_previous, map_to_previous in future.result():
+                store.write(version_a, version_b, map_from_previous)
+                store.write(version_b, version_a, map_to_previous)
+                checkpoint['done'].append([version_a, version_b])
+            _write_checkpoint(checkpoint, REBUILD_CHECKPOINT_FILE)
+            if progress:
+                progress(len(checkpoint['done']), len(pairs))
+
+    for version in range_versions:
+        _invalidate_skip_maps(version)
+        _invalidate_range_cache(version)
+    for version in range_versions:
+        _update_skip_maps(version)
+    _rebuild_lineage_index()
+
+    Path(REBUILD_CHECKPOINT_FILE).unlink()
+
+def read_manifest(path):
+    """Read (version, file path) entries from a directory of files named after their versions, 
+    a JSON object of version to path, or lines of whitespace separated version and path. 
+    """
+    path = Path(path)
+
+    if path.is_dir():
+        return [(file.name[:-len(file.suffix)] if file.suffix in ('.apk', '.dex') else file.name, file)
+                for file in sorted(path.iterdir()) if file.is_file()]
+
+    with open(path) as f:
+        content = f.read()
+    try:
+        entries = json.loads(content).items()
+    except ValueError:
+        entries = [line.split(maxsplit=1) for line in content.splitlines() if line.strip() and not line.startswith('#')]
+    return [(version, path.parent / file_path.strip()) for version, file_path in entries]
+
+def map(version_from, version_to, package=None):
+    """Return the JSON map from one version to another, optionally only for the classes of `package`. 
+
+    Whole maps are kept in the range cache, so repeating a query reads a single file. 
+    """
+    if not _is_range_valid(version_from, version_to):
         return
 
-    reverse = StrictVersion(version_from) > StrictVersion(version_to)
-    lower_version = version_to if reverse else version_from
-    uppder_version = version_from if reverse else version_to
+    generation = _generation()
+    cached = _read_range_cache(version_from, version_to)
+    if cached is not None:
+        return cached if package is None else json.dumps(dict(filter_package(json.loads(cached).items(), package)))
 
-    relevant_versions = sorted((version for version in versions() 
-                        if StrictVersion(lower_version) <= StrictVersion(version) 
-                        and StrictVersion(version) <= StrictVersion(uppder_version)))
-    
-    if reverse:
-        relevant_versions.reverse()
+    result = json.dumps(dict(_iter_composed(_map_spans(version_from, version_to), package)))
+    if package is None:
+        _write_range_cache(version_from, version_to, result, generation)
+    return result
 
-    with open(Path(DIFF_FOLDER) / f'{relevant_versions[0]}-{relevant_versions[1]}') as f:
-        total_map = json.load(f)
-    for current_version, next_version in zip(relevant_versions[:-1], relevant_versions[2:]):
-        current_map = Path(DIFF_FOLDER) / f'{current_version}-{next_version}'
+def iter_map(version_from, version_to, package=None):
+    """Yield the (class, mapped class) pairs from one version to another as they are composed, 
+    optionally only for the classes of `package` and its subpackages. 
+    """
+    if not _is_range_valid(version_from, version_to):
+        return
 
-        if not current_map.is_file():
-            _compute_maps(current_version, next_version)
+    cached = _read_range_cache(version_from, version_to)
+    if cached is not None:
+        yield from filter_package(json.loads(cached).items(), package)
+        return
 
-        with open(current_map, 'r') as f:
-            current_map = json.load(f)
-            for key, value in total_map.items():
-                try:
-                    total_map[key] = current_map[value]
-                except KeyError:
-                    pass
+    yield from _iter_composed(_map_spans(version_from, version_to), package)
+
+def filter_package(pairs, package=None):
+    """Keep the (class, mapped class) pairs whose class is in `package`, given dotted, or in its subpackages. 
+    """
+    if package is None:
+        yield from pairs
+        return
 
-    return json.dumps(total_map)
+    prefix = 'L' + package.replace('.', '/') + '/'
+    for class_name, mapped_name in pairs:
+        if class_name.startswith(prefix):
+            yield class_name, mapped_name
 
 def until(version, class_name):
     if not in_timeline():
@@ -139,17 +382,21 @@ def until(version, class_name):
         logger.error("Version {version} doesn't exist. ")
         return
 
+    index = _lineage_index()
+    if index:
+        try:
+            return index.until(version, class_name)
+        finally:
+            index.close()
+
     for next_version in versions():
         if StrictVersion(next_version) <= StrictVersion(version):
             continue
 
-        with open(Path(DIFF_FOLDER) / f'{version}-{next_version}', 'r') as f:
-            mapping = json.load(f)
-            try:
-                class_name = mapping[class_name]
-            except KeyError:
-                break
-            version = next_version
+        class_name = _lookup(version, next_version, class_name)
+        if class_name is None:
+            break
+        version = next_version
 
     return version
 
@@ -162,26 +409,93 @@ def since(version, class_name):
         logger.error("Version {version} doesn't exist. ")
         return
 
+    index = _lineage_index()
+    if index:
+        try:
+            return index.since(version, class_name)
+        finally:
+            index.close()
+
     for previous_version in reversed(versions()):
         if StrictVersion(previous_version) >= StrictVersion(version):
             continue
 
-        with open(Path(DIFF_FOLDER) / f'{version}-{previous_version}', 'r') as f:
-            mapping = json.load(f)
-            try:
-                class_name = mapping[class_name]
-            except KeyError:
-                break
-            version = previous_version
+        class_name = _lookup(version, previous_version, class_name)
+        if class_name is None:
+            break
+        version = previous_version
 
     return version
 
+def lifetimes():
+    """Yield the first version, last version and names per version of every class chain. 
+    """
+    if not in_timeline():
+        logger.error('Not in a timeline. ')
+        return
+
+    index = _lineage_index()
+    if index is None:
+        _rebuild_lineage_index()
+        index = _lineage_index()
+
+    try:
+        yield from index.lifetimes()
+    finally:
+        index.close()
+
+@_locked
+def migrate_storage(storage):
+    if not in_timeline():
+        logger.error('Not in a timeline. ')
+        return
+
+    if storage not in STORAGE_FORMATS:
+        logger.error(f"'{storage}' is not a valid storage format")
+        return
+
+    current_storage = get_config('storage', 'json')
+    if storage == current_storage:
+        logger.info(f'Timeline already uses {storage} storage')
+        return
+
+    for folder in (DIFF_FOLDER, SKIPS_FOLDER):
+        old_store = _map_store(folder, current_storage)
+        new_store = _map_store(folder, storage)
+        for version_a, version_b in old_store.pairs():
+            new_store.write(version_a, version_b, old_store.read(version_a, version_b))
+
+    put_config('storage', storage)
+
+    for folder in (DIFF_FOLDER, SKIPS_FOLDER):
+        old_store = _map_store(folder, current_storage)
+        for version_a, version_b in old_store.pairs():
+            old_store.remove(version_a, version_b)
+
 def versions():
     if not in_timeline():
         logger.error('Not in a timeline. ')
         return
 
-    return sorted((p.name for p in Path(SOURCES_FOLDER).iterdir()), key=StrictVersion)
+    return sorted((p.name for p in Path(SOURCES_FOLDER).iterdir() if not p.name.endswith(TMP_SUFFIX)), key=StrictVersion)
+
+def set_cache(cache):
+    """Keep loaded maps and features in `cache`, an object with `get(key)` and `put(key, value)`. 
+
+    Keys include the modification stamp of the file they were loaded from, so a cache never serves stale data. 
+    """
+    global _cache
+    _cache = cache
+
+def _cached(key, load):
+    if _cache is None:
+        return load()
+
+    value = _cache.get(key)
+    if value is None:
+        value = load()
+        _cache.put(key, value)
+    return value
 
 def _is_version_valid(version):
     try:
@@ -190,18 +504,590 @@ def _is_version_valid(version):
     except ValueError:
         return False
 
-def _compute_maps(version_a, version_b):
+def _get_differ(memory_budget=None, workers=None):
+    # the differs load lief, which only commands that diff should pay for
+    from apocalypse.dex_differ import DexDiffer
+    from apocalypse.apk_differ import APKDiffer
+
     format = get_config('format')
 
     if format == 'DEX':
-        differ = DexDiffer()
+        return DexDiffer()
     elif format == 'APK':
-        differ = APKDiffer()
+        return APKDiffer(workers=workers, memory_budget=memory_budget)
     else:
         raise ValueError('Invalid format in config')
-    map_from_previous, map_to_previous = differ.diff(str(Path(SOURCES_FOLDER) / version_a), str(Path(SOURCES_FOLDER) / version_b))
 
-    with open(Path(DIFF_FOLDER) / f'{version_a}-{version_b}', 'w') as f:
-        json.dump(map_from_previous, f)
-    with open(Path(DIFF_FOLDER) / f'{version_b}-{version_a}', 'w') as f:
-        json.dump(map_to_previous, f)
\ No newline at end of file
+def _memory_budget(memory_budget=None):
+    # an explicit budget overrides the one of the timeline config
+    return memory_budget if memory_budget is not None else get_config('memory_budget')
+
+def _load_features(version, workers=None):
+    features_path = Path(FEATURES_FOLDER) / version
+
+    if features_path.is_file():
+        stat = features_path.stat()
+        with profiling.section('snapshot loading'):
+            return _cached(('features', version, stat.st_mtime_ns, stat.st_size), lambda: load_features(features_path))
+
+    return _classes(_load_dexs(version, workers))
+
+def _load_dexs(version, workers=None):
+    """Return the content digest and class features of every dex file of `version`. 
+
+    Versions snapshotted before their dex files were recorded are a single dex file without digest, 
+    unless their manifest lists their dex files. 
+    """
+    if not (Path(FEATURES_FOLDER) / version).is_file():
+        # timelines created before feature snapshots existed get them lazily
+        dexs = _source_dexs(Path(SOURCES_FOLDER) / version, _read_manifest(version), _memory_budget(), workers)
+        _save_snapshot(version, dexs)
+        return dexs
+
+    features = _load_features(version)
+    try:
+        with open(Path(DEXS_FOLDER) / version) as f:
+            record = json.load(f)
+    except FileNotFoundError:
+        record = None
+
+    if record is None or sum(count for _, count in record) != len(features):
+        manifest = _read_manifest(version)
+        if manifest is not None:
+            return [(digest, _dex_blob_features(digest)) for digest in _dex_digests(manifest)]
+        return [(None, features)]
+
+    dexs = []
+    start = 0
+    for digest, count in record:
+        dexs.append((digest, features[start:start + count]))
+        start += count
+    return dexs
+
+def _save_snapshot(version, dexs):
+    """Save the features of `version`, and the digest and number of classes of each of its dex files, 
+    which tell the dex files apart in the snapshot. 
+    """
+    Path(DEXS_FOLDER).mkdir(exist_ok=True)
+    with atomic_write(Path(DEXS_FOLDER) / version) as f:
+        json.dump([[digest, len(classes)] for digest, classes in dexs], f)
+
+    Path(FEATURES_FOLDER).mkdir(exist_ok=True)
+    save_features(_classes(dexs), Path(FEATURES_FOLDER) / version)
+
+def _classes(dexs):
+    return [cls for _, classes in dexs for cls in classes]
+
+def _map_store(folder=DIFF_FOLDER, storage=None):
+    if storage is None:
+        storage = get_config('storage', 'json')
+
+    if storage == 'binary':
+        return BinaryMapStore(folder, NameTable(NAMES_FILE))
+    return JSONMapStore(folder)
+
+def _extract_features(version):
+    # runs in a worker process, which parses the dex files itself rather than through a pool of its own
+    _load_features(version, workers=1)
+
+def _extract_all_features(executor, versions, memory_budget=None):
+    """Extract the features of `versions` in the workers of `executor`, starting an extraction 
+    only when the estimated memory of those running leaves room for it in `memory_budget`. 
+    """
+    if memory_budget is None:
+        list(executor.map(_extract_features, versions))
+        return
+
+    from apocalypse.apk_differ import run_within_memory_budget
+
+    tasks = [(version, _extraction_memory(version)) for version in versions]
+    run_within_memory_budget(functools.partial(executor.submit, _extract_features), tasks, memory_budget)
+
+def _extraction_memory(version):
+    # dex files of a version are parsed one at a time per worker, so the largest one decides
+    from apocalypse.apk_differ import DEX_MEMORY_FACTOR
+
+    manifest = _read_manifest(version)
+    path = Path(SOURCES_FOLDER) / version
+    if manifest is not None:
+        sizes = [BlobStore(BLOBS_FOLDER).path(digest).stat().st_size for digest in _dex_digests(manifest)]
+    elif get_config('format') == 'APK':
+        with ZipFile(path) as z:
+            sizes = [info.file_size for info in z.infolist() if info.filename.endswith('.dex')]
+    else:
+        sizes = [path.stat().st_size]
+    return DEX_MEMORY_FACTOR * max(sizes, default=0)
+
+def _diff_versions(version_a, version_b, encoding_workers=1):
+    return _diff_dexs(_load_dexs(version_a), _load_dexs(version_b), encoding_workers)
+
+def _diff_dexs(old_dexs, new_dexs, encoding_workers=1):
+    return _diff_features(_classes(old_dexs), _classes(new_dexs), encoding_workers, _identical_dex_mapping(old_dexs, new_dexs))
+
+def _diff_features(old_features, new_features, encoding_workers=1, initial_mapping=None):
+    from apocalypse.classes_differ import ClassesDiffer
+
+    differ = ClassesDiffer(encoding_workers=encoding_workers)
+    return differ.diff(old_features, new_features, initial_mapping)
+
+def _chains(pairs, workers):
+    """Cut version pairs into chains of consecutive pairs, short enough to keep `workers` busy. 
+    """
+    runs = []
+    for pair in pairs:
+        if runs and runs[-1][-1][1] == pair[0]:
+            runs[-1].append(pair)
+        else:
+            runs.append([pair])
+
+    length = max(2, -(-len(pairs) // (2 * workers)))
+    return [run[i:i + length] for run in runs for i in range(0, len(run), length)]
+
+def _diff_chain(pairs):
+    # runs in a worker process; the features of the newer version are kept for the next pair
+    results = []
+    dexs = {}
+    for version_a, version_b in pairs:
+        old_dexs = dexs[version_a] if version_a in dexs else _load_dexs(version_a, workers=1)
+        new_dexs = _load_dexs(version_b, workers=1)
+        dexs = {version_b: new_dexs}
+
+        map_from_previous, map_to_previous = _diff_dexs(old_dexs, new_dexs)
+        results.append((version_a, version_b, map_from_previous, map_to_previous))
+    return results
+
+def _compute_maps(version_a, version_b, encoding_workers=1):
+    # maps missing from lazily inserted versions are computed by queries, and stored as derived data
+    generation = _generation()
+    map_from_previous, map_to_previous = _diff_versions(version_a, version_b, encoding_workers)
+
+    with _timeline_lock_if_free() as locked:
+        if locked and _generation() == generation:
+            store = _map_store()
+            store.write(version_a, version_b, map_from_previous)
+            store.write(version_b, version_a, map_to_previous)
+
+    return map_from_previous, map_to_previous
+
+def _load_map(version_a, version_b):
+    store = _map_store()
+
+    if not store.exists(version_a, version_b):
+        mapping, _ = _compute_maps(version_a, version_b)
+        store = _map_store()
+        if not store.exists(version_a, version_b):
+            return mapping
+
+    return _cached((DIFF_FOLDER, version_a, version_b, store.stamp(version_a, version_b)),
+                   lambda: store.read(version_a, version_b))
+
+def _lookup(version_a, version_b, class_name):
+    if _cache is not None:
+        return _load_map(version_a, version_b).get(class_name)
+
+    store = _map_store()
+
+    if not store.exists(version_a, version_b):
+        mapping, _ = _compute_maps(version_a, version_b)
+        store = _map_store()
+        if not store.exists(version_a, version_b):
+            return mapping.get(class_name)
+
+    return store.lookup(version_a, version_b, class_name)
+
+def _is_range_valid(version_from, version_to):
+    if not in_timeline():
+        logger.error('Not in a timeline. ')
+        return False
+
+    if not _is_version_valid(version_from):
+        logger.error(f"'{version_from}' is not a valid version")
+        return False
+    if not _is_version_valid(version_to):
+        logger.error(f"'{version_to}' is not a valid version")
+        return False
+
+    if version_from == version_to:
+        logger.error(f"Can't map version {version_from} to itself")
+        return False
+
+    if not (Path(SOURCES_FOLDER) / version_from).is_file():
+        logger.error("Version {version_from} doesn't exist. ")
+        return False
+    if not (Path(SOURCES_FOLDER) / version_to).is_file():
+        logger.error(f"Version {version_to} doesn't exist. ")
+        return False
+
+    return True
+
+def _map_spans(version_from, version_to):
+    reverse = StrictVersion(version_from) > StrictVersion(version_to)
+    lower_version = version_to if reverse else version_from
+    uppder_version = version_from if reverse else version_to
+
+    relevant_versions = [version for version in versions() 
+                        if StrictVersion(lower_version) <= StrictVersion(version) 
+                        and StrictVersion(version) <= StrictVersion(uppder_version)]
+    
+    if reverse:
+        relevant_versions.reverse()
+
+    return [_load_span(current_version, next_version) for current_version, next_version in _skip_path(relevant_versions)]
+
+def _iter_composed(spans, package=None):
+    # each class is followed through the spans, so no intermediate map is ever built
+    first_span, *other_spans = spans
+
+    for class_name, mapped_name in filter_package(first_span.items(), package):
+        for span in other_spans:
+            mapped_name = span.get(mapped_name)
+            if mapped_name is None:
+                break
+        else:
+            yield class_name, mapped_name
+
+def _compose(first_map, second_map):
+    # classes that have no counterpart along the way are dropped
+    return {key: second_map[value] for key, value in first_map.items() if value in second_map}
+
+# Skip maps compose the adjacent maps over longer spans, forming a deterministic skip list:
+# each version gets a level from its hash, and a span joins consecutive versions of level >= j.
+# A range query then composes O(log N) spans instead of every adjacent map.
+
+def _version_level(version):
+    h = int.from_bytes(blake2b(version.encode(), digest_size=8).digest(), 'little')
+    if h == 0:
+        return MAX_SKIP_LEVEL
+    return min((h & -h).bit_length() - 1, MAX_SKIP_LEVEL)
+
+def _skip_path(relevant_versions):
+    levels = [_version_level(version) for version in relevant_versions]
+
+    path = []
+    i = 0
+    while i < len(relevant_versions) - 1:
+        j = i + 1
+        for level in range(levels[i], 0, -1):
+            k = next((k for k in range(i + 1, len(relevant_versions)) if levels[k] >= level), None)
+            if k is not None:
+                j = k
+                break
+        path.append((relevant_versions[i], relevant_versions[j]))
+        i = j
+
+    return path
+
+def _load_span(version_a, version_b):
+    generation = _generation()
+    all_versions = versions()
+    index_a = all_versions.index(version_a)
+    index_b = all_versions.index(version_b)
+
+    if abs(index_a - index_b) == 1:
+        return _load_map(version_a, version_b)
+
+    store = _map_store(SKIPS_FOLDER)
+    if store.exists(version_a, version_b):
+        return _cached((SKIPS_FOLDER, version_a, version_b, store.stamp(version_a, version_b)),
+                       lambda: store.read(version_a, version_b))
+
+    # a span is built from the spans one level below it
+    step = 1 if index_a < index_b else -1
+    inner_versions = all_versions[index_a + step:index_b:step]
+    top_level = max(_version_level(version) for version in inner_versions)
+    breakpoints = [version_a] + [version for version in inner_versions if _version_level(version) == top_level] + [version_b]
+
+    span = None
+    for current_version, next_version in zip(breakpoints[:-1], breakpoints[1:]):
+        current_map = _load_span(current_version, next_version)
+        span = current_map if span is None else _compose(span, current_map)
+
+    with _timeline_lock_if_free() as locked:
+        if locked and _generation() == generation:
+            _map_store(SKIPS_FOLDER).write(version_a, version_b, span)
+
+    return span
+
+def _invalidate_skip_maps(version):
+    store = _map_store(SKIPS_FOLDER)
+
+    for version_a, version_b in store.pairs():
+        lower_version, upper_version = sorted((version_a, version_b), key=StrictVersion)
+        if StrictVersion(lower_version) <= StrictVersion(version) <= StrictVersion(upper_version):
+            store.remove(version_a, version_b)
+
+def _update_skip_maps(version):
+    all_versions = versions()
+    index = all_versions.index(version)
+    levels = [_version_level(some_version) for some_version in all_versions]
+
+    # rebuild the span covering the version at every level, in both directions
+    for level in range(1, MAX_SKIP_LEVEL + 1):
+        previous_index = next((i for i in range(index - 1, -1, -1) if levels[i] >= level), None)
+        next_index = next((i for i in range(index + 1, len(all_versions)) if levels[i] >= level), None)
+
+        if levels[index] >= level:
+            spans = [(previous_index, index), (index, next_index)]
+        else:
+            spans = [(previous_index, next_index)]
+
+        for index_a, index_b in spans:
+            if index_a is not None and index_b is not None and index_b - index_a > 1:
+                _load_span(all_versions[index_a], all_versions[index_b])
+                _load_span(all_versions[index_b], all_versions[index_a])
+
+        if previous_index is None and next_index is None:
+            break
+
+# The range cache keeps the JSON result of whole map queries, one file per (from, to) range. 
+# File modification times track recency: a hit touches its file, and writes evict the least 
+# recently used files beyond the configured size. Inserting a version drops the ranges covering it. 
+
+def _range_cache_path(version_from, version_to):
+    return Path(RANGE_CACHE_FOLDER) / f'{version_from}-{version_to}'
+
+def _read_range_cache(version_from, version_to):
+    path = _range_cache_path(version_from, version_to)
+    try:
+        with open(path) as f:
+            result = f.read()
+    except FileNotFoundError:
+        return None
+
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        # evicted by another process since it was read
+        pass
+    return result
+
+def _write_range_cache(version_from, version_to, result, generation):
+    max_size = get_config('range_cache_size', RANGE_CACHE_SIZE)
+    if len(result) > max_size:
+        return
+
+    with _timeline_lock_if_free() as locked:
+        if not locked or _generation() != generation:
+            return
+
+        Path(RANGE_CACHE_FOLDER).mkdir(exist_ok=True)
+        with atomic_write(_range_cache_path(version_from, version_to)) as f:
+            f.write(result)
+
+        entries = [(path.stat(), path) for path in Path(RANGE_CACHE_FOLDER).iterdir() if not path.name.endswith(TMP_SUFFIX)]
+        size = sum(stat.st_size for stat, _ in entries)
+        for stat, path in sorted(entries, key=lambda entry: entry[0].st_mtime):
+            if size <= max_size:
+                break
+            path.unlink(missing_ok=True)
+            size -= stat.st_size
+
+def _invalidate_range_cache(version):
+    if not Path(RANGE_CACHE_FOLDER).is_dir():
+        return
+
+    for path in Path(RANGE_CACHE_FOLDER).iterdir():
+        if path.name.endswith(TMP_SUFFIX):
+            continue
+        lower_version, upper_version = sorted(path.name.split('-'), key=StrictVersion)
+        if StrictVersion(lower_version) <= StrictVersion(version) <= StrictVersion(upper_version):
+            path.unlink(missing_ok=True)
+
+def _lineage_index():
+    # the index only answers queries while it covers exactly the versions of the timeline
+    if not Path(LINEAGE_FILE).is_file():
+        return None
+
+    index = LineageIndex(LINEAGE_FILE)
+    if index.versions() != versions():
+        index.close()
+        return None
+    return index
+
+def _rebuild_lineage_index():
+    Path(LINEAGE_FILE).unlink(missing_ok=True)
+    index = LineageIndex(LINEAGE_FILE)
+
+    try:
+        previous_version = None
+        for version in versions():
+            map_from_previous = _load_map(previous_version, version) if previous_version else None
+            index.insert_version(version, previous_version, None, map_from_previous, None, _class_names(version))
+            previous_version = version
+    finally:
+        index.close()
+
+def _update_lineage_index(version):
+    all_versions = versions()
+
+    if not Path(LINEAGE_FILE).is_file():
+        _rebuild_lineage_index()
+        return
+
+    index = LineageIndex(LINEAGE_FILE)
+    try:
+        if [some_version for some_version in index.versions() if some_version != version] != \
+                [some_version for some_version in all_versions if some_version != version]:
+            stale = True
+        else:
+            stale = False
+            position = all_versions.index(version)
+            previous_version = all_versions[position - 1] if position > 0 else None
+            next_version = all_versions[position + 1] if position + 1 < len(all_versions) else None
+
+            index.insert_version(
+                version, previous_version, next_version,
+                _load_map(previous_version, version) if previous_version else None,
+                _load_map(version, next_version) if next_version else None,
+                _class_names(version))
+    finally:
+        index.close()
+
+    if stale:
+        _rebuild_lineage_index()
+
+def _class_names(version):
+    # the classes the maps of the version are made of, as diffs skip the others
+    from apocalypse.classes_differ import ClassesDiffer
+
+    return [cls.fullname for cls in _load_features(version) if ClassesDiffer.filter_class(cls)]
+
+# Writers of a timeline take the timeline lock to change it, and bump its generation once done. 
+# Readers never wait for the lock: every file is replaced atomically, and the data they derive 
+# and store (skip maps, cached ranges) is only written if they get the lock without waiting and 
+# the generation didn't change since they started, and is left to a later query otherwise. 
+
+def _file_lock(path):
+    path = Path(path).absolute()
+    if path not in _locks:
+        _locks[path] = FileLock(path)
+    return _locks[path]
+
+def _timeline_lock():
+    return _file_lock(LOCK_FILE)
+
+@contextmanager
+def _timeline_lock_if_free():
+    # yields whether the timeline lock could be taken without waiting
+    lock = _timeline_lock()
+    locked = lock.acquire(blocking=False)
+    try:
+        yield locked
+    finally:
+        if locked:
+            lock.release()
+
+def _version_lock(version):
+    # serializes the insertions of a same version, which mostly run outside the timeline lock
+    Path(LOCKS_FOLDER).mkdir(exist_ok=True)
+    return _file_lock(Path(LOCKS_FOLDER) / version)
+
+def _generation():
+    try:
+        with open(GENERATION_FILE) as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return 0
+
+def _bump_generation():
+    with atomic_write(GENERATION_FILE) as f:
+        f.write(str(_generation() + 1))
+
+def _neighbor_pairs(version):
+    """Return the pairs `version` forms with its neighbors, with the stamp of the neighbor's source. 
+    """
+    other_versions = [some_version for some_version in versions() if some_version != version]
+    previous_versions = [some_version for some_version in other_versions if StrictVersion(some_version) < StrictVersion(version)]
+    next_versions = [some_version for some_version in other_versions if StrictVersion(some_version) > StrictVersion(version)]
+
+    pairs = {}
+    if previous_versions:
+        pairs[previous_versions[-1], version] = _source_stamp(previous_versions[-1])
+    if next_versions:
+        pairs[version, next_versions[0]] = _source_stamp(next_versions[0])
+    return pairs
+
+def _source_stamp(version):
+    stat = (Path(SOURCES_FOLDER) / version).stat()
+    return stat.st_mtime_ns, stat.st_size
+
+def _write_source(file_path, version, manifest=None):
+    if manifest is not None:
+        with atomic_write(Path(SOURCES_FOLDER) / version) as f:
+            json.dump(manifest, f)
+        return
+
+    with open(file_path, 'rb') as source, atomic_write(Path(SOURCES_FOLDER) / version, 'wb') as f:
+        shutil.copyfileobj(source, f)
+
+# With the 'blobs' source layout, the entries of an apk, or a dex file whole, are stored once 
+# by content, and features are extracted once per dex blob. Dex files left unchanged between 
+# versions then cost nothing to parse. 
+
+def _store_blobs(file_path):
+    """Store the entries of a source file as blobs and return its manifest, 
+    or None if the timeline keeps copies of its source files. 
+    """
+    if get_config('sources', 'files') != 'blobs':
+        return None
+
+    blobs = BlobStore(BLOBS_FOLDER)
+    if get_config('format') == 'DEX':
+        with open(file_path, 'rb') as f:
+            return {'entries': [['classes.dex', blobs.put(f.read())]]}
+
+    with ZipFile(file_path) as z:
+        return {'entries': [[info.filename, blobs.put(z.read(info))] for info in z.infolist() if not info.is_dir()]}
+
+def _read_manifest(version):
+    if get_config('sources', 'files') != 'blobs':
+        return None
+
+    with open(Path(SOURCES_FOLDER) / version) as f:
+        return json.load(f)
+
+def _dex_digests(manifest):
+    entries = dict(manifest['entries'])
+
+    digests = []
+    for i in itertools.count(start=1):
+        dex_filename = 'classes' + ('' if i == 1 else str(i)) + '.dex'
+        if dex_filename not in entries:
+            return digests
+        digests.append(entries[dex_filename])
+
+def _source_dexs(file_path, manifest=None, memory_budget=None, workers=None):
+    """Return the content digest, as stored blobs are named, and class features of every dex file of a source file. 
+    """
+    if manifest is None:
+        return [(digest.hex(), classes) for digest, classes in _get_differ(memory_budget, workers).extract_dexs(str(file_path))]
+
+    return [(digest, _dex_blob_features(digest)) for digest in _dex_digests(manifest)]
+
+def _dex_blob_features(digest):
+    features_path = Path(DEX_FEATURES_FOLDER) / digest
+    if features_path.is_file():
+        return _cached(('dex features', digest), lambda: load_features(features_path))
+
+    from apocalypse.dex_differ import DexDiffer
+
+    features = DexDiffer().extract_features(str(BlobStore(BLOBS_FOLDER).path(digest)))
+    Path(DEX_FEATURES_FOLDER).mkdir(exist_ok=True)
+    save_features(features, features_path)
+    return features
+
+def _identical_dex_mapping(old_dexs, new_dexs):
+    # the classes of dex files found in both versions map to themselves, as in a diff of the files
+    identical_digests = set(digest for digest, _ in old_dexs if digest is not None) & set(digest for digest, _ in new_dexs)
+    return {cls.fullname: cls.fullname for digest, classes in new_dexs if digest in identical_digests for cls in classes}
+
+def _read_checkpoint(path=CHECKPOINT_FILE):
+    if not Path(path).is_file():
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+def _write_checkpoint(checkpoint, path=CHECKPOINT_FILE):
+    with atomic_write(path) as f:
+        json.dump(checkpoint, f)
@@ -0,0 +1,48 @@
+import re
+from functools import total_ordering
+
+
+# Same rules as distutils.version.StrictVersion, whose import alone (through setuptools)
+# costs more than the rest of the query commands, and which newer Pythons no longer ship.
+_VERSION_RE = re.compile(r'^(\d+) \. (\d+) (\. (\d+))? ([ab](\d+))?$', re.VERBOSE | re.ASCII)
+
+
+@total_ordering
+class StrictVersion:
+    """Version numbers like '1.2', '1.2.3' or '1.2.3b1', where a pre-release sorts before its release.
+    """
+
+    def __init__(self, version: str):
+        match = _VERSION_RE.match(version)
+        if not match:
+            raise ValueError(f"invalid version number '{version}'")
+
+        major, minor, patch, prerelease, prerelease_number = match.group(1, 2, 4, 5, 6)
+        self.version = (int(major), int(minor), int(patch) if patch else 0)
+        self.prerelease = (prerelease[0], int(prerelease_number)) if prerelease else None
+
+    def _key(self):
+        return self.version, (0,) + self.prerelease if self.prerelease else (1,)
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            other = StrictVersion(other)
+        return self._key() == other._key()
+
+    def __lt__(self, other):
+        if isinstance(other, str):
+            other = StrictVersion(other)
+        return self._key() < other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __str__(self):
+        major, minor, patch = self.version
+        version = f'{major}.{minor}' if patch == 0 else f'{major}.{minor}.{patch}'
+        if self.prerelease:
+            version += f'{self.prerelease[0]}{self.prerelease[1]}'
+        return version
+
+    def __repr__(self):
+        return f"StrictVersion('{self}')"
@@ -0,0 +1,47 @@
+"""Peak memory of diffing two APKs, to check the memory budget of dex parsing holds.
+
+    python -m benchmarks.apk_memory old.apk new.apk --workers 4 --memory-budget 2048 --max-rss 3072
+
+Unlike the other benchmarks this needs real APK files, as the memory goes to lief parsing
+their dex files. Run it once per configuration: peak RSS only ever grows within a process.
+"""
+import argparse
+import sys
+import time
+
+from apocalypse.apk_differ import APKDiffer
+from apocalypse.profiling import peak_rss
+
+
+MB = 1 << 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--workers', type=int, default=1, help='dex parsing processes, 1 parses in-process')
+    parser.add_argument('--memory-budget', type=int, default=None, help='MB the dex files parsed at once may take')
+    parser.add_argument('--max-rss', type=int, default=None, help='fail when a process peaks above this many MB')
+    args = parser.parse_args()
+
+    memory_budget = args.memory_budget * MB if args.memory_budget is not None else None
+    differ = APKDiffer(workers=args.workers, memory_budget=memory_budget)
+
+    start = time.perf_counter()
+    mapping, _ = differ.diff(args.old, args.new)
+    elapsed = time.perf_counter() - start
+
+    rss = peak_rss()
+    if rss is None:
+        sys.exit('peak RSS is not available on this platform')
+
+    print(f'{len(mapping)} classes mapped in {elapsed:.2f}s')
+    print(f"peak RSS: {rss['self'] / MB:.0f}MB, largest worker: {rss['children'] / MB:.0f}MB")
+
+    over_budget = args.max_rss is not None and max(rss.values()) > args.max_rss * MB
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Synthetic class corpora for benchmarking, generated offline from a seed.
+
+Classes are produced directly as `ClassFeatures`, the same records the differ works on,
+mixing obfuscated classes (short package names, so they get encoded) with library classes
+(long package names, so they are matched by name). `mutate` derives a next build and the
+ground truth mapping between the two.
+"""
+import itertools
+import random
+import string
+from typing import Dict, List, Tuple
+
+from apocalypse.features import ClassFeatures, MethodFeatures
+
+
+PRIMITIVE_TYPES = ['VOID_T', 'BOOLEAN', 'INT', 'LONG', 'FLOAT', 'DOUBLE', 'BYTE', 'CHAR']
+FRAMEWORK_TYPES = ['Ljava/lang/Object;', 'Ljava/lang/String;', 'Landroid/content/Context;', 'Landroid/os/Bundle;']
+LIBRARY_PACKAGES = ['com.google.gson', 'okhttp3.internal', 'kotlin.collections', 'androidx.core.view']
+METHOD_NAMES = ['<init>', 'toString', 'hashCode', 'equals', 'onCreate', 'access$000', 'lambda$run$0']
+
+OBJECT = 'Ljava/lang/Object;'
+
+
+def _short_name(i: int) -> str:
+    letters = string.ascii_lowercase
+    name = ''
+    i += 1
+    while i:
+        i, remainder = divmod(i - 1, len(letters))
+        name = letters[remainder] + name
+    return name
+
+
+def _obfuscated_names(count: int, rng: random.Random, used=()) -> List[Tuple[str, str]]:
+    names = []
+    used = set(used)
+    i = 0
+    while len(names) < count:
+        package = _short_name(rng.randrange(26))
+        fullname = f'L{package}/{_short_name(i)};'
+        i += 1
+        if fullname not in used:
+            used.add(fullname)
+            names.append((fullname, package))
+    return names
+
+
+def generate_classes(count: int, seed: int = 0, library_ratio: float = 0.2) -> List[ClassFeatures]:
+    rng = random.Random(seed)
+
+    names = []
+    obfuscated = iter(_obfuscated_names(count, rng))
+    for i in range(count):
+        if rng.random() < library_ratio:
+            package = rng.choice(LIBRARY_PACKAGES)
+            names.append((f"L{package.replace('.', '/')}/C{i};", package))
+        else:
+            names.append(next(obfuscated))
+
+    packages = dict(names)
+    classes = []
+    for i, (fullname, package) in enumerate(names):
+        if i and rng.random() < 0.4:
+            parent = names[rng.randrange(i)][0]
+        else:
+            parent = OBJECT
+        parent_package = packages.get(parent, 'java.lang')
+
+        def random_type():
+            roll = rng.random()
+            if roll < 0.4:
+                type_ = rng.choice(PRIMITIVE_TYPES[1:])
+            elif roll < 0.6:
+                type_ = rng.choice(FRAMEWORK_TYPES)
+            else:
+                type_ = names[rng.randrange(count)][0]
+            return '[' + type_ if rng.random() < 0.1 else type_
+
+        methods = []
+        for j in range(rng.randint(1, 12)):
+            name = rng.choice(METHOD_NAMES) if rng.random() < 0.3 else _short_name(j)
+            length = rng.choice([0, rng.randint(2, 400)])
+            methods.append(MethodFeatures(
+                name,
+                [random_type() for _ in range(rng.randint(0, 4))],
+                'VOID_T' if rng.random() < 0.5 else random_type(),
+                rng.choice([1, 2, 9, 17, 4097]),
+                length,
+                rng.randrange(256) if length else None))
+
+        classes.append(ClassFeatures(fullname, package, i, rng.choice([1, 17, 1025, 1537]),
+                                     parent, parent_package, methods))
+    return classes
+
+
+def mutate(classes: List[ClassFeatures], seed: int = 0, renames: float = 0.3, implementation_edits: float = 0.05,
+           api_edits: float = 0.02, removals: float = 0.01, additions: float = 0.01) -> Tuple[List[ClassFeatures], Dict[str, str]]:
+    """Derive the next build of `classes`, returning it with the ground truth map of surviving classes.
+
+    `renames` is the fraction of obfuscated classes getting a fresh name within their package,
+    as a new obfuscation run would; references to renamed classes are rewritten accordingly.
+    """
+    rng = random.Random(seed)
+
+    survivors = [cls for cls in classes if rng.random() >= removals]
+
+    used = set(cls.fullname for cls in classes)
+    counter = itertools.count(len(used))
+    rename = {}
+    for cls in survivors:
+        if len(cls.package_name) > 3 or rng.random() >= renames:
+            continue
+        fullname = cls.fullname
+        while fullname in used:
+            fullname = f"L{cls.package_name.replace('.', '/')}/{_short_name(next(counter))};"
+        used.add(fullname)
+        rename[cls.fullname] = fullname
+
+    def retype(type_):
+        array = type_.startswith('[')
+        type_ = rename.get(type_.lstrip('['), type_.lstrip('['))
+        return '[' + type_ if array else type_
+
+    new_classes = []
+    for cls in survivors:
+        methods = [MethodFeatures(method.name, [retype(t) for t in method.parameters_type], retype(method.return_type),
+                                  method.access_flags, method.bytecode_length, method.bytecode_first)
+                   for method in cls.methods]
+
+        if methods and rng.random() < implementation_edits:
+            method = rng.choice(methods)
+            method.bytecode_length += rng.randint(1, 20)
+            method.bytecode_first = rng.randrange(256)
+        if rng.random() < api_edits:
+            if len(methods) > 1 and rng.random() < 0.5:
+                methods.pop(rng.randrange(len(methods)))
+            else:
+                methods.append(MethodFeatures(_short_name(len(methods)), ['INT'], 'VOID_T', 1, 12, 0x12))
+
+        parent = rename.get(cls.parent, cls.parent) if cls.has_parent else None
+        new_classes.append(ClassFeatures(
+            rename.get(cls.fullname, cls.fullname),
+            cls.package_name,
+            len(new_classes),
+            cls.access_flags,
+            parent,
+            cls.parent_package_name,
+            methods))
+
+    truth = {cls.fullname: rename.get(cls.fullname, cls.fullname) for cls in survivors}
+
+    extra = generate_classes(int(len(classes) * additions), seed=seed + 1, library_ratio=0)
+    taken = set(cls.fullname for cls in new_classes) | used
+    for cls, (fullname, package) in zip(extra, _obfuscated_names(len(extra), rng, taken)):
+        cls.fullname = fullname
+        cls.package_name = package
+        cls.index = len(new_classes)
+        new_classes.append(cls)
+
+    return new_classes, truth
+
+
+def accuracy(mapping: Dict[str, str], truth: Dict[str, str]) -> Dict[str, float]:
+    correct = sum(1 for old, new in mapping.items() if truth.get(old) == new)
+    return {
+        'mapped': len(mapping),
+        'precision': correct / len(mapping) if mapping else 1.0,
+        'recall': correct / len(truth) if truth else 1.0,
+    }
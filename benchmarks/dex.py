@@ -0,0 +1,219 @@
+"""Minimal DEX and APK writers, turning synthetic classes into files the differs parse.
+
+Only what class features are extracted from is written: class definitions with their parents,
+and methods with their prototypes, access flags and bytecode. Bytecode is its first byte
+followed by padding, its length rounded up to whole 16-bit code units, and a method clashing
+with an earlier one of its class by name and prototype is left out, as a dex can't hold both.
+"""
+import hashlib
+import io
+import struct
+import zipfile
+import zlib
+from typing import List, Tuple
+
+from apocalypse.features import ClassFeatures
+
+
+PRIMITIVE_DESCRIPTORS = {'VOID_T': 'V', 'BOOLEAN': 'Z', 'BYTE': 'B', 'SHORT': 'S', 'CHAR': 'C',
+                         'INT': 'I', 'LONG': 'J', 'FLOAT': 'F', 'DOUBLE': 'D'}
+
+NO_INDEX = 0xffffffff
+HEADER_SIZE = 0x70
+ENDIAN_CONSTANT = 0x12345678
+
+ACC_PRIVATE = 0x2
+ACC_STATIC = 0x8
+ACC_CONSTRUCTOR = 0x10000
+
+# map item types
+TYPE_HEADER_ITEM = 0x0000
+TYPE_STRING_ID_ITEM = 0x0001
+TYPE_TYPE_ID_ITEM = 0x0002
+TYPE_PROTO_ID_ITEM = 0x0003
+TYPE_METHOD_ID_ITEM = 0x0005
+TYPE_CLASS_DEF_ITEM = 0x0006
+TYPE_MAP_LIST = 0x1000
+TYPE_TYPE_LIST = 0x1001
+TYPE_CLASS_DATA_ITEM = 0x2000
+TYPE_CODE_ITEM = 0x2001
+TYPE_STRING_DATA_ITEM = 0x2002
+
+
+def _descriptor(type_: str) -> str:
+    base = type_.lstrip('[')
+    return '[' * (len(type_) - len(base)) + PRIMITIVE_DESCRIPTORS.get(base, base)
+
+
+def _shorty(descriptor: str) -> str:
+    return 'L' if descriptor[0] in 'L[' else descriptor
+
+
+def _uleb128(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _align(buffer: bytearray, alignment: int = 4):
+    buffer.extend(bytes(-len(buffer) % alignment))
+
+
+def _methods(cls: ClassFeatures) -> List[Tuple[str, str, Tuple[str, ...], int, int, int]]:
+    """Return the (name, return, parameters, access flags, code units, first byte) of the methods of `cls`."""
+    methods = []
+    seen = set()
+    for method in cls.methods:
+        return_type = _descriptor(method.return_type)
+        parameters = tuple(_descriptor(t) for t in method.parameters_type)
+        if (method.name, return_type, parameters) in seen:
+            continue
+        seen.add((method.name, return_type, parameters))
+
+        access_flags = method.access_flags
+        if method.name == '<init>':
+            access_flags |= ACC_CONSTRUCTOR
+        methods.append((method.name, return_type, parameters, access_flags,
+                        (method.bytecode_length + 1) // 2, method.bytecode_first or 0))
+    return methods
+
+
+def write_dex(classes: List[ClassFeatures]) -> bytes:
+    """Return a dex file defining `classes`, in their order, which must list parents first."""
+    class_methods = [_methods(cls) for cls in classes]
+
+    types = set()
+    strings = set()
+    protos = set()
+    for cls, methods in zip(classes, class_methods):
+        types.add(cls.fullname)
+        if cls.has_parent:
+            types.add(cls.parent)
+        for name, return_type, parameters, _, _, _ in methods:
+            strings.add(name)
+            types.add(return_type)
+            types.update(parameters)
+            protos.add((return_type, parameters))
+    shorties = {proto: _shorty(proto[0]) + ''.join(_shorty(t) for t in proto[1]) for proto in protos}
+    strings.update(types)
+    strings.update(shorties.values())
+
+    # ids are sorted as the format requires: strings by code points, the others by the indices they hold
+    string_list = sorted(strings)
+    string_index = {string: i for i, string in enumerate(string_list)}
+    type_list = sorted(types, key=string_index.__getitem__)
+    type_index = {type_: i for i, type_ in enumerate(type_list)}
+    proto_list = sorted(protos, key=lambda proto: (type_index[proto[0]], [type_index[t] for t in proto[1]]))
+    proto_index = {proto: i for i, proto in enumerate(proto_list)}
+    method_list = sorted({(type_index[cls.fullname], string_index[name], proto_index[(return_type, parameters)])
+                          for cls, methods in zip(classes, class_methods)
+                          for name, return_type, parameters, _, _, _ in methods})
+    method_index = {method: i for i, method in enumerate(method_list)}
+
+    string_ids_off = HEADER_SIZE
+    type_ids_off = string_ids_off + 4 * len(string_list)
+    proto_ids_off = type_ids_off + 4 * len(type_list)
+    method_ids_off = proto_ids_off + 12 * len(proto_list)
+    class_defs_off = method_ids_off + 8 * len(method_list)
+    data_off = class_defs_off + 32 * len(classes)
+
+    # the data section, at offsets relative to the start of the file
+    data = bytearray(data_off)
+    map_items = []
+
+    def section(item_type, count, offset):
+        if count:
+            map_items.append((item_type, count, offset))
+
+    type_list_offsets = {}
+    for _, parameters in proto_list:
+        if parameters and parameters not in type_list_offsets:
+            _align(data)
+            type_list_offsets[parameters] = len(data)
+            data += struct.pack('<I', len(parameters))
+            data += b''.join(struct.pack('<H', type_index[t]) for t in parameters)
+    _align(data)
+    section(TYPE_TYPE_LIST, len(type_list_offsets), min(type_list_offsets.values(), default=0))
+
+    code_offsets = {}
+    code_start = len(data)
+    for cls, methods in zip(classes, class_methods):
+        for name, return_type, parameters, access_flags, units, first in methods:
+            if not units:
+                continue
+            _align(data)
+            code_offsets[(cls.fullname, name, return_type, parameters)] = len(data)
+            ins = sum(2 if t in ('J', 'D') else 1 for t in parameters) + (0 if access_flags & ACC_STATIC else 1)
+            data += struct.pack('<HHHHII', ins, ins, 0, 0, 0, units)
+            data += bytes([first]) + bytes(2 * units - 1)
+    _align(data)
+    section(TYPE_CODE_ITEM, len(code_offsets), code_start)
+
+    string_offsets = []
+    section(TYPE_STRING_DATA_ITEM, len(string_list), len(data))
+    for string in string_list:
+        string_offsets.append(len(data))
+        data += _uleb128(len(string)) + string.encode() + b'\0'
+
+    class_data_offsets = []
+    section(TYPE_CLASS_DATA_ITEM, len(classes), len(data))
+    for cls, methods in zip(classes, class_methods):
+        class_data_offsets.append(len(data))
+        encoded = {True: [], False: []}
+        for name, return_type, parameters, access_flags, units, _ in methods:
+            index = method_index[(type_index[cls.fullname], string_index[name], proto_index[(return_type, parameters)])]
+            direct = bool(access_flags & (ACC_STATIC | ACC_PRIVATE | ACC_CONSTRUCTOR))
+            encoded[direct].append((index, access_flags, code_offsets.get((cls.fullname, name, return_type, parameters), 0)))
+        data += _uleb128(0) + _uleb128(0) + _uleb128(len(encoded[True])) + _uleb128(len(encoded[False]))
+        for direct in (True, False):
+            previous = 0
+            for index, access_flags, code_off in sorted(encoded[direct]):
+                data += _uleb128(index - previous) + _uleb128(access_flags) + _uleb128(code_off)
+                previous = index
+
+    _align(data)
+    map_off = len(data)
+    section(TYPE_HEADER_ITEM, 1, 0)
+    section(TYPE_STRING_ID_ITEM, len(string_list), string_ids_off)
+    section(TYPE_TYPE_ID_ITEM, len(type_list), type_ids_off)
+    section(TYPE_PROTO_ID_ITEM, len(proto_list), proto_ids_off)
+    section(TYPE_METHOD_ID_ITEM, len(method_list), method_ids_off)
+    section(TYPE_CLASS_DEF_ITEM, len(classes), class_defs_off)
+    section(TYPE_MAP_LIST, 1, map_off)
+    map_items.sort(key=lambda item: item[2])
+    data += struct.pack('<I', len(map_items))
+    data += b''.join(struct.pack('<HHII', item_type, 0, count, offset) for item_type, count, offset in map_items)
+
+    ids = bytearray()
+    ids += b''.join(struct.pack('<I', offset) for offset in string_offsets)
+    ids += b''.join(struct.pack('<I', string_index[type_]) for type_ in type_list)
+    ids += b''.join(struct.pack('<III', string_index[shorties[proto]], type_index[proto[0]], type_list_offsets.get(proto[1], 0))
+                    for proto in proto_list)
+    ids += b''.join(struct.pack('<HHI', class_idx, proto_idx, name_idx) for class_idx, name_idx, proto_idx in method_list)
+    for cls, class_data_off in zip(classes, class_data_offsets):
+        superclass = type_index[cls.parent] if cls.has_parent else NO_INDEX
+        ids += struct.pack('<8I', type_index[cls.fullname], cls.access_flags, superclass, 0, NO_INDEX, 0, class_data_off, 0)
+    data[HEADER_SIZE:data_off] = ids
+
+    data[:HEADER_SIZE] = struct.pack(
+        '<8sI20s20I', b'dex\n035\0', 0, bytes(20), len(data), HEADER_SIZE, ENDIAN_CONSTANT, 0, 0, map_off,
+        len(string_list), string_ids_off, len(type_list), type_ids_off, len(proto_list), proto_ids_off, 0, 0,
+        len(method_list), method_ids_off, len(classes), class_defs_off, len(data) - data_off, data_off)
+    data[12:32] = hashlib.sha1(data[32:]).digest()
+    data[8:12] = struct.pack('<I', zlib.adler32(data[12:]))
+    return bytes(data)
+
+
+def write_apk(classes: List[ClassFeatures], classes_per_dex: int) -> bytes:
+    """Return an apk holding `classes` split across dex files of up to `classes_per_dex` classes."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+        for i, start in enumerate(range(0, len(classes), classes_per_dex)):
+            z.writestr('classes' + ('' if i == 0 else str(i + 1)) + '.dex', write_dex(classes[start:start + classes_per_dex]))
+    return buffer.getvalue()
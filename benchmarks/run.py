@@ -0,0 +1,190 @@
+"""Benchmark harness for dex parsing, the differ pipeline and timeline ingest and queries, on synthetic corpora.
+
+    python -m benchmarks.run --scales 1000 10000 100000 --versions 5 20 --json results.json
+
+Everything runs offline: classes come from `benchmarks.corpus`, and are written as real dex and
+apk files by `benchmarks.dex` wherever parsing is measured, in a temporary directory.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import apocalypse.timeline as timeline
+from apocalypse.apk_differ import APKDiffer
+from apocalypse.classes_differ import ClassesDiffer
+from apocalypse.dex_differ import DexDiffer
+from apocalypse.features import load_features, save_features
+from apocalypse.fuzzy import FuzzyMatcher
+from apocalypse.profiling import Profile
+
+from benchmarks.corpus import accuracy, generate_classes, mutate
+from benchmarks.dex import write_apk, write_dex
+
+
+@contextmanager
+def _timer(results, key):
+    start = time.perf_counter()
+    yield
+    results[key] = time.perf_counter() - start
+
+
+def _peak_memory(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_differ(scale, seed=0, memory=True):
+    old_classes = generate_classes(scale, seed)
+    new_classes, truth = mutate(old_classes, seed + 1)
+    results = {'classes': scale}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot = Path(tmp_dir) / 'snapshot'
+        with _timer(results, 'snapshot_save'):
+            save_features(old_classes, snapshot)
+        with _timer(results, 'snapshot_load'):
+            load_features(snapshot)
+
+    # stages as a real diff runs them, with mappings growing and matched classes kept as anchors
+    with Profile() as profile, _timer(results, 'diff'):
+        mapping, _ = ClassesDiffer().diff(old_classes, new_classes)
+    results['stages'] = profile.diffs[0]['stages']
+    results['accuracy'] = accuracy(mapping, truth)
+
+    with Profile() as profile, _timer(results, 'fuzzy_diff'):
+        mapping, _ = ClassesDiffer(fuzzy_matcher=FuzzyMatcher()).diff(old_classes, new_classes)
+    results['fuzzy_stages'] = profile.diffs[0]['stages']
+    results['fuzzy_accuracy'] = accuracy(mapping, truth)
+
+    if memory:
+        results['diff_peak_memory'] = _peak_memory(ClassesDiffer().diff, old_classes, new_classes)
+
+    return results
+
+
+def bench_parsing(scale, seed=0, classes_per_dex=4000):
+    old_classes = generate_classes(scale, seed)
+    new_classes, truth = mutate(old_classes, seed + 1)
+    results = {'classes': scale}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        old_dex, new_dex, old_apk = (Path(tmp_dir) / name for name in ('old.dex', 'new.dex', 'old.apk'))
+        old_dex.write_bytes(write_dex(old_classes))
+        new_dex.write_bytes(write_dex(new_classes))
+        old_apk.write_bytes(write_apk(old_classes, classes_per_dex))
+        results['dex_size'] = old_dex.stat().st_size
+
+        with _timer(results, 'dex_parse'):
+            DexDiffer().extract_features(str(old_dex))
+        with _timer(results, 'apk_parse'):
+            APKDiffer(workers=1).extract_features(str(old_apk))
+        with _timer(results, 'apk_parallel_parse'):
+            APKDiffer().extract_features(str(old_apk))
+
+        # parsing both files and diffing them, as `apocalypse map --file` does
+        with _timer(results, 'dex_diff'):
+            mapping, _ = DexDiffer().diff(str(old_dex), str(new_dex))
+        results['accuracy'] = accuracy(mapping, truth)
+
+    return results
+
+
+def bench_timeline(version_count, scale, seed=0, queries=50, classes_per_dex=4000):
+    results = {'versions': version_count, 'classes': scale}
+    rng = random.Random(seed)
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            versions = [f'1.{i}' for i in range(version_count)]
+            classes = generate_classes(scale, seed)
+            for i, version in enumerate(versions):
+                if i:
+                    classes, _ = mutate(classes, seed + i)
+                Path(f'{version}.apk').write_bytes(write_apk(classes, classes_per_dex))
+
+            timeline.init('timeline', 'APK')
+            os.chdir('timeline')
+
+            # versions are inserted as `apocalypse insert` does, parsing and diffing against their neighbors
+            with _timer(results, 'ingest'):
+                for version in versions:
+                    timeline.insert_version(version, Path(tmp_dir) / f'{version}.apk')
+
+            with _timer(results, 'map_first_query'):
+                timeline.map(versions[0], versions[-1])
+            with _timer(results, 'map_repeated_query'):
+                timeline.map(versions[0], versions[-1])
+
+            first_classes = list(json.loads(timeline.map(versions[0], versions[1])))
+            sample = rng.sample(first_classes, min(queries, len(first_classes)))
+            with _timer(results, 'until'):
+                for class_name in sample:
+                    timeline.until(versions[0], class_name)
+            with _timer(results, 'since'):
+                for class_name in sample:
+                    timeline.since(versions[0], class_name)
+            results['queries'] = len(sample)
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--versions', type=int, nargs='+', default=[5, 20])
+    parser.add_argument('--timeline-scale', type=int, default=2000)
+    parser.add_argument('--classes-per-dex', type=int, default=4000, help='classes of every dex file of generated apks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='skip the (slower) traced peak memory runs')
+    parser.add_argument('--json', metavar='PATH', help='also write the results as JSON')
+    args = parser.parse_args()
+
+    results = {'parsing': [], 'differ': [], 'timeline': []}
+
+    for scale in args.scales:
+        result = bench_parsing(scale, args.seed, args.classes_per_dex)
+        results['parsing'].append(result)
+        print(f"{scale:>7} classes: dex of {result['dex_size'] / 2 ** 20:.1f} MiB parsed in {result['dex_parse']:.2f}s, "
+              f"apk in {result['apk_parse']:.2f}s ({result['apk_parallel_parse']:.2f}s in parallel), "
+              f"dex diff {result['dex_diff']:.2f}s recall {result['accuracy']['recall']:.3f}")
+
+    for scale in args.scales:
+        result = bench_differ(scale, args.seed, not args.no_memory)
+        results['differ'].append(result)
+        stages = ', '.join(f"{stage['precision']} {stage['encoding']:.2f}s+{stage['heckel']:.2f}s ({stage['mappings']})"
+                           for stage in result['stages'])
+        memory = f", peak {result['diff_peak_memory'] / 2 ** 20:.0f} MiB" if 'diff_peak_memory' in result else ''
+        print(f"{scale:>7} classes: diff {result['diff']:.2f}s{memory}, "
+              f"recall {result['accuracy']['recall']:.3f}, precision {result['accuracy']['precision']:.3f}, "
+              f"fuzzy {result['fuzzy_diff']:.2f}s recall {result['fuzzy_accuracy']['recall']:.3f} "
+              f"precision {result['fuzzy_accuracy']['precision']:.3f} "
+              f"[{stages}] snapshot load {result['snapshot_load']:.2f}s")
+
+    for version_count in args.versions:
+        result = bench_timeline(version_count, args.timeline_scale, args.seed, classes_per_dex=args.classes_per_dex)
+        results['timeline'].append(result)
+        print(f"{version_count:>4} versions: ingest {result['ingest']:.2f}s, map {result['map_first_query']:.3f}s "
+              f"then {result['map_repeated_query']:.3f}s, until {result['until']:.3f}s, since {result['since']:.3f}s "
+              f"for {result['queries']} queries")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
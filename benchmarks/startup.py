@@ -0,0 +1,104 @@
+"""Startup time of the query-only CLI commands, which scripts call in tight loops.
+
+    python -m benchmarks.startup --runs 20 --max-seconds 0.5
+
+Each command runs in a fresh interpreter against a small synthetic timeline. The run fails
+if a command is slower than --max-seconds on median, or if any of them loads the diffing
+stack (lief, numpy), which only commands that actually diff should pay for.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import apocalypse.timeline as timeline
+from apocalypse.features import save_features
+
+from benchmarks.corpus import generate_classes, mutate
+
+
+HEAVY_MODULES = ['lief', 'numpy', 'apocalypse.classes_differ']
+
+# imports the cli module the way the console script does, then reports the loaded heavy modules
+IMPORT_PROBE = f'''
+import json
+import sys
+import apocalypse.cli
+print(json.dumps([module for module in {HEAVY_MODULES!r} if module in sys.modules]))
+'''
+
+
+def _build_timeline(root, version_count=5, scale=200):
+    timeline.init(root, 'DEX')
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        classes = generate_classes(scale)
+        versions = [f'1.{i}' for i in range(version_count)]
+        for i, version in enumerate(versions):
+            if i:
+                classes, _ = mutate(classes, i)
+            (Path(timeline.SOURCES_FOLDER) / version).touch()
+            save_features(classes, Path(timeline.FEATURES_FOLDER) / version)
+        for version in versions:
+            timeline._update_skip_maps(version)
+        timeline._rebuild_lineage_index()
+
+        class_name = next(iter(json.loads(timeline.map(versions[0], versions[1]))))
+    finally:
+        os.chdir(cwd)
+    return versions, class_name
+
+
+def _median_time(command, runs, cwd=None):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-seconds', type=float, default=None, help='fail when a command is slower on median')
+    args = parser.parse_args()
+
+    probe = subprocess.run([sys.executable, '-c', IMPORT_PROBE], check=True, capture_output=True, text=True)
+    loaded = json.loads(probe.stdout)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir) / 'timeline'
+        versions, class_name = _build_timeline(str(root))
+
+        baseline = _median_time([sys.executable, '-c', 'pass'], args.runs)
+        print(f'interpreter: {baseline:.3f}s')
+
+        failed = False
+        commands = {
+            'versions': ['versions'],
+            'until': ['until', versions[0], class_name],
+            'since': ['since', versions[-1], class_name],
+            'map': ['map', versions[0], versions[-1]],
+        }
+        for name, command in commands.items():
+            median = _median_time([sys.executable, '-m', 'apocalypse.cli'] + command, args.runs, root)
+            slow = args.max_seconds is not None and median > args.max_seconds
+            failed |= slow
+            print(f"{name:>9}: {median:.3f}s{' (over budget)' if slow else ''}")
+
+    if loaded:
+        print(f"importing the cli loads {', '.join(loaded)}")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,9 @@ setup(
         'lief',
         'click'
     ],
+    extras_require={
+        'fast': ['numpy']
+    },
     entry_points='''
         [console_scripts]
         apocalypse=apocalypse.cli:main
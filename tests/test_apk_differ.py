@@ -0,0 +1,131 @@
+import mmap
+import os
+import pickle
+import sys
+import threading
+import time
+import zipfile
+from types import SimpleNamespace
+
+import lief.DEX
+import pytest
+
+from apocalypse.apk_differ import APKDiffer, DEX_MEMORY_FACTOR
+from apocalypse.features import ClassFeatures, MethodFeatures
+
+
+MB = 1 << 20
+DEX_SIZE = 2 * MB
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='memory is sampled through /proc')
+
+
+def parse_with_memory(data):
+    # takes the memory estimated for a dex of this size, for long enough to be sampled, 
+    # mapped directly so that it is given back to the system right after
+    with mmap.mmap(-1, DEX_MEMORY_FACTOR * len(data)) as memory:
+        for offset in range(0, len(memory), mmap.PAGESIZE):
+            memory[offset] = 1
+        time.sleep(0.3)
+    return SimpleNamespace(classes=pickle.loads(data))
+
+
+def write_apk(path, dex_count, seed):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for i in range(dex_count):
+            classes = [ClassFeatures(f'La/c{seed}_{i};', 'a', 0, 1, None, None, [MethodFeatures('a', [], 'VOID_T', 1, 2, 0)])]
+            # pickle ignores the padding after its data, which gives the dex its size
+            data = pickle.dumps(classes)
+            z.writestr('classes' + ('' if i == 0 else str(i + 1)) + '.dex', data + bytes(DEX_SIZE - len(data)))
+
+
+def _rss(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        return None
+
+
+def _children(pid):
+    children = []
+    for task in os.listdir(f'/proc/{pid}/task'):
+        try:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            pass
+    return children
+
+
+class ChildrenMemorySampler:
+    """Samples the memory the child processes took on top of their size at start, summed. 
+    """
+
+    def __init__(self):
+        self.peak = 0
+        self._baselines = {}
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._done.wait(0.01):
+            total = 0
+            for pid in _children(os.getpid()):
+                rss = _rss(pid)
+                if rss is None:
+                    continue
+                baseline = self._baselines[pid] = min(self._baselines.get(pid, rss), rss)
+                total += rss - baseline
+            self.peak = max(self.peak, total)
+
+
+@pytest.fixture
+def apks(tmp_path, monkeypatch):
+    monkeypatch.setattr(lief.DEX, 'parse', parse_with_memory)
+    write_apk(tmp_path / 'old.apk', 6, 0)
+    write_apk(tmp_path / 'new.apk', 6, 1)
+    return str(tmp_path / 'old.apk'), str(tmp_path / 'new.apk')
+
+
+def test_memory_budget_bounds_peak_memory_of_parsing(apks):
+    dex_memory = DEX_MEMORY_FACTOR * DEX_SIZE
+    budget = 2 * dex_memory
+
+    with ChildrenMemorySampler() as bounded:
+        APKDiffer(workers=4, memory_budget=budget).diff(*apks)
+    with ChildrenMemorySampler() as unbounded:
+        APKDiffer(workers=4).diff(*apks)
+
+    # the slack covers reading the dex files and their features, which the estimate leaves out
+    assert bounded.peak <= budget + dex_memory
+    # the check can tell: without a budget the four workers parse at once
+    assert unbounded.peak > budget + dex_memory
+
+
+def _signatures(classes):
+    return [(cls.fullname, cls.parent, sorted((method.name, method.parameters_type, method.return_type) for method in cls.methods))
+            for cls in classes if cls.index != 4294967295]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_extract_features_parses_generated_apks(tmp_path, workers):
+    from benchmarks.corpus import generate_classes
+    from benchmarks.dex import write_apk
+
+    classes = generate_classes(300)
+    apk = write_apk(classes, 100)
+    (tmp_path / 'app.apk').write_bytes(apk)
+
+    for source in (apk, str(tmp_path / 'app.apk')):
+        assert _signatures(APKDiffer(workers=workers).extract_features(source)) == _signatures(classes)
@@ -0,0 +1,74 @@
+import itertools
+import json
+from pathlib import Path
+
+import pytest
+
+import apocalypse.timeline as timeline
+
+from benchmarks.corpus import generate_classes, mutate
+from benchmarks.dex import write_apk
+
+
+def write_apks(root, count=4):
+    """Write apks of successive builds, whose first two dex files never change.
+    """
+    classes = generate_classes(300)
+    unchanged, changed = classes[:200], classes[200:]
+    paths = []
+    for i in range(count):
+        if i:
+            changed, _ = mutate(changed, i)
+        path = Path(root) / f'{i}.apk'
+        path.write_bytes(write_apk(unchanged + changed, 100))
+        paths.append(path)
+    return paths
+
+
+def all_maps():
+    return {(a, b): json.loads(timeline.map(a, b)) for a, b in itertools.permutations(timeline.versions(), 2)}
+
+
+@pytest.mark.parametrize('many', [False, True])
+def test_blobs_layout_stores_entries_once_and_maps_as_files(tmp_path, monkeypatch, many):
+    paths = write_apks(tmp_path)
+    entries = [(f'1.{i}', path) for i, path in enumerate(paths)]
+
+    for sources in timeline.SOURCE_LAYOUTS:
+        timeline.init(tmp_path / sources, 'APK', sources=sources)
+        monkeypatch.chdir(tmp_path / sources)
+        if many:
+            timeline.insert_versions(entries, workers=2)
+        else:
+            for version, path in entries:
+                timeline.insert_version(version, path)
+    expected = all_maps()
+
+    monkeypatch.chdir(tmp_path / 'blobs')
+    assert all_maps() == expected
+
+    manifests = {version: timeline._read_manifest(version) for version in timeline.versions()}
+    assert all(digest for manifest in manifests.values() for _, digest in manifest['entries'])
+    # the unchanged dex files are stored, and their features extracted, once for all versions
+    digests = set(digest for manifest in manifests.values() for _, digest in manifest['entries'])
+    assert len(digests) == 2 + len(entries)
+    assert set(path.name for path in Path(timeline.BLOBS_FOLDER).glob('*/*')) == digests
+    assert set(path.name for path in Path(timeline.DEX_FEATURES_FOLDER).iterdir()) == digests
+    assert [timeline._dex_digests(manifest)[:2] for manifest in manifests.values()] == \
+        [timeline._dex_digests(manifests['1.0'])[:2]] * len(entries)
+
+
+def test_blobs_survive_replacing_a_version(tmp_path, monkeypatch):
+    paths = write_apks(tmp_path, 3)
+    timeline.init(tmp_path / 'timeline', 'APK', sources='blobs')
+    monkeypatch.chdir(tmp_path / 'timeline')
+    for i, path in enumerate(paths):
+        timeline.insert_version(f'1.{i}', path)
+
+    # the first version now holds the build of the last one
+    timeline.insert_version('1.0', paths[-1], force=True)
+
+    assert timeline._read_manifest('1.0') == timeline._read_manifest('1.2')
+    # identical builds map every class to itself
+    mapping = json.loads(timeline.map('1.0', '1.2'))
+    assert mapping and all(class_name == mapped_name for class_name, mapped_name in mapping.items())
@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from apocalypse.classes_differ import ClassesDiffer
+from apocalypse.encoder import DefaultEncoder
+from apocalypse.features import ClassFeatures, MethodFeatures
+from apocalypse.heckel_diff import diff as heckel_diff
+
+
+def keep_all(cls):
+    return True
+
+
+def reference_diff(old_classes, new_classes):
+    # the stages as first written: every class is encoded and diffed at every stage
+    encoder = DefaultEncoder()
+    mapping = {}
+    successful_mappings = -1
+    for precision in encoder.get_stages():
+        old_encoding = [encoder.encode_old_class(cls, precision) for cls in old_classes]
+        new_encoding = [encoder.encode_new_class(cls, precision) for cls in new_classes]
+        lines, reverse_lines = heckel_diff(old_encoding, new_encoding)
+        mapping = {old_classes[i].fullname: new_classes[lines[i]].fullname for i in lines}
+        reverse_mapping = {new_classes[i].fullname: old_classes[reverse_lines[i]].fullname for i in reverse_lines}
+        encoder.set_mapping(mapping, reverse_mapping)
+        if len(mapping) == successful_mappings:
+            break
+        successful_mappings = len(mapping)
+    return mapping
+
+
+def renamed_corpus(count, seed):
+    """Classes of a few colliding shapes, all renamed, a fifth of them with a small bytecode change,
+    so most can only be matched next to an already matched neighbour.
+    """
+    rng = random.Random(seed)
+    old_classes, new_classes = [], []
+    for i in range(count):
+        shape = [(rng.choice(['a', 'b', '<init>']), rng.choice([0, 2, 4]), rng.randrange(3)) for _ in range(rng.randint(1, 2))]
+        edited = rng.random() < 0.2
+        for classes, name in ((old_classes, f'La/o{i};'), (new_classes, f'La/n{i};')):
+            methods = [MethodFeatures(method, [], 'VOID_T', 1, length, first if length else None) for method, length, first in shape]
+            if edited and classes is new_classes:
+                methods[0].bytecode_length += 1
+                methods[0].bytecode_first = 7
+            classes.append(ClassFeatures(name, 'a', i, 1, 'Ljava/lang/Object;', 'java.lang', methods))
+    return old_classes, new_classes
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_reference_stages(seed):
+    old_classes, new_classes = renamed_corpus(500, seed)
+
+    mapping, reverse_mapping = ClassesDiffer(keep_all).diff(old_classes, new_classes)
+
+    assert mapping == reference_diff(old_classes, new_classes)
+    assert reverse_mapping == {new: old for old, new in mapping.items()}
+
+
+def test_sharded_encoding_matches_in_process():
+    old_classes, new_classes = renamed_corpus(300, 0)
+
+    assert ClassesDiffer(keep_all, encoding_workers=2).diff(old_classes, new_classes) == \
+        ClassesDiffer(keep_all).diff(old_classes, new_classes)
+
+
+def _class(name, package, index, bytecode_length=2):
+    return ClassFeatures(name, package, index, 1, 'Ljava/lang/Object;', 'java.lang',
+                         [MethodFeatures('a', [], 'VOID_T', 1, bytecode_length, 0)])
+
+
+def test_pinned_classes_anchor_their_neighbours():
+    # the renamed classes all collide, so only their position next to the pinned class tells them apart
+    old_classes = [_class('La/p;', 'a', 0, 10), _class('La/o1;', 'a', 1), _class('La/o2;', 'a', 2)]
+    new_classes = [_class('La/p;', 'a', 0, 20), _class('La/n1;', 'a', 1), _class('La/n2;', 'a', 2)]
+
+    mapping, _ = ClassesDiffer(keep_all).diff(old_classes, new_classes, {'La/p;': 'La/p;'})
+
+    assert mapping == {'La/p;': 'La/p;', 'La/o1;': 'La/n1;', 'La/o2;': 'La/n2;'}
+
+
+def test_identical_classes_are_only_pinned_under_their_name():
+    old_classes = [_class('Lcom/example/Old;', 'com.example', 0), _class('La/b;', 'a', 1, 10)]
+    new_classes = [_class('Lcom/example/New;', 'com.example', 0), _class('La/b;', 'a', 1, 10)]
+
+    mapping, _ = ClassesDiffer(keep_all).diff(old_classes, new_classes)
+
+    assert mapping == reference_diff(old_classes, new_classes) == {'La/b;': 'La/b;'}
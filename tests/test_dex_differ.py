@@ -0,0 +1,15 @@
+from apocalypse.dex_differ import DexDiffer
+
+from benchmarks.corpus import generate_classes, mutate
+from benchmarks.dex import write_dex
+
+
+def test_diff_parses_generated_dex_files(tmp_path):
+    old_classes = generate_classes(300)
+    new_classes, truth = mutate(old_classes, 1)
+    (tmp_path / 'old.dex').write_bytes(write_dex(old_classes))
+
+    mapping, _ = DexDiffer().diff(str(tmp_path / 'old.dex'), write_dex(new_classes))
+
+    assert sum(1 for old, new in mapping.items() if truth.get(old) == new) > 0.9 * len(truth)
+    assert all(truth.get(old) == new for old, new in mapping.items())
@@ -0,0 +1,90 @@
+import functools
+import os
+import pickle
+from pathlib import Path
+from types import SimpleNamespace
+
+import lief.DEX
+
+from apocalypse.classes_differ import ClassesDiffer
+from apocalypse.dex_differ import DexDiffer
+from apocalypse.diff_cache import DiffCache
+from apocalypse.encoder import DefaultEncoder
+from apocalypse.features import ClassFeatures, MethodFeatures
+
+
+def make_filter(prefix):
+    return lambda cls: cls.fullname.startswith(prefix)
+
+
+def test_configuration_tells_captured_values_apart():
+    assert ClassesDiffer(make_filter('Lcom/')).configuration() != ClassesDiffer(make_filter('Lorg/')).configuration()
+    assert ClassesDiffer(make_filter('Lcom/')).configuration() == ClassesDiffer(make_filter('Lcom/')).configuration()
+
+
+def test_configuration_tells_defaults_apart():
+    def keep(cls, prefix='Lcom/'):
+        return cls.fullname.startswith(prefix)
+    com = ClassesDiffer(keep).configuration()
+    keep.__defaults__ = ('Lorg/',)
+
+    assert ClassesDiffer(keep).configuration() != com
+
+
+def test_configuration_tells_read_attributes_apart():
+    by_name = ClassesDiffer(lambda cls: cls.fullname.startswith('La')).configuration()
+    by_package = ClassesDiffer(lambda cls: cls.package_name.startswith('La')).configuration()
+
+    assert by_name != by_package
+
+
+def test_diffs_are_cached_per_filter(tmp_path, monkeypatch):
+    monkeypatch.setattr(lief.DEX, 'parse', lambda data: SimpleNamespace(classes=pickle.loads(data)))
+    dex = pickle.dumps([ClassFeatures('La/b;', 'x', 0, 1, None, None, [MethodFeatures('a', [], 'VOID_T', 1, 2, 0)])])
+    cache = DiffCache(tmp_path)
+
+    by_name, _ = DexDiffer(class_filtering_function=lambda cls: cls.fullname.startswith('La'), cache=cache).diff(dex, dex)
+    by_package, _ = DexDiffer(class_filtering_function=lambda cls: cls.package_name.startswith('La'), cache=cache).diff(dex, dex)
+
+    assert by_name == {'La/b;': 'La/b;'}
+    assert by_package == {}
+
+
+def test_configuration_describes_partials():
+    debug = ClassesDiffer(encoder=functools.partial(DefaultEncoder, debug=True)).configuration()
+
+    assert debug is not None
+    assert debug != ClassesDiffer(encoder=functools.partial(DefaultEncoder, debug=False)).configuration()
+
+
+class KeepAll:
+    def __call__(self, cls):
+        return True
+
+
+def test_configuration_refuses_unknown_callables():
+    assert ClassesDiffer(KeepAll()).configuration() is None
+    assert ClassesDiffer(make_filter(object())).configuration() is None
+
+
+def test_diffs_are_not_cached_without_configuration(tmp_path, monkeypatch):
+    monkeypatch.setattr(lief.DEX, 'parse', lambda data: SimpleNamespace(classes=pickle.loads(data)))
+    dex = pickle.dumps([ClassFeatures('La/b;', 'a', 0, 1, None, None, [MethodFeatures('a', [], 'VOID_T', 1, 2, 0)])])
+
+    mapping, _ = DexDiffer(class_filtering_function=KeepAll(), cache=DiffCache(tmp_path)).diff(dex, dex)
+
+    assert mapping == {'La/b;': 'La/b;'}
+    assert not any(tmp_path.iterdir())
+
+
+def test_hits_survive_concurrent_eviction(tmp_path, monkeypatch):
+    cache = DiffCache(tmp_path)
+    key = cache.key(b'old', b'new', 'configuration')
+    cache.put(key, ({'La;': 'Lb;'}, {'Lb;': 'La;'}))
+
+    def evicted(path):
+        Path(path).unlink()
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(os, 'utime', evicted)
+
+    assert cache.get(key) == ({'La;': 'Lb;'}, {'Lb;': 'La;'})
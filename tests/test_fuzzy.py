@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from click.testing import CliRunner
+
+# imported up front, as it enables faulthandler on the real stderr, which the runner replaces
+import apocalypse.apk_differ  # noqa: F401
+import apocalypse.fuzzy as fuzzy
+from apocalypse.cli import main
+from apocalypse.features import ClassFeatures, MethodFeatures
+from apocalypse.fuzzy import FuzzyMatcher
+
+from benchmarks.corpus import generate_classes, mutate
+from benchmarks.dex import write_dex
+
+
+def _class(name, package, methods):
+    return ClassFeatures(name, package, 0, 1, 'Ljava/lang/Object;', 'java.lang',
+                         [MethodFeatures(f'method{i}', ['I'], 'VOID_T', 1, length, 0) for i, length in enumerate(methods)])
+
+
+def test_matches_similar_classes_only():
+    old_classes = [_class('La/a;', 'a', range(10, 20)), _class('La/b;', 'a', range(30, 40))]
+    # the first class with one method changed, and a class unlike any other
+    new_classes = [_class('La/x;', 'a', [*range(10, 19), 99]), _class('La/y;', 'a', range(50, 60))]
+
+    assert FuzzyMatcher().match(old_classes, new_classes, {}) == {0: 0}
+    assert FuzzyMatcher(threshold=1.0).match(old_classes, new_classes, {}) == {}
+
+
+def test_leaves_ambiguous_classes_unmatched():
+    old_classes = [_class('La/a;', 'a', range(10, 20))]
+    new_classes = [_class('La/x;', 'a', range(10, 20)), _class('La/y;', 'a', range(10, 20))]
+
+    assert FuzzyMatcher().match(old_classes, new_classes, {}) == {}
+    assert FuzzyMatcher().match(old_classes, new_classes[:1], {}) == {0: 0}
+
+
+def test_matches_within_the_same_package():
+    old_classes = [_class('La/a;', 'a', range(10, 20))]
+    new_classes = [_class('Lb/a;', 'b', range(10, 20))]
+
+    assert FuzzyMatcher().match(old_classes, new_classes, {}) == {}
+
+
+def test_signatures_do_not_depend_on_numpy(monkeypatch):
+    if fuzzy.np is None:
+        pytest.skip('numpy is not installed')
+    shingles = [fuzzy._shingles(cls, {}, set()) for cls in generate_classes(50)] + [frozenset()]
+    matcher = FuzzyMatcher()
+    expected = matcher._signatures(shingles)
+
+    monkeypatch.setattr(fuzzy, 'np', None)
+
+    assert matcher._signatures(shingles) == expected
+
+
+def test_map_matches_fuzzily_when_asked(tmp_path):
+    old_classes = generate_classes(500)
+    new_classes, truth = mutate(old_classes, 1, renames=0.6, api_edits=0.3)
+    (tmp_path / 'old.dex').write_bytes(write_dex(old_classes))
+    (tmp_path / 'new.dex').write_bytes(write_dex(new_classes))
+
+    def map_files(*options):
+        result = CliRunner().invoke(main, ['map', '--file', str(tmp_path / 'old.dex'), str(tmp_path / 'new.dex'), *options])
+        assert result.exit_code == 0, result.output
+        return json.loads(result.output)
+
+    exact = map_files()
+    fuzzy = map_files('--fuzzy')
+
+    assert exact.items() <= fuzzy.items()
+    assert len(fuzzy) > len(exact)
+    assert all(truth.get(old) == new for old, new in fuzzy.items())
@@ -0,0 +1,43 @@
+import random
+
+import pytest
+
+from apocalypse.heckel_diff import diff, vectorized_diff, np
+
+
+pytestmark = pytest.mark.skipif(np is None, reason='numpy is not installed')
+
+
+def random_sequences(rng, length=60):
+    # few symbols, so most collide and matches mostly come from extending neighbours
+    alphabet = [rng.randrange(1 << 64).to_bytes(16, 'little') for _ in range(rng.randint(1, 12))]
+    old = [rng.choice(alphabet) for _ in range(rng.randint(0, length))]
+    new = list(old)
+    for _ in range(rng.randint(0, length // 6)):
+        roll = rng.random()
+        if roll < 0.3 and new:
+            new.pop(rng.randrange(len(new)))
+        elif roll < 0.6:
+            new.insert(rng.randint(0, len(new)), rng.choice(alphabet))
+        elif new:
+            new[rng.randrange(len(new))] = rng.randrange(1 << 64).to_bytes(16, 'little')
+    return old, new
+
+
+@pytest.mark.parametrize('seed', range(500))
+def test_vectorized_diff_matches_diff(seed):
+    old, new = random_sequences(random.Random(seed))
+
+    assert vectorized_diff(old, new) == diff(old, new)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_vectorized_diff_matches_diff_on_long_sequences(seed):
+    old, new = random_sequences(random.Random(seed), 3000)
+
+    assert vectorized_diff(old, new) == diff(old, new)
+
+
+@pytest.mark.parametrize('old, new', [([], []), ([b'a'], []), ([], [b'a']), ([b'a'] * 5, [b'a'] * 5), ([b'a', b'b'], [b'b', b'a'])])
+def test_vectorized_diff_matches_diff_on_edge_cases(old, new):
+    assert vectorized_diff(old, new) == diff(old, new)
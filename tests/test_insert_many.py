@@ -0,0 +1,64 @@
+import itertools
+import json
+from pathlib import Path
+
+import pytest
+
+import apocalypse.timeline as timeline
+
+from test_lineage import write_versions
+
+
+class Interrupted(Exception):
+    pass
+
+
+def all_maps():
+    return {(a, b): json.loads(timeline.map(a, b)) for a, b in itertools.permutations(timeline.versions(), 2)}
+
+
+def test_interrupted_insertion_resumes_where_it_stopped(tmp_path, monkeypatch):
+    paths = write_versions(tmp_path, 5)
+    entries = [(f'1.{i}', path) for i, path in enumerate(paths)]
+
+    timeline.init(tmp_path / 'expected', 'DEX')
+    monkeypatch.chdir(tmp_path / 'expected')
+    timeline.insert_versions(entries, workers=2)
+    expected = all_maps()
+
+    timeline.init(tmp_path / 'timeline', 'DEX')
+    monkeypatch.chdir(tmp_path / 'timeline')
+
+    def interrupt(done, total):
+        if done == 2:
+            raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        timeline.insert_versions(entries, workers=2, progress=interrupt)
+    checkpoint = timeline._read_checkpoint()
+    assert len(checkpoint['copied']) == len(entries)
+    assert len(checkpoint['done']) == 2
+
+    # another insertion is refused while this one is pending
+    timeline.insert_versions(entries[:2], workers=2)
+    assert timeline._read_checkpoint() == checkpoint
+
+    calls = []
+    timeline.insert_versions(entries, workers=2, progress=lambda done, total: calls.append((done, total)))
+
+    # only the pairs left were diffed
+    assert calls[0] == (3, 4) and calls[-1] == (4, 4)
+    assert not Path(timeline.CHECKPOINT_FILE).exists()
+    assert all_maps() == expected
+
+
+def test_insertion_refuses_existing_versions(tmp_path, monkeypatch):
+    paths = write_versions(tmp_path, 3)
+    timeline.init(tmp_path / 'timeline', 'DEX')
+    monkeypatch.chdir(tmp_path / 'timeline')
+    timeline.insert_version('1.1', paths[1])
+
+    timeline.insert_versions([('1.0', paths[0]), ('1.1', paths[2])])
+
+    assert timeline.versions() == ['1.1']
+    assert not Path(timeline.CHECKPOINT_FILE).exists()
@@ -0,0 +1,34 @@
+import itertools
+import json
+
+import pytest
+
+import apocalypse.timeline as timeline
+
+from test_timeline import build_timeline
+
+
+def test_filter_package_keeps_the_package_and_its_subpackages():
+    pairs = [('La/b/C;', 'La/b/C;'), ('La/b/c/D;', 'La/b/c/E;'), ('La/bc/F;', 'La/bc/F;'), ('La/G;', 'La/G;')]
+
+    assert list(timeline.filter_package(pairs, 'a.b')) == pairs[:2]
+    assert list(timeline.filter_package(pairs, 'a')) == pairs
+    assert list(timeline.filter_package(pairs, 'a.b.c')) == pairs[1:2]
+    assert list(timeline.filter_package(pairs)) == pairs
+
+
+@pytest.mark.parametrize('package', [None, 'androidx', 'androidx.core.view', 'm'])
+@pytest.mark.parametrize('range_cache_size', [0, 2**20])
+def test_iter_map_yields_the_pairs_of_map(tmp_path, monkeypatch, package, range_cache_size):
+    versions = build_timeline(tmp_path / 'timeline', 8, range_cache_size=range_cache_size)
+    monkeypatch.chdir(tmp_path / 'timeline')
+
+    # twice, the second time from the range cache when there is one
+    for _ in range(2):
+        for version_from, version_to in itertools.permutations(versions, 2):
+            pairs = list(timeline.iter_map(version_from, version_to, package))
+            assert dict(pairs) == json.loads(timeline.map(version_from, version_to, package))
+            assert len(pairs) == len(dict(pairs))
+            if package is not None:
+                prefix = 'L' + package.replace('.', '/') + '/'
+                assert pairs and all(class_name.startswith(prefix) for class_name, _ in pairs)
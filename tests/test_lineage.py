@@ -0,0 +1,74 @@
+from pathlib import Path
+
+import apocalypse.timeline as timeline
+from apocalypse.classes_differ import ClassesDiffer
+from apocalypse.features import load_features
+
+from benchmarks.corpus import generate_classes, mutate
+from benchmarks.dex import write_dex
+
+
+def write_versions(root, count=4):
+    """Write dex files of successive builds, with classes removed and added along the way.
+    """
+    classes = generate_classes(200)
+    paths = []
+    for i in range(count):
+        if i:
+            classes, _ = mutate(classes, i, removals=0.05, additions=0.05)
+        path = Path(root) / f'{i}.dex'
+        path.write_bytes(write_dex(classes))
+        paths.append(path)
+    return paths
+
+
+def class_names(version):
+    features = load_features(Path(timeline.FEATURES_FOLDER) / version)
+    return sorted(cls.fullname for cls in features if ClassesDiffer.filter_class(cls))
+
+
+def test_lifetimes_cover_every_class_of_every_version(tmp_path, monkeypatch):
+    paths = write_versions(tmp_path)
+    timeline.init(tmp_path / 'timeline', 'DEX')
+    monkeypatch.chdir(tmp_path / 'timeline')
+    # the third version lands between two others, updating the index in place
+    for i in (0, 1, 3, 2):
+        timeline.insert_version(f'1.{i}', paths[i])
+
+    rows = list(timeline.lifetimes())
+
+    for version in timeline.versions():
+        assert sorted(names[version] for _, _, names in rows if version in names) == class_names(version)
+    # classes mapped to no neighbor are chains of their own version alone
+    assert any(first == last for first, last, _ in rows)
+
+
+def lineage():
+    return sorted((first, last, sorted(names.items())) for first, last, names in timeline.lifetimes())
+
+
+def chains(version):
+    return {name: (timeline.since(version, name), timeline.until(version, name)) for name in class_names(version)}
+
+
+def test_index_updated_in_place_matches_a_rebuilt_one(tmp_path, monkeypatch):
+    paths = write_versions(tmp_path, 6)
+    timeline.init(tmp_path / 'timeline', 'DEX')
+    monkeypatch.chdir(tmp_path / 'timeline')
+    for i in (0, 2, 4, 5):
+        timeline.insert_version(f'1.{i}', paths[i])
+    # inserted between others, splitting and merging the chains over them
+    timeline.insert_version('1.1', paths[1])
+    timeline.insert_version('1.3', paths[3])
+    # replaced by the build of another version
+    timeline.insert_version('1.4', paths[1], force=True)
+
+    updated = lineage()
+    updated_chains = {version: chains(version) for version in timeline.versions()}
+
+    timeline._rebuild_lineage_index()
+    assert lineage() == updated
+
+    # and both answer as the maps themselves do
+    Path(timeline.LINEAGE_FILE).unlink()
+    assert {version: chains(version) for version in timeline.versions()} == updated_chains
@@ -0,0 +1,65 @@
+import itertools
+import shutil
+from pathlib import Path
+
+import pytest
+
+import apocalypse.timeline as timeline
+from apocalypse.features import load_features
+from apocalypse.version import StrictVersion
+
+from benchmarks.dex import write_dex
+from test_timeline import build_timeline
+
+
+def all_maps():
+    return {(a, b): timeline.map(a, b) for a, b in itertools.permutations(timeline.versions(), 2)}
+
+
+def cached_ranges():
+    return set(tuple(path.name.split('-')) for path in Path(timeline.RANGE_CACHE_FOLDER).iterdir())
+
+
+def covers(version_range, version):
+    lower_version, upper_version = sorted(version_range, key=StrictVersion)
+    return StrictVersion(lower_version) <= StrictVersion(version) <= StrictVersion(upper_version)
+
+
+def write_half(root, version, path):
+    # a build keeping half the classes of `version`, which every range over it must drop
+    classes = load_features(Path(root) / timeline.FEATURES_FOLDER / version)
+    path.write_bytes(write_dex(classes[::2]))
+    return path
+
+
+@pytest.mark.parametrize('version, force', [('1.2.1', False), ('1.3', True)])
+def test_insert_drops_the_ranges_over_the_version(tmp_path, monkeypatch, version, force):
+    versions = build_timeline(tmp_path / 'timeline', 6)
+    monkeypatch.chdir(tmp_path / 'timeline')
+    all_maps()
+    before = cached_ranges()
+    assert len(before) == len(versions) * (len(versions) - 1)
+
+    timeline.insert_version(version, write_half(tmp_path / 'timeline', versions[2], tmp_path / 'inserted.dex'), force=force)
+
+    assert cached_ranges() == set(version_range for version_range in before if not covers(version_range, version))
+    maps = all_maps()
+    # and the same maps again once computed without any cache
+    shutil.rmtree(timeline.RANGE_CACHE_FOLDER)
+    assert all_maps() == maps
+
+
+def test_cache_stays_within_its_size(tmp_path, monkeypatch):
+    versions = build_timeline(tmp_path / 'timeline', 6, range_cache_size=0)
+    monkeypatch.chdir(tmp_path / 'timeline')
+    size = max(len(result) for result in all_maps().values())
+    timeline.put_config('range_cache_size', 3 * size)
+
+    timeline.map(versions[0], versions[1])
+    for version_from, version_to in itertools.permutations(versions[1:], 2):
+        timeline.map(version_from, version_to)
+
+        assert sum(path.stat().st_size for path in Path(timeline.RANGE_CACHE_FOLDER).iterdir()) <= 3 * size
+        # kept as the most recently read range, which reading again touches
+        assert (versions[0], versions[1]) in cached_ranges()
+        timeline.map(versions[0], versions[1])
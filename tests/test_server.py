@@ -0,0 +1,67 @@
+import pickle
+import zipfile
+from types import SimpleNamespace
+
+import lief.DEX
+
+from apocalypse.apk_differ import APKDiffer
+from apocalypse.features import ClassFeatures, MethodFeatures
+from apocalypse.server import LRUCache, Server, estimate_size
+
+
+def _class(name, index):
+    return ClassFeatures(name, 'a', index, 1, 'Ljava/lang/Object;', 'java.lang',
+                         [MethodFeatures('a', [], 'VOID_T', 1, 2, 0)])
+
+
+def _write_apk(path, *dexs):
+    # dex files hold pickled features, which the patched parser reads back
+    with zipfile.ZipFile(path, 'w') as z:
+        for i, classes in enumerate(dexs):
+            z.writestr('classes' + ('' if i == 0 else str(i + 1)) + '.dex', pickle.dumps(classes))
+
+
+def test_diff_maps_identical_dex_files_as_a_local_diff(tmp_path, monkeypatch):
+    monkeypatch.setattr(lief.DEX, 'parse', lambda data: SimpleNamespace(classes=pickle.loads(data)))
+
+    # identical classes, that only the identical dex file tells apart
+    unchanged = [_class('La/x;', 0), _class('La/y;', 1), _class('La/z;', 2)]
+    _write_apk(tmp_path / 'old.apk', [_class('La/o;', 0)], unchanged)
+    _write_apk(tmp_path / 'new.apk', [_class('La/n;', 0), _class('La/m;', 1)], unchanged)
+
+    expected, _ = APKDiffer(workers=1).diff(str(tmp_path / 'old.apk'), str(tmp_path / 'new.apk'))
+    mapping = Server().diff(str(tmp_path / 'old.apk'), str(tmp_path / 'new.apk'))
+
+    assert mapping == expected
+    assert all(mapping[cls.fullname] == cls.fullname for cls in unchanged)
+
+
+def test_cache_evicts_the_least_recently_used_entries():
+    entry_size = estimate_size({'La;': 'Lb;'})
+    cache = LRUCache(3 * entry_size)
+    for key in 'abc':
+        cache.put(key, {'La;': 'Lb;'})
+
+    # read last, so kept over the others
+    cache.get('a')
+    cache.put('d', {'La;': 'Lb;'})
+
+    assert cache.get('b') is None
+    assert all(cache.get(key) is not None for key in 'acd')
+
+
+def test_cache_stays_within_its_size():
+    cache = LRUCache(1000)
+    for i in range(50):
+        cache.put(i, {f'L{j};': f'L{j};' for j in range(i % 5)})
+        assert cache._size == sum(size for _, size in cache._entries.values()) <= 1000
+
+    # replacing an entry counts only its new value
+    cache.put(49, {})
+    assert cache._size == sum(size for _, size in cache._entries.values())
+
+    # values larger than the whole cache are never kept, and evict nothing
+    kept = list(cache._entries)
+    cache.put('large', {f'L{j};': f'L{j};' for j in range(10)})
+    assert cache.get('large') is None
+    assert list(cache._entries) == kept
@@ -0,0 +1,61 @@
+import itertools
+import json
+
+import pytest
+
+import apocalypse.timeline as timeline
+from apocalypse.features import load_features
+
+from benchmarks.dex import write_dex
+from test_timeline import build_timeline
+
+
+def naive_map(all_versions, version_from, version_to):
+    # every adjacent map along the range, composed in turn
+    i, j = all_versions.index(version_from), all_versions.index(version_to)
+    step = 1 if i < j else -1
+    path = [all_versions[k] for k in range(i, j + step, step)]
+
+    mapping = timeline._load_map(path[0], path[1])
+    for version_a, version_b in zip(path[1:], path[2:]):
+        mapping = timeline._compose(mapping, timeline._load_map(version_a, version_b))
+    return mapping
+
+
+def test_skip_path_spans_the_range_in_few_steps():
+    versions = [f'1.{i}' for i in range(512)]
+
+    path = timeline._skip_path(versions)
+
+    assert path[0][0] == versions[0] and path[-1][1] == versions[-1]
+    assert all(a[1] == b[0] for a, b in zip(path, path[1:]))
+    assert len(path) <= 40
+
+
+def test_map_composes_skip_maps_as_the_adjacent_maps(tmp_path, monkeypatch):
+    versions = build_timeline(tmp_path / 'timeline', 12, range_cache_size=0)
+    monkeypatch.chdir(tmp_path / 'timeline')
+
+    for version_from, version_to in itertools.permutations(versions, 2):
+        assert json.loads(timeline.map(version_from, version_to)) == naive_map(versions, version_from, version_to)
+    assert any((tmp_path / 'timeline' / timeline.SKIPS_FOLDER).iterdir())
+
+
+@pytest.mark.parametrize('position', [1, 5, 8, 11])
+def test_insert_keeps_skip_maps_in_step(tmp_path, monkeypatch, position):
+    versions = build_timeline(tmp_path / 'timeline', 12, range_cache_size=0)
+    monkeypatch.chdir(tmp_path / 'timeline')
+    # skip maps of every span, built before the insertion
+    timeline.map(versions[0], versions[-1])
+    timeline.map(versions[-1], versions[0])
+
+    # a version keeping half the classes of its predecessor, which every span over it must drop
+    classes = load_features(tmp_path / 'timeline' / timeline.FEATURES_FOLDER / versions[position])
+    (tmp_path / 'inserted.dex').write_bytes(write_dex(classes[::2]))
+    # at the lowest level, so that the spans over it don't break there
+    version = next(f'{versions[position]}.{i}' for i in itertools.count(1) if timeline._version_level(f'{versions[position]}.{i}') == 0)
+    timeline.insert_version(version, tmp_path / 'inserted.dex')
+
+    versions = timeline.versions()
+    for version_from, version_to in itertools.permutations(versions, 2):
+        assert json.loads(timeline.map(version_from, version_to)) == naive_map(versions, version_from, version_to)
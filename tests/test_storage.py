@@ -0,0 +1,77 @@
+import itertools
+import json
+
+import pytest
+
+import apocalypse.timeline as timeline
+from apocalypse.storage import BinaryMapStore, JSONMapStore, NameTable
+
+from test_timeline import build_timeline
+
+
+def test_name_table_interns_names_once(tmp_path):
+    names = NameTable(tmp_path / 'names')
+    ids = dict(names.intern(['Lb;', 'La;']))
+
+    assert names.intern(['La;', 'Lc;'])['La;'] == ids['La;']
+
+    # a fresh table reads the interned names back, and finds them by binary search
+    reopened = NameTable(tmp_path / 'names')
+    assert len(reopened) == 3
+    assert all(reopened.id(name) == id_ for name, id_ in names.intern([]).items())
+    assert reopened.name(reopened.id('Lc;')) == 'Lc;'
+    assert reopened.id('Ld;') is None
+
+
+def test_binary_store_round_trips_maps(tmp_path):
+    store = BinaryMapStore(tmp_path / 'diffs', NameTable(tmp_path / 'names'))
+    first = {'La;': 'La;', 'Lb;': 'Lc;', 'Ld;': 'La;'}
+    second = {'Lc;': 'Lc;', 'Le;': 'Lb;'}
+
+    store.write('1.0', '1.1', first)
+    store.write('1.1', '1.2', second)
+
+    # both maps share the one name table, which grew with the second
+    store = BinaryMapStore(tmp_path / 'diffs', NameTable(tmp_path / 'names'))
+    assert store.read('1.0', '1.1') == first
+    assert store.read('1.1', '1.2') == second
+    assert store.lookup('1.0', '1.1', 'Lb;') == 'Lc;'
+    assert store.lookup('1.0', '1.1', 'La;') == 'La;'
+    # known to the table, but not mapped by this pair
+    assert store.lookup('1.0', '1.1', 'Le;') is None
+    assert store.lookup('1.0', '1.1', 'Lz;') is None
+    assert sorted(store.pairs()) == [('1.0', '1.1'), ('1.1', '1.2')]
+
+    store.remove('1.0', '1.1')
+    assert not store.exists('1.0', '1.1')
+    assert store.pairs() == [('1.1', '1.2')]
+
+
+def test_stores_ignore_each_other(tmp_path):
+    names = NameTable(tmp_path / 'names')
+    JSONMapStore(tmp_path / 'diffs').write('1.0', '1.1', {'La;': 'La;'})
+    BinaryMapStore(tmp_path / 'diffs', names).write('1.1', '1.2', {'La;': 'La;'})
+
+    assert JSONMapStore(tmp_path / 'diffs').pairs() == [('1.0', '1.1')]
+    assert BinaryMapStore(tmp_path / 'diffs', names).pairs() == [('1.1', '1.2')]
+
+
+@pytest.mark.parametrize('storage, other', [('json', 'binary'), ('binary', 'json')])
+def test_migrate_storage_keeps_the_maps(tmp_path, monkeypatch, storage, other):
+    versions = build_timeline(tmp_path / 'timeline', 6, storage=storage, range_cache_size=0)
+    monkeypatch.chdir(tmp_path / 'timeline')
+    expected = {(a, b): json.loads(timeline.map(a, b)) for a, b in itertools.permutations(versions, 2)}
+
+    timeline.migrate_storage(other)
+
+    assert timeline.get_config('storage') == other
+    assert not timeline._map_store(timeline.DIFF_FOLDER, storage).pairs()
+    assert not timeline._map_store(timeline.SKIPS_FOLDER, storage).pairs()
+    assert timeline._map_store(timeline.SKIPS_FOLDER).pairs()
+    for (a, b), mapping in expected.items():
+        assert json.loads(timeline.map(a, b)) == mapping
+
+    timeline.migrate_storage(storage)
+
+    for (a, b), mapping in expected.items():
+        assert json.loads(timeline.map(a, b)) == mapping
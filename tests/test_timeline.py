@@ -0,0 +1,206 @@
+import json
+import multiprocessing
+import pickle
+import threading
+import zipfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import lief.DEX
+import pytest
+
+import apocalypse.timeline as timeline
+from apocalypse.features import save_features
+from apocalypse.storage import FileLock
+
+from benchmarks.corpus import generate_classes, mutate
+
+
+def build_timeline(root, version_count=5, **config):
+    timeline.init(root, 'DEX', **config)
+    versions = [f'1.{i}' for i in range(version_count)]
+    classes = generate_classes(100)
+    for i, version in enumerate(versions):
+        if i:
+            classes, _ = mutate(classes, i)
+        (Path(root) / timeline.SOURCES_FOLDER / version).touch()
+        save_features(classes, Path(root) / timeline.FEATURES_FOLDER / version)
+    return versions
+
+
+def _hold_lock(path, locked, release):
+    with FileLock(path):
+        locked.set()
+        release.wait()
+
+
+def test_file_lock_does_not_wait_when_asked_not_to(tmp_path):
+    locked, release = multiprocessing.Event(), multiprocessing.Event()
+    holder = multiprocessing.Process(target=_hold_lock, args=(tmp_path / 'lock', locked, release))
+    holder.start()
+    try:
+        locked.wait()
+        lock = FileLock(tmp_path / 'lock')
+        assert not lock.acquire(blocking=False)
+    finally:
+        release.set()
+        holder.join()
+
+    assert lock.acquire(blocking=False)
+    # reentrant within the process
+    assert lock.acquire(blocking=False)
+    lock.release()
+    lock.release()
+
+
+def test_map_does_not_wait_for_writers(tmp_path, monkeypatch):
+    versions = build_timeline(tmp_path / 'timeline')
+    monkeypatch.chdir(tmp_path / 'timeline')
+
+    locked, release = multiprocessing.Event(), multiprocessing.Event()
+    holder = multiprocessing.Process(target=_hold_lock, args=(Path(timeline.LOCK_FILE).absolute(), locked, release))
+    holder.start()
+    try:
+        locked.wait()
+        results = []
+        query = threading.Thread(target=lambda: results.append(timeline.map(versions[0], versions[-1])))
+        query.start()
+        query.join(timeout=30)
+        assert not query.is_alive()
+    finally:
+        release.set()
+        holder.join()
+
+    # the derived data was left for a later query
+    assert results[0] is not None
+    assert not any(Path(timeline.RANGE_CACHE_FOLDER).glob('*'))
+
+    assert timeline.map(versions[0], versions[-1]) == results[0]
+    assert any(Path(timeline.RANGE_CACHE_FOLDER).glob('*'))
+
+
+def test_insert_parses_within_the_memory_budget(tmp_path, monkeypatch):
+    from apocalypse.apk_differ import APKDiffer
+
+    budgets = []
+    extract_dexs = APKDiffer.extract_dexs
+    def recording_extract_dexs(differ, apk):
+        budgets.append(differ._memory_budget)
+        return extract_dexs(differ, apk)
+    monkeypatch.setattr(APKDiffer, 'extract_dexs', recording_extract_dexs)
+    monkeypatch.setattr(lief.DEX, 'parse', lambda data: SimpleNamespace(classes=pickle.loads(data)))
+
+    classes = generate_classes(50)
+    with zipfile.ZipFile(tmp_path / 'app.apk', 'w') as z:
+        z.writestr('classes.dex', pickle.dumps(classes))
+
+    timeline.init(tmp_path / 'timeline', 'APK', memory_budget=64 << 20)
+    monkeypatch.chdir(tmp_path / 'timeline')
+    timeline.insert_version('1.0', tmp_path / 'app.apk')
+    timeline.insert_version('1.1', tmp_path / 'app.apk', memory_budget=32 << 20)
+
+    assert budgets == [64 << 20, 32 << 20]
+
+
+def test_insert_many_extracts_within_the_memory_budget(tmp_path, monkeypatch):
+    from test_apk_differ import ChildrenMemorySampler, DEX_SIZE, parse_with_memory, write_apk
+    from apocalypse.apk_differ import DEX_MEMORY_FACTOR
+
+    monkeypatch.setattr(lief.DEX, 'parse', parse_with_memory)
+    for seed in range(3):
+        write_apk(tmp_path / f'1.{seed}.apk', 2, seed)
+    dex_memory = DEX_MEMORY_FACTOR * DEX_SIZE
+
+    peaks = []
+    for name, memory_budget in (('bounded', dex_memory), ('unbounded', None)):
+        timeline.init(tmp_path / name, 'APK')
+        monkeypatch.chdir(tmp_path / name)
+        # versions are parsed by the pool workers themselves, so their memory is sampled there
+        with ChildrenMemorySampler() as sampler:
+            timeline.insert_versions([(f'1.{seed}', tmp_path / f'1.{seed}.apk') for seed in range(3)],
+                                     workers=3, memory_budget=memory_budget)
+        peaks.append(sampler.peak)
+
+    assert dex_memory // 2 < peaks[0] <= 2 * dex_memory < peaks[1]
+
+
+def test_insert_does_not_overwrite_a_version_inserted_meanwhile(tmp_path, monkeypatch):
+    from benchmarks.dex import write_dex
+
+    (tmp_path / 'single.dex').write_bytes(write_dex(generate_classes(50, 0)))
+    (tmp_path / 'many.dex').write_bytes(write_dex(generate_classes(50, 1)))
+    timeline.init(tmp_path / 'timeline', 'DEX')
+    monkeypatch.chdir(tmp_path / 'timeline')
+
+    # an insert-many of the same version commits while the single insert parses its file
+    source_dexs = timeline._source_dexs
+    def racing_source_dexs(*args, **kwargs):
+        monkeypatch.setattr(timeline, '_source_dexs', source_dexs)
+        timeline.insert_versions([('1.0', tmp_path / 'many.dex')], workers=1)
+        return source_dexs(*args, **kwargs)
+    monkeypatch.setattr(timeline, '_source_dexs', racing_source_dexs)
+
+    timeline.insert_version('1.0', tmp_path / 'single.dex')
+
+    assert (Path(timeline.SOURCES_FOLDER) / '1.0').read_bytes() == (tmp_path / 'many.dex').read_bytes()
+
+
+def test_resumed_insert_many_does_not_overwrite_a_version_inserted_meanwhile(tmp_path, monkeypatch):
+    from benchmarks.dex import write_dex
+
+    for name, seed in (('single', 0), ('many', 1), ('other', 2)):
+        (tmp_path / f'{name}.dex').write_bytes(write_dex(generate_classes(50, seed)))
+    timeline.init(tmp_path / 'timeline', 'DEX')
+    monkeypatch.chdir(tmp_path / 'timeline')
+    entries = [('1.0', tmp_path / 'other.dex'), ('1.1', tmp_path / 'many.dex')]
+
+    # an insert-many interrupted before copying its last version, which a single insert commits meanwhile
+    write_source = timeline._write_source
+    def interrupted_write_source(file_path, version, manifest):
+        if version == '1.1':
+            raise KeyboardInterrupt
+        write_source(file_path, version, manifest)
+    monkeypatch.setattr(timeline, '_write_source', interrupted_write_source)
+    with pytest.raises(KeyboardInterrupt):
+        timeline.insert_versions(entries, workers=1)
+    monkeypatch.setattr(timeline, '_write_source', write_source)
+    timeline.insert_version('1.1', tmp_path / 'single.dex')
+
+    timeline.insert_versions(entries, workers=1)
+
+    assert (Path(timeline.SOURCES_FOLDER) / '1.1').read_bytes() == (tmp_path / 'single.dex').read_bytes()
+
+
+def _write_apk_of_dexs(path, *dexs):
+    from benchmarks.dex import write_dex
+
+    with zipfile.ZipFile(path, 'w') as z:
+        for i, classes in enumerate(dexs):
+            z.writestr('classes' + ('' if i == 0 else str(i + 1)) + '.dex', write_dex(classes))
+
+
+@pytest.mark.parametrize('many', [False, True])
+def test_insert_maps_identical_dex_files_as_a_file_diff(tmp_path, monkeypatch, many):
+    from apocalypse.apk_differ import APKDiffer
+    from apocalypse.features import ClassFeatures, MethodFeatures
+
+    def _class(name, index):
+        return ClassFeatures(name, 'a', index, 1, 'Ljava/lang/Object;', 'java.lang', [MethodFeatures('a', [], 'VOID_T', 1, 2, 0)])
+
+    # identical classes, that only the identical dex file tells apart
+    unchanged = [_class('La/x;', 0), _class('La/y;', 1), _class('La/z;', 2)]
+    _write_apk_of_dexs(tmp_path / 'old.apk', [_class('La/o;', 0)], unchanged)
+    _write_apk_of_dexs(tmp_path / 'new.apk', [_class('La/n;', 0), _class('La/m;', 1)], unchanged)
+    expected, _ = APKDiffer(workers=1).diff(str(tmp_path / 'old.apk'), str(tmp_path / 'new.apk'))
+
+    timeline.init(tmp_path / 'timeline', 'APK')
+    monkeypatch.chdir(tmp_path / 'timeline')
+    if many:
+        timeline.insert_versions([('1.0', tmp_path / 'old.apk'), ('1.1', tmp_path / 'new.apk')], workers=1)
+    else:
+        timeline.insert_version('1.0', tmp_path / 'old.apk')
+        timeline.insert_version('1.1', tmp_path / 'new.apk')
+    mapping = json.loads(timeline.map('1.0', '1.1'))
+
+    assert mapping == expected
+    assert all(mapping[cls.fullname] == cls.fullname for cls in unchanged)